@@ -0,0 +1,404 @@
+import os
+import signal
+import socket
+import asyncio
+from sys import exit
+from time import monotonic
+from multiprocessing import Array, Lock, Process, RawArray, Value
+from ctypes import c_int, c_ulonglong
+from handler import RequestHandler
+from protocol import VALUE_FRAME, MULTI_RESULT, WireFormat, FrameReader
+from shm_table import ShmHashTable, ShmIndicatorTable
+from slab import SlabAllocator
+from stats import pack_snapshot
+from table_file import TableFile
+
+class RequestProtocol(asyncio.BufferedProtocol):
+    """Parses requests from one client connection and answers them in the
+    same event loop that read them"""
+    # request types
+    GET_BYTEC    = b'\x00'
+    PUT_BYTEC    = b'\x01'
+    END_BYTEC    = b'\x02'
+    GETV_BYTEC   = b'\x03'
+    PUTV_BYTEC   = b'\x04'
+    GETV_RYW_BYTEC = b'\x08'
+    MGET_BYTEC     = b'\x09'
+    MPUT_BYTEC     = b'\x0a'
+    MCOMMIT_BYTEC  = b'\x0b'
+    MABORT_BYTEC   = b'\x0c'
+    COMMIT_MANY_BYTEC = b'\x0f'
+    ABORT_MANY_BYTEC  = b'\x10'
+    # answered with the uptime and request count of every event loop (see
+    # stats.pack_snapshot); sent by cluster_stats.py, to stats_port
+    STATS_BYTEC       = b'\x11'
+
+    # response types
+    ACK_BYTEC    = b'\x06'
+    VALUE_BYTEC  = b'\x07'
+    CANCEL_BYTEC = b'\x18'
+
+    # multi-key requests, and the request each of their keys becomes
+    MULTI_REQUESTS = {
+        MGET_BYTEC: GET_BYTEC,
+        MPUT_BYTEC: MPUT_BYTEC,
+        MCOMMIT_BYTEC: ACK_BYTEC,
+        MABORT_BYTEC: CANCEL_BYTEC
+    }
+
+    # batched commits and aborts, and the request each of their PUTs
+    # becomes
+    DECISIONS = {
+        COMMIT_MANY_BYTEC: ACK_BYTEC,
+        ABORT_MANY_BYTEC: CANCEL_BYTEC
+    }
+
+    # requests answered with a VALUE response
+    GETV_REQUESTS = (
+        GETV_BYTEC,
+        GETV_RYW_BYTEC
+    )
+
+    def __init__(self, event_loop):
+        # the EventLoop process that accepted this connection
+        self.event_loop = event_loop
+        self.handler = event_loop.handler
+        self.framing = event_loop.framing
+        self.wire = event_loop.wire
+        self.request = event_loop.wire.request
+        self.verbose = event_loop.verbose
+        # the event loop reads straight into this buffer; partial requests
+        # stay in it until the rest of their bytes arrive
+        self.reader = FrameReader()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.event_loop.log("received a connection from: " +
+                repr(transport.get_extra_info('peername')))
+
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.reader.buffer_updated(nbytes)
+        handle = self.handler.handle
+        response_format = self.wire.response
+        responses = []
+        num_requests = 0
+        for request in self.read_requests():
+            message_id, request_type, key, value = request
+            if request_type == self.PUTV_BYTEC:
+                # the handler only ever sees the value's slab reference
+                value = self.store_value(value)
+            elif request_type in self.GETV_REQUESTS:
+                value = 0
+            if self.verbose:
+                self.event_loop.show_hex(self.wire.routed.pack(message_id,
+                        request_type, key, value, 0), prefix="Received: ")
+            if request_type == self.END_BYTEC:
+                self.event_loop.record_end()
+                continue
+            if request_type == self.STATS_BYTEC:
+                payload = self.event_loop.snapshot()
+                responses.append(self.wire.value_response.pack(message_id,
+                        self.VALUE_BYTEC, 0, len(payload)))
+                responses.append(payload)
+                continue
+            num_requests += 1
+            if request_type in self.MULTI_REQUESTS:
+                responses.extend(self.handle_multi(message_id, request_type,
+                        value))
+                continue
+            if request_type in self.DECISIONS:
+                key_type = self.DECISIONS[request_type]
+                for message_id, key, value in \
+                        self.wire.decision.iter_unpack(value):
+                    handle(key_type, key, value, message_id, self)
+                continue
+            # this connection and the message ID identify a PUT, so only
+            # its own abort releases its key
+            response = handle(request_type, key, value, message_id, self)
+            if response is None:
+                continue
+            if response[0] == self.VALUE_BYTEC:
+                value = self.read_value(key, response[1])
+                responses.append(self.wire.value_response.pack(
+                        message_id, self.VALUE_BYTEC, response[2],
+                        len(value)))
+                responses.append(value)
+            else:
+                responses.append(response_format.pack(message_id,
+                        *response))
+        self.event_loop.handled[self.event_loop.loop_id] += num_requests
+        # one write per read, no matter how many requests it held
+        if responses:
+            message = b''.join(responses)
+            if self.verbose:
+                self.event_loop.show_hex(message, prefix="Sending: ")
+            self.transport.write(message)
+
+    def handle_multi(self, message_id, request_type, entries):
+        """Applies a multi-key request; returns the buffers of its
+        response, if it gets one
+
+        Keys are handled in ascending order, so two multi-key requests
+        never take the same keys' pending marks in different orders."""
+        handle = self.handler.handle
+        key_type = self.MULTI_REQUESTS[request_type]
+        entries = sorted(self.wire.entry.iter_unpack(entries))
+        results = [handle(key_type, key, value, message_id, self)
+                for key, value in entries]
+        if request_type == self.MGET_BYTEC:
+            # every value and version, in ascending key order
+            payload = b''.join([MULTI_RESULT.pack(value, version)
+                    for response_type, value, version in results])
+            return (self.wire.value_response.pack(message_id,
+                    self.VALUE_BYTEC, 0, len(payload)), payload)
+        elif request_type != self.MPUT_BYTEC:
+            # commits and aborts get no response
+            return ()
+        response_type = self.ACK_BYTEC
+        if any(result[0] != self.ACK_BYTEC for result in results):
+            # all or nothing: release the keys we did get, then refuse
+            response_type = self.CANCEL_BYTEC
+            for (key, value), result in zip(entries, results):
+                if result[0] == self.ACK_BYTEC:
+                    handle(self.CANCEL_BYTEC, key, 0, message_id, self)
+        return (self.wire.response.pack(message_id, response_type, 0, 0),)
+
+    def store_value(self, value):
+        """Copies a PUTV value into the shared slab; returns its slab
+        reference, or 0 if it can't be stored"""
+        if self.handler.slab is None:
+            return 0
+        return self.handler.slab.store(value)
+
+    def read_value(self, key, ref):
+        """Returns a copy of the value at ref
+
+        The transport may hold on to what we write after this call
+        returns, and another EventLoop can replace and free the value at
+        any time, so unlike Worker we can't send straight from the slab.
+        The copy is only good if the key still points at the same slot
+        once it's done."""
+        blobs = self.handler.blobs
+        while ref:
+            value = bytes(self.handler.slab.view(ref))
+            current = blobs[key]
+            if current == ref:
+                return value
+            ref = current
+        return b''
+
+    def read_requests(self):
+        """Yields each complete (message_id, request_type, key, value)
+        request in the buffer; the values of GETV/PUTV requests are views
+        into the buffer"""
+        request = self.request
+        if self.framing:
+            for frame_kind, payload in self.reader.frames():
+                if frame_kind == VALUE_FRAME:
+                    yield from self.wire.value_requests(payload)
+                else:
+                    yield from request.iter_unpack(payload)
+        else:
+            yield from request.iter_unpack(
+                    self.reader.records(request.size))
+
+class EventLoop(Process):
+    """Accepts connections on a SO_REUSEPORT socket and serves them from a
+    single asyncio event loop"""
+    def __init__(self, loop_id, server_settings, backlog_size, table,
+            pending, pending_lock, num_done, framing=False, wire=None,
+            blobs=None, slab=None, outfile=None, verbose=False,
+            stats_port=None, handled=None, start_time=0):
+        self.loop_id = loop_id
+        self.server_settings = server_settings
+        # where cluster_stats.py asks for STATS; None doesn't listen
+        self.stats_port = stats_port
+        # handled[loop_id] counts the requests we've handled, and
+        # start_time is when the server started, for STATS answers
+        self.handled = handled or [0] * (loop_id + 1)
+        self.start_time = start_time
+        self.backlog_size = backlog_size
+        # other EventLoops share the table, so PUTs still need the lock
+        self.handler = RequestHandler(table, pending, pending_lock, blobs,
+                slab)
+        # number of ENDs received by all EventLoops
+        self.num_done = num_done
+
+        # whether clients wrap requests in length-prefixed frames
+        self.framing = framing
+        # record layouts, e.g. how wide keys are
+        self.wire = wire or WireFormat()
+
+        # logging info
+        self.outfile = outfile
+        self.verbose = verbose
+
+        # pass options to multiprocessing.Process
+        super(EventLoop, self).__init__(group=None, target=None, name=None)
+
+    def run(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # let the kernel spread incoming connections across EventLoops
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind(self.server_settings)
+        s.listen(self.backlog_size)
+        self.log("Loop {} listening for connections on port ({})".format(
+                self.loop_id, self.server_settings[1]))
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(loop.create_server(
+                lambda: RequestProtocol(self), sock=s))
+        if self.stats_port is not None:
+            # STATS requests come in on a port of their own, like the
+            # dispatcher's
+            stats_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            stats_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT,
+                    1)
+            stats_socket.bind((self.server_settings[0], self.stats_port))
+            stats_socket.listen(self.backlog_size)
+            loop.run_until_complete(loop.create_server(
+                    lambda: RequestProtocol(self), sock=stats_socket))
+        loop.run_forever()
+
+    def snapshot(self):
+        """Returns a STATS answer; there are no worker queues, and no
+        stage timings are recorded, so it only has our uptime and every
+        event loop's request count"""
+        return pack_snapshot(monotonic() - self.start_time, [],
+                sum(self.handled))
+
+    def record_end(self):
+        """Counts an END across all EventLoops"""
+        with self.num_done.get_lock():
+            self.num_done.value += 1
+            num_done = self.num_done.value
+        self.log("Received END #{}".format(num_done))
+
+    def log(self, message):
+        self.outfile.write(message + os.linesep)
+        self.outfile.flush()
+
+    def show_hex(self, data, prefix='', suffix=''):
+        """For debugging socket messages"""
+        import textwrap
+        data = textwrap.wrap(data.hex(), 2)
+        self.log(prefix + ' '.join(data) + suffix)
+
+class AsyncServer(Process):
+    """Drop-in replacement for Server that handles requests in asyncio event
+    loops instead of passing them through a Queue to Worker processes"""
+    def __init__(self, clients, server_host, config, hostname=None):
+        # setup connection info; hostname is our name in clients, which
+        # is this host's name unless we're one of several nodes on it
+        self.hostname = hostname or socket.gethostname()
+        self.clients = clients
+        self.num_clients = len(clients)
+        self.server_settings = (server_host, int(config['port']))
+        # where cluster_stats.py asks for STATS
+        self.stats_port = int(config['stats_port'])
+        self.backlog_size = int(config['backlog'])
+        # whether clients wrap requests in length-prefixed frames
+        self.framing = config['framing'].upper()[0] == 'T'
+        # record layouts, e.g. how wide keys are
+        self.wire = WireFormat.from_config(config)
+
+        # setup logging info
+        self.verbose = config['verbose'].upper()[0] == 'T'
+        outfilename = os.path.join(
+                os.getenv("OUTPUT_DIR"),
+                self.hostname + "_server.out")
+        self.outfile = open(outfilename, 'w')
+
+        # every event loop commits any key, so there's no one log a key's
+        # history could be replayed from
+        if config['wal_dir'] != 'none':
+            raise ValueError("wal_dir requires server_mode select")
+        # event loops don't talk to other servers
+        if config['replication'] != '2pc':
+            raise ValueError("replication primary requires server_mode "
+                    "select")
+        # stage timings come from the dispatcher and its workers
+        if config['stats'].upper()[0] == 'T':
+            raise ValueError("stats requires server_mode select")
+        # PUTs only wait for their keys in a Worker
+        if float(config['max_wait']):
+            raise ValueError("max_wait requires server_mode select")
+
+        # setup table
+        num_keys = int(config['table_size'])
+        self.table_file = None
+        if config['table_file'] != 'none':
+            if config['table_backend'] != 'array':
+                raise ValueError("table_file requires table_backend array")
+            # the table and pending indicators live in a mapped file, which
+            # a restarted server serves from right away
+            self.table_file = TableFile(config['table_file'], num_keys)
+            self.table = self.table_file.table
+            self.pending = self.table_file.pending
+            self.pending_lock = Lock()
+        elif config['table_backend'] == 'hash':
+            # every event loop writes the same table, so writes are locked
+            self.table = ShmHashTable(num_keys, lock=Lock())
+            self.pending = ShmIndicatorTable(lock=Lock())
+            self.pending_lock = Lock()
+        else:
+            # syncrhonized by means of an indicator array
+            self.table = RawArray(c_ulonglong, num_keys)
+            # a dumb globally-locked array keeps track of pending PUTs
+            self.pending = Array(c_int, num_keys)
+            self.pending_lock = self.pending.get_lock()
+        self.num_done = Value(c_int, 0)
+        # variable-length values, shared by every event loop; slab_bytes
+        # of slots per size class, and 0 disables GETV/PUTV
+        slab_bytes = int(config['slab_bytes'])
+        self.blobs = self.slab = None
+        if slab_bytes:
+            self.blobs = ShmHashTable(lock=Lock())
+            self.slab = SlabAllocator(slab_bytes, Lock())
+
+        # one event loop process per core
+        self.num_loops = int(config['server_threads'])
+        # requests each event loop has handled, for STATS answers
+        self.handled = RawArray(c_ulonglong, self.num_loops)
+
+        # setup multiprocessing info
+        super(AsyncServer, self).__init__(
+            group=None, target=None,
+            name="{} (server)".format(self.hostname))
+
+    def run(self):
+        """Start an event loop process for each server thread"""
+        loops = []
+        start_time = monotonic()
+        if self.table_file is not None:
+            self.outfile.write("Mapped table file {} ({}){}".format(
+                    self.table_file.path, self.table_file.status,
+                    os.linesep))
+            self.outfile.flush()
+            # stop_all.sh sends SIGTERM; unwind so the file is closed
+            # cleanly
+            signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+        for loop_id in range(self.num_loops):
+            loop = EventLoop(loop_id, self.server_settings,
+                    self.backlog_size, self.table, self.pending,
+                    self.pending_lock, self.num_done, self.framing,
+                    self.wire, self.blobs, self.slab, self.outfile,
+                    self.verbose, self.stats_port, self.handled, start_time)
+            loop.start()
+            loops.append(loop)
+        if self.slab is not None:
+            self.slab.unlink()
+        try:
+            for loop in loops:
+                loop.join()
+        finally:
+            if self.table_file is not None:
+                # the table has to stop changing before it's checksummed
+                for loop in loops:
+                    loop.terminate()
+                    loop.join()
+                self.table_file.close()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# Usage: ./bench.py [-n nodes] [-w workload ...] [--save results.json]
+#                   [--baseline results.json [--tolerance 0.1]] [name=value ...]
+# Runs fixed workloads against an N-node cluster on this machine and prints
+# throughput, GET/PUT latency percentiles, and retry and abort rates as
+# JSON. Every node gets its own loopback address (127.0.0.1, 127.0.0.2,
+# ...) as its identity, so no hostnames or config/ips entries are needed;
+# name=value pairs override config.txt options for every workload; e.g.
+# trace=/path/to/node_{node}.trace replays compiled traces (see traces.py)
+# instead of generating commands.
+#
+# With --baseline, the results are compared against a file written by
+# --save, and the exit status is 1 if any workload's throughput dropped, or
+# its p99 latency rose, by more than the tolerance.
+
+import os
+import json
+import glob
+import shutil
+import signal
+import socket
+import tempfile
+from argparse import ArgumentParser
+from sys import exit, stderr
+from time import monotonic, sleep
+from client import Client
+from server import Server
+from async_server import AsyncServer
+
+CONFIG = '../config/config.txt'
+
+# option overrides for each workload
+WORKLOADS = {
+    # mostly GETs, spread over the whole table
+    'read_heavy': {'get_frac': '0.95'},
+    'mixed': {'get_frac': '0.5'},
+    'write_heavy': {'get_frac': '0.2'},
+    # a handful of keys every client keeps writing
+    'hot_keys': {'get_frac': '0.5', 'table_size': '8'},
+    # skewed, but over the whole table
+    'zipf': {'get_frac': '0.5', 'key_distribution': 'zipf'},
+    'hotspot': {'get_frac': '0.5', 'key_distribution': 'hotspot',
+            'hot_key_frac': '0.05'},
+}
+
+# latency percentiles to report
+PERCENTILES = (
+    ('p50', 0.5),
+    ('p99', 0.99),
+    ('p99.9', 0.999)
+)
+
+def free_port():
+    """Returns a port nothing on the loopback interface is using"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_cluster(hosts, options):
+    """Starts a server and a client for each node, then waits to be
+    killed; runs in a process group of its own"""
+    os.setpgrp()
+    # clients print their throughput; stdout is for the results
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    server_type = options['server_mode'] == 'asyncio' and AsyncServer or \
+            Server
+    for host in hosts:
+        server_type(hosts, host, options, hostname=host).start()
+    # clients only retry a refused connection after a few seconds
+    sleep(0.5)
+    for host in hosts:
+        Client(hosts, options, hostname=host).start()
+    while True:
+        signal.pause()
+
+def run_workload(num_nodes, options, timeout):
+    """Runs one workload; returns each client's stats, or None if they
+    didn't all finish in time"""
+    hosts = ['127.0.0.{}'.format(node + 1) for node in range(num_nodes)]
+    options = dict(options, port=str(free_port()),
+            stats_port=str(free_port()))
+    output_dir = tempfile.mkdtemp(prefix='dht_bench_')
+    os.environ['OUTPUT_DIR'] = output_dir
+    # shared memory the cluster leaves behind when it's killed
+    segments = set(glob.glob('/dev/shm/psm_*'))
+    pid = os.fork()
+    if not pid:
+        try:
+            start_cluster(hosts, options)
+        finally:
+            os._exit(1)
+    filenames = [os.path.join(output_dir, host + '_client.json')
+            for host in hosts]
+    deadline = monotonic() + timeout
+    while monotonic() < deadline and \
+            not all(os.path.exists(filename) for filename in filenames):
+        sleep(0.1)
+    stats = None
+    if all(os.path.exists(filename) for filename in filenames):
+        stats = []
+        for filename in filenames:
+            with open(filename) as fh:
+                stats.append(json.load(fh))
+    os.killpg(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    for segment in set(glob.glob('/dev/shm/psm_*')) - segments:
+        os.remove(segment)
+    shutil.rmtree(output_dir)
+    return stats
+
+def percentile(samples, fraction):
+    """Returns the sample below which the given fraction of them fall"""
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+def summarize(stats):
+    """Combines every client's stats into one result for the workload"""
+    commands = sum(node['commands'] for node in stats)
+    # the clients run side by side, so the slowest one sets the pace
+    run_time = max(node['run_time'] for node in stats)
+    latency = dict()
+    for kind in stats[0]['latency']:
+        samples = sorted(sample for node in stats
+                for sample in node['latency'][kind])
+        if not samples:
+            continue
+        # microseconds to milliseconds
+        latency[kind] = dict((name, percentile(samples, fraction) / 1000)
+                for name, fraction in PERCENTILES)
+        latency[kind]['count'] = len(samples)
+    writes = sum(latency[kind]['count'] for kind in ('PUT', 'MPUT')
+            if kind in latency)
+    return {
+        'commands': commands,
+        'run_time': run_time,
+        'throughput': commands / run_time,
+        'latency_ms': latency,
+        # retries per command, and refused attempts per committed write
+        'retry_rate': sum(node['retries'] for node in stats) / commands,
+        'abort_rate': writes and
+                sum(node['aborts'] for node in stats) / writes or 0,
+        # traced commands sent behind their recorded time
+        'late_rate': sum(node['late'] for node in stats) / commands
+    }
+
+def regressions(results, baseline, tolerance):
+    """Returns a description of everything that got worse than baseline by
+    more than tolerance"""
+    found = []
+    for name, result in results['workloads'].items():
+        before = baseline['workloads'].get(name)
+        if before is None:
+            continue
+        if result is None:
+            found.append("{}: didn't finish".format(name))
+            continue
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            found.append("{}: throughput {:.0f} -> {:.0f} messages/s".format(
+                    name, before['throughput'], result['throughput']))
+        for kind, latency in result['latency_ms'].items():
+            if kind not in before['latency_ms']:
+                continue
+            old_p99 = before['latency_ms'][kind]['p99']
+            if latency['p99'] > old_p99 * (1 + tolerance):
+                found.append("{}: {} p99 {:.3f} -> {:.3f} ms".format(name,
+                        kind, old_p99, latency['p99']))
+    return found
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Benchmarks a cluster of nodes "
+            "on this machine's loopback interface")
+    parser.add_argument('-n', '--nodes', type=int, default=3)
+    parser.add_argument('-w', '--workload', action='append',
+            choices=sorted(WORKLOADS),
+            help="workload to run (default: all of them)")
+    parser.add_argument('-c', '--commands', type=int, default=2000,
+            help="commands each client sends")
+    parser.add_argument('-t', '--timeout', type=float, default=300,
+            help="seconds to wait for a workload to finish")
+    parser.add_argument('--save', help="also write the results here")
+    parser.add_argument('--baseline',
+            help="results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+            help="fraction by which results may get worse (default 0.1)")
+    parser.add_argument('overrides', nargs='*', metavar='name=value',
+            help="config.txt options to override")
+    args = parser.parse_args()
+
+    with open(CONFIG) as fh:
+        options = dict([line.strip().split() for line in fh])
+    overrides = dict(override.split('=', 1) for override in args.overrides)
+    options.update(overrides)
+    options['num_test_commands'] = str(args.commands)
+    # our own timing replaces the progress output
+    options['count_every'] = '0'
+    options['verbose'] = 'False'
+
+    results = {
+        'nodes': args.nodes,
+        'commands': args.commands,
+        'overrides': overrides,
+        'workloads': dict()
+    }
+    for name in args.workload or sorted(WORKLOADS):
+        stats = run_workload(args.nodes, dict(options, **WORKLOADS[name]),
+                args.timeout)
+        if stats is None:
+            print("{} didn't finish in {} s".format(name, args.timeout),
+                    file=stderr)
+        results['workloads'][name] = stats and summarize(stats)
+    print(json.dumps(results, indent=2))
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        found = regressions(results, baseline, args.tolerance)
+        for regression in found:
+            print("regression: " + regression, file=stderr)
+        if found:
+            exit(1)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# Usage: ./bench_transport.py [num_records [batch_size]]
+# Measures how fast 15-byte routed requests move from one process to
+# another through each dispatcher -> Worker transport
+
+from multiprocessing import Pipe, Process, Queue
+from sys import argv
+from time import time
+from protocol import ROUTED
+from ringbuffer import RingBuffer
+
+def queue_consumer(queue, num_records, done):
+    """The original transport: one pickled (bytes, fileno) per request"""
+    for i in range(num_records):
+        queue.get()
+    done.send(True)
+
+def pipe_consumer(pipe, num_records, done):
+    received = 0
+    while received < num_records:
+        received += len(pipe.recv_bytes()) // ROUTED.size
+    done.send(True)
+
+def ring_consumer(ring, num_records, done):
+    received = 0
+    while received < num_records:
+        batch = ring.get()
+        received += len(batch) // ROUTED.size
+        ring.consume(len(batch))
+    done.send(True)
+
+def run(name, consumer, channel, send, num_records, batch_size):
+    done_recv, done_send = Pipe(duplex=False)
+    proc = Process(target=consumer, args=(channel, num_records, done_send))
+    proc.start()
+    record = ROUTED.pack(1, b'\x00', 2, 3, 4)
+    batch = record * batch_size
+    start = time()
+    if send is None:
+        # queue: one put per request, like the dispatcher used to do
+        for i in range(num_records):
+            channel.put((record[:7], 4))
+    else:
+        for i in range(num_records // batch_size):
+            send(batch)
+    done_recv.recv()
+    elapsed = time() - start
+    proc.join()
+    print("{:6} {:12.0f} records/s {:8.3f} us/record".format(name,
+            num_records / elapsed, elapsed / num_records * 1e6))
+
+if __name__ == '__main__':
+    num_records = len(argv) > 1 and int(argv[1]) or 200000
+    batch_size = len(argv) > 2 and int(argv[2]) or 64
+    # whole batches only
+    num_records -= num_records % batch_size
+    print("{} records, batches of {}".format(num_records, batch_size))
+
+    queue = Queue()
+    run('queue', queue_consumer, queue, None, num_records, batch_size)
+
+    pipe_recv, pipe_send = Pipe(duplex=False)
+    run('pipe', pipe_consumer, pipe_recv, pipe_send.send_bytes,
+            num_records, batch_size)
+
+    ring = RingBuffer(ROUTED.size, 4096)
+    run('ring', ring_consumer, ring, ring.put, num_records, batch_size)
+    ring.unlink()
+    ring.close()
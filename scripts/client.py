@@ -2,42 +2,21 @@ import os
 import socket
 from select import select
 from sys import stdout
-from time import time, sleep
+from time import time, sleep, monotonic
 from multiprocessing import Process
-# there is no multiprocessing analogue to threading.Timer
-from threading import Lock, Timer
+from threading import Lock
+import json
+from array import array
 # for determining how much to wait between retries
 from math import exp
 from random import random
-
-def get_command_generator(num_commands, num_keys, num_messages=10000, count_every=0,
-        get_frac=0.8, max_value=1000):
-    """Returns a generator for random commands"""
-    if count_every > 0:
-        def generate_command():
-            for i in range(num_messages):
-                if not i % count_every:
-                    print("i =", i)
-                transaction_type = (random() < get_frac) and 'GET' or 'PUT'
-                if transaction_type != 'PUT':
-                    args = str(int(random() * num_keys))
-                else:
-                    args = str(int(random() * num_keys)) + ' ' + \
-                            str(int(random() * max_value))
-                yield transaction_type + ' ' + args
-            print("Last message generated")
-    else:
-        def generate_command():
-            for i in range(num_messages):
-                transaction_type = (random() < get_frac) and 'GET' or 'PUT'
-                if transaction_type != 'PUT':
-                    args = str(int(random() * num_keys))
-                else:
-                    args = str(int(random() * num_keys)) + ' ' + \
-                            str(int(random() * max_value))
-                yield transaction_type + ' ' + args
-            print("Last message generated")
-    return generate_command
+from protocol import FRAME_HEADER, BATCH_FRAME, VALUE_FRAME, MULTI_RESULT, \
+        STAMP, WireFormat, FrameReader, sendmsg_all
+from placement import Placement
+from pending import PendingTable
+from timer_wheel import TimerWheel
+from workload import CONSISTENCIES, Workload, GET, PUT, MGET
+from traces import Trace
 
 class Client(Process):
     #
@@ -49,30 +28,150 @@ class Client(Process):
     GET_BYTEC    = b'\x00'
     PUT_BYTEC    = b'\x01'
     END_BYTEC    = b'\x02'
+    GETV_BYTEC   = b'\x03' # GET a variable-length value
+    PUTV_BYTEC   = b'\x04' # PUT a variable-length value
+    GET_RYW_BYTEC  = b'\x05' # GET that waits out a pending PUT
+    GETV_RYW_BYTEC = b'\x08' # GETV that waits out a pending PUT
+    MGET_BYTEC     = b'\x09' # GET several keys
+    MPUT_BYTEC     = b'\x0a' # PUT several keys in one transaction
+    MCOMMIT_BYTEC  = b'\x0b' # commit an MPUT
+    MABORT_BYTEC   = b'\x0c' # abort an MPUT
+    COMMIT_MANY_BYTEC = b'\x0f' # commit several PUTs
+    ABORT_MANY_BYTEC  = b'\x10' # abort several PUTs
 
     # response types
-    EMPTY_BYTEC  = b'\x00' # when the response of a GET is null
+    EMPTY_BYTEC  = b'\x00' # a PUT is pending; only for GET_RYW/GETV_RYW
     ACK_BYTEC    = b'\x06' # OK
+    VALUE_BYTEC  = b'\x07' # answer to a GETV; a length, then the value
     CANCEL_BYTEC = b'\x18' # Abort
 
-    # maximum size of a short
-    max_counter = 2 ** 16
+    # requests that carry a variable-length value
+    VALUE_REQUESTS = (
+        GETV_BYTEC,
+        PUTV_BYTEC,
+        GETV_RYW_BYTEC,
+        MGET_BYTEC,
+        MPUT_BYTEC,
+        MCOMMIT_BYTEC,
+        MABORT_BYTEC,
+        COMMIT_MANY_BYTEC,
+        ABORT_MANY_BYTEC
+    )
+
+    # requests whose value is a list of (key, value) entries for each
+    # server, instead of one value for every replica
+    MULTI_REQUESTS = (
+        MGET_BYTEC,
+        MPUT_BYTEC
+    )
 
-    def __init__(self, servers, config):
-        """servers should be a list of hostnames"""
+    # how many of a key's replicas a GET is sent to: the least-loaded one,
+    # a majority, or all of them; the newest version any of them answers
+    # with wins
+    READ_CONSISTENCY = (
+        'one',
+        'quorum',
+        'all'
+    )
+
+    # requests the servers don't answer: commit, abort and END
+    NO_RESPONSE = (
+        ACK_BYTEC,
+        CANCEL_BYTEC,
+        END_BYTEC,
+        MCOMMIT_BYTEC,
+        MABORT_BYTEC,
+        COMMIT_MANY_BYTEC,
+        ABORT_MANY_BYTEC
+    )
+
+    # requests answered with a value
+    READ_REQUESTS = (
+        GET_BYTEC,
+        GETV_BYTEC,
+        GET_RYW_BYTEC,
+        GETV_RYW_BYTEC
+    )
+
+    # how requests are grouped in the latency figures
+    LATENCY_KINDS = {
+        GET_BYTEC: 'GET',
+        GETV_BYTEC: 'GET',
+        GET_RYW_BYTEC: 'GET',
+        GETV_RYW_BYTEC: 'GET',
+        PUT_BYTEC: 'PUT',
+        PUTV_BYTEC: 'PUT',
+        MGET_BYTEC: 'MGET',
+        MPUT_BYTEC: 'MPUT'
+    }
+
+    def __init__(self, servers, config, hostname=None):
+        """servers should be a list of hostnames; hostname is our own
+        node's name among them (default: this host's name)"""
         self.config = config
 
         # general network info
         num_servers = len(servers)
         self.num_nodes = num_servers
         self.num_servers = num_servers
-        self.hostname = socket.gethostname()
+        self.hostname = hostname or socket.gethostname()
         self.node_n = servers.index(self.hostname) # our node ID
 
         # connection settings
         port = int(config['port'])
         self.client_settings = list(zip(servers, (port,) * num_servers))
         self.max_retries = int(config['max_retries'])
+        # decides which replication_factor servers store each key
+        self.placement = Placement(num_servers,
+                int(config['replication_factor']))
+        # whether to wrap requests in length-prefixed frames
+        self.framing = config['framing'].upper()[0] == 'T'
+        # how many bytes a key takes on the wire
+        self.key_bytes = int(config['key_bytes'])
+        # how many bytes a message ID takes on the wire; IDs wrap here
+        self.id_bytes = int(config['id_bytes'])
+        self.max_counter = 2 ** (8 * self.id_bytes)
+        # response layouts
+        self.wire = WireFormat.from_config(config)
+        # if nonzero, PUT values of this many bytes with PUTV, and read
+        # them back with GETV
+        self.value_bytes = int(config['value_bytes'])
+        if self.value_bytes and not self.framing:
+            raise ValueError("value_bytes requires framing")
+        # servers answer GETs with the last committed value, even while a
+        # PUT of the key is pending; if this is set, GETs of keys we have
+        # a PUT in flight for wait until that PUT is committed instead
+        self.read_your_writes = config['read_your_writes'].upper()[0] == 'T'
+        # number of our PUTs in flight for each key
+        self.writing = dict()
+        # if nonzero, test commands are MGETs and MPUTs of this many keys.
+        # An MPUT is refused unless it gets every key's pending mark on
+        # every replica, so refusals grow quickly with the number of keys
+        # in flight (clients * backlog * multi_keys) over table_size
+        self.multi_keys = int(config['multi_keys'])
+        if self.multi_keys and not self.framing:
+            raise ValueError("multi_keys requires framing")
+        # with 'primary' replication, PUTs only go to their key's primary
+        # (the first of its replicas), which answers once every replica
+        # has the value, and there's nothing to commit or abort
+        self.primary = config['replication'] == 'primary'
+        if self.primary and (self.value_bytes or self.multi_keys):
+            raise ValueError("replication primary only supports PUT")
+        # with max_wait set, servers let an older PUT wait for a key that
+        # a younger one holds, so each PUT carries its transaction's stamp
+        self.stamped = float(config['max_wait']) > 0 and not self.primary
+        if self.stamped and not self.framing:
+            raise ValueError("max_wait requires framing")
+        # commits and aborts decided while handling the same batch of
+        # responses go to each server as one COMMIT_MANY and ABORT_MANY
+        self.batch_decisions = config['batch_decisions'].upper()[0] == 'T'
+        if self.batch_decisions and not self.framing:
+            raise ValueError("batch_decisions requires framing")
+        # default for GETs that don't ask for a READ_CONSISTENCY
+        self.read_consistency = config['read_consistency']
+        if self.read_consistency not in self.READ_CONSISTENCY:
+            raise ValueError("unknown read_consistency: {}".format(
+                    self.read_consistency))
 
         # logging info
         self.verbose = config['verbose'].upper()[0] == 'T'
@@ -83,22 +182,62 @@ class Client(Process):
 
         # ensure only one thread attempts read/write operation on sockets
         self.sock_lock = Lock()
-        # ensure only one thread attempts to modify pending dict
+        # ensure only one thread attempts to modify pending table
         self.pending_lock = Lock()
-        # amount to increase our message ID by
-        self.next_message_id = self.node_n
         # amount of pending messages we can have before we just wait
         self.backlog = int(config['backlog'])
+        # seconds from first sending each finished request to finishing it,
+        # by LATENCY_KINDS; and how often requests were retried, and PUTs
+        # refused
+        self.latencies = dict((kind, array('d'))
+                for kind in set(self.LATENCY_KINDS.values()))
+        self.num_retries = 0
+        self.num_aborts = 0
+        # messages waiting to be retried, by when they're due; fired from
+        # the response loop, so retries need no threads of their own
+        self.retry_timers = TimerWheel()
+        # amount of messages waiting to be retried before we stop sending
+        # new ones
+        self.max_pending_retries = int(config['max_pending_retries'])
+        # buffered requests are sent once a server's outbox holds this many
+        # bytes, or once its oldest request is this many seconds old
+        self.flush_size = int(config['flush_size'])
+        self.flush_latency = float(config['flush_latency'])
 
-        # controls what randomly generated commands look like
-        self.generate_command = get_command_generator(
-            int(config['num_test_commands']),
-            int(config['table_size']),
-            int(config['num_test_commands']),
-            int(config['count_every']),
-            float(config['get_frac']),
-            int(config['max_value'])
-        )
+        # every command we'll send, generated before the timer starts;
+        # with a seed, the commands are the same from run to run (and
+        # still different on every node)
+        seed = config['seed'] != 'none' and \
+                int(config['seed']) + self.node_n or None
+        # or replayed from a compiled trace; {node} in its path is our
+        # node number
+        self.trace_timing = config['trace_timing']
+        if config['trace'] != 'none':
+            self.workload = Trace(config['trace'].format(node=self.node_n))
+            if self.workload.key_bytes > int(config['key_bytes']):
+                raise ValueError("trace has {}-byte keys".format(
+                        self.workload.key_bytes))
+        else:
+            self.workload = Workload(
+                int(config['num_test_commands']),
+                int(config['table_size']),
+                float(config['get_frac']),
+                int(config['max_value']),
+                config['key_distribution'],
+                float(config['zipf_s']),
+                float(config['hot_key_frac']),
+                float(config['hot_access_frac']),
+                float(config['rmw_frac']),
+                self.multi_keys,
+                seed,
+                self.key_bytes
+            )
+        # a traced command sent later than it was recorded by more than
+        # this many seconds counts as late
+        self.late_after = 0.001
+        self.num_late = 0
+        # print progress every count_every commands; 0 doesn't
+        self.count_every = int(config['count_every'])
 
         # setup thread settings
         super(Client, self).__init__(
@@ -136,42 +275,103 @@ class Client(Process):
                 self.start_time))
         self.outfile.flush()
         self.connected = connected
+        # requests waiting to be sent to each server, in the order they
+        # were made, and when the oldest of them was buffered
+        self.outbox = dict()
+        self.outbox_since = dict()
+        # with framing, where the batch frame that plain requests are
+        # added to starts in each outbox; None if there's none open
+        self.batch_start = dict()
+        # requests sent to each server that it hasn't answered yet
+        self.outstanding = dict()
+        # (message ID, key, value) entries of the PUTs to commit and abort
+        # on each server, with batch_decisions
+        self.commits = dict()
+        self.aborts = dict()
+        # responses are received into a buffer per server, and partial
+        # responses wait there for the rest of their bytes
+        self.readers = dict()
+        for conn in connected:
+            self.outbox[conn] = bytearray()
+            self.outbox_since[conn] = 0
+            self.batch_start[conn] = None
+            self.outstanding[conn] = 0
+            self.commits[conn] = []
+            self.aborts[conn] = []
+            self.readers[conn] = FrameReader()
 
         # process each transaction sequentially (slow)
-        num_servers = self.num_servers
-        # list of messages sent which have not yet been given a response
-        self.pending = dict() 
-        for command in self.generate_command():
+        replicas = self.placement.replicas
+        workload = self.workload
+        count_every = self.count_every
+        # with a trace at its recorded timing, each command is sent when
+        # it's due whether or not earlier ones have been answered (open
+        # loop); otherwise, we wait once more than backlog are pending
+        paced = isinstance(workload, Trace) and \
+                self.trace_timing == 'recorded'
+        # messages sent which have not yet been given a response; a
+        # canceled PUT briefly holds two IDs while it's reissued. Replaying
+        # a trace open-loop, we only wait if we run out of message IDs.
+        capacity = 2 * (self.backlog + 2)
+        if paced:
+            num_ids = (self.max_counter - self.node_n - 1) // \
+                    self.num_nodes + 1
+            capacity = 1 << (num_ids.bit_length() - 1)
+        self.pending = PendingTable(capacity, self.node_n, self.num_nodes,
+                self.max_counter)
+        max_pending = paced and capacity - 2 or self.backlog
+        trace_start = monotonic()
+        # commands are sent as they're packed if their keys are as wide
+        # as ours
+        direct = workload.key_bytes == self.key_bytes
+        for command_n, (op, key, value, command) in enumerate(workload):
+            if count_every and not command_n % count_every:
+                print("i =", command_n)
+            if paced:
+                due = trace_start + workload.offset(command_n)
+                self.wait_until(due)
+                if monotonic() - due > self.late_after:
+                    self.num_late += 1
             if self.verbose:
-                self.outfile.write(command + '\n')
+                self.outfile.write(workload.describe(command_n) + '\n')
                 self.outfile.flush()
-            # get request type
-            request_type = command[:3]
-            # get first parameter (key) from the command
-            args = list(map(int, command[4:].split()))
-            key = args[0]
-            # determine which server is responsible for handling this tx
-            server_index = key % num_servers
-            target_server = connected[server_index]
-
-            # make request to everybody; deal with response later
-            for target_server in connected:
-                # make the request
-                if request_type == 'GET':
-                    self.get(target_server, self.next_message_id, key)
-                elif request_type == 'PUT':
-                    value = args[1]
-                    self.put(target_server, self.next_message_id, key,
-                            value)
-
-            # make sure messages have unique message ID
-            self.next_message_id += self.num_nodes
-            # make sure we won't overflow
-            self.next_message_id %= self.max_counter
 
+            # make request to each replica; deal with response later;
+            # message IDs are unique among the messages still pending
+            self.pending_lock.acquire()
+            message_id = self.pending.new_id()
+            self.pending_lock.release()
+            if not direct:
+                command = None
+            if op == GET:
+                # determine which servers are responsible for this tx
+                servers = [connected[index] for index in replicas(key)]
+                # a GET's value is the consistency it asks for
+                self.get(servers, message_id, key, CONSISTENCIES[value],
+                        command)
+            elif op == PUT:
+                servers = [connected[index] for index in replicas(key)]
+                self.put(servers, message_id, key, value, command)
+            elif op == MGET:
+                self.mget(message_id, key)
+            else:
+                self.mput(message_id, dict(zip(key, value)))
+
+            # send whatever has waited long enough
+            self.flush(force=False)
+
+            if paced:
+                # read whatever has come back, but don't wait for it
+                self.check_responses(block=False)
+                while len(self.pending) > max_pending:
+                    self.flush()
+                    self.check_responses(block=True)
+                continue
             # check for responses; prevent pending messages from
             # accumulating endlessly; also prevent socket buffer overflow
-            self.wait_responses(max_pending=self.backlog)
+            self.wait_responses(max_pending=max_pending)
+        if count_every:
+            print("Last message generated")
 
         # done sending messages, and now we wait for the final responses
         self.wait_responses(max_pending=0)
@@ -183,9 +383,10 @@ class Client(Process):
         print(debug_msg)
         self.outfile.write(debug_msg + os.linesep)
         debug_msg = "Average throughput: {:.2f} messages/s".format(
-                int(self.config['num_test_commands']) / run_time)
+                len(self.workload) / run_time)
         print(debug_msg)
         self.outfile.write(debug_msg + os.linesep)
+        self.write_stats(run_time)
 
         # write that we're done to our debug file
         self.outfile.write("Writing {} ENDs{}".format(len(connected),
@@ -195,6 +396,7 @@ class Client(Process):
         # write that we're done to all servers
         for conn in connected:
             self.request(conn, 0, self.END_BYTEC)
+        self.flush()
 
         # we should get sigterm, but if not within 100s, just join thread
         while True:
@@ -214,15 +416,30 @@ class Client(Process):
             done = False
             while not done:
                 self.pending_lock.acquire()
-                if len(self.pending) <= max_pending:
+                if len(self.pending) <= max_pending and \
+                        len(self.retry_timers) <= self.max_pending_retries:
                     block = False
                 self.pending_lock.release()
+                if block:
+                    # nobody can answer requests still in the outbox
+                    self.flush()
                 responses_read = self.check_responses(block=block)
                 if not block and not responses_read:
                     done = True
 
-    def check_responses(self, block=False):
-        """Check established connections to see if any servers responded
+    def wait_until(self, when):
+        """Handles responses until monotonic() reaches when"""
+        while True:
+            timeout = when - monotonic()
+            if timeout <= 0:
+                return
+            # nobody can answer requests still in the outbox
+            self.flush()
+            self.check_responses(block=True, timeout=timeout)
+
+    def check_responses(self, block=False, timeout=None):
+        """Check established connections to see if any servers responded;
+        when blocking, waits no more than timeout seconds, if given
         
         Returns whether any responses were read"""
         responses_read = False
@@ -230,110 +447,204 @@ class Client(Process):
         wlist = tuple()
         xlist = tuple()
         if block:
-            # wait for a connection
-            ready_list = select(self.connected, wlist, xlist)[0]
+            # wait for a connection, or for the next retry to come due
+            wait = self.retry_timers.timeout()
+            if timeout is not None and (wait is None or timeout < wait):
+                wait = timeout
+            ready_list = select(self.connected, wlist, xlist, wait)[0]
         else:
             # poll connections; don't block
             ready_list = select(self.connected, wlist, xlist, 0)[0]
+        self.send_retries()
         for conn in ready_list:
-            message_id, response_type, data = self.receive_response(conn)
-            if message_id == None:
-                break
-            responses_read = True
+            # read as much as the connection has
+            reader = self.readers[conn]
+            self.sock_lock.acquire()
+            nbytes = reader.recv_from(conn)
+            self.sock_lock.release()
+            if not nbytes:
+                continue
+            # handle every complete response it held
             self.pending_lock.acquire()
-            # we don't need to handle duplicate responses
-            if message_id in self.pending:
-                message_log = self.pending[message_id]
-                message_type = message_log["args"][1]
-                # is the response for a GET?
-                if message_type == self.GET_BYTEC:
-                    key = int.from_bytes(message_log["args"][2],
-                            byteorder='big')
-                    if response_type == self.EMPTY_BYTEC:
-                        # we got a 'busy' response
-                        result = None
-                        message_log['responses'] += 1
-                        if message_log['responses'] >= self.num_servers:
-                            # everyone's busy; retry later
-                            message_log['responses'] = 0
-                            self.retry(message_id)
-                    else:
-                        # we got a good response; remove from pending
-                        result = int.from_bytes(data, byteorder='big')
-                        del self.pending[message_id]
-                    debug_msg = "GET {}: {}".format(key, result)
+            for message_id, response_type, data, version in \
+                    reader.responses(self.wire, self.VALUE_BYTEC):
+                responses_read = True
+                if self.verbose:
+                    self.outfile.write("Received: {} {}\n".format(
+                        message_id, response_type.hex()))
+                self.handle_response(conn, message_id, response_type, data,
+                        version)
+            self.pending_lock.release()
+        if self.batch_decisions:
+            self.send_decisions()
+
+        return responses_read
+
+    def handle_response(self, conn, message_id, response_type, data,
+            version=0):
+        """Acts on one response; the caller holds pending_lock
+
+        Parameters
+        ----------
+            conn            socket  connection the response came from
+            message_id      int     message chain ID
+            response_type   bytes   EMPTY/ACK/VALUE/CANCEL
+            data            int     value of a GET, or a view of the value
+                                    of a GETV
+            version         int     number of times the key had been
+                                    committed when it was read
+        """
+        message_log = self.pending.get(message_id)
+        # we don't need to handle duplicate responses
+        if message_log is not None:
+            if message_log.owed.get(conn):
+                message_log.owed[conn] -= 1
+                self.outstanding[conn] -= 1
+            message_type = message_log.request_type
+            # is the response for an MGET?
+            if message_type == self.MGET_BYTEC:
+                # answers for the keys we asked this server for, in the
+                # same order
+                result = message_log.result
+                keys = [key for key, value in
+                        self.wire.entry.iter_unpack(message_log.value[conn])]
+                for key, (value, version) in zip(keys,
+                        MULTI_RESULT.iter_unpack(data)):
+                    if key not in result or version > result[key][1]:
+                        result[key] = value, version
+                message_log.responses += 1
+                if message_log.responses >= len(message_log.servers):
+                    # everyone answered; remove from pending
+                    self.finish(message_log)
                     if self.verbose:
-                        self.outfile.write(debug_msg + '\n')
-                # is the response for a PUT?
-                elif message_type == self.PUT_BYTEC:
-                    key, value = message_log["args"][2:]
-                    key = int.from_bytes(key, byteorder='big')
+                        self.outfile.write("MGET {}\n".format(' '.join(
+                                "{}: {} (version {})".format(key, *result[key])
+                                for key in sorted(result))))
+            # is the response for a GET?
+            elif message_type in self.READ_REQUESTS:
+                key = int.from_bytes(message_log.key, byteorder='big')
+                result = None
+                if response_type == self.EMPTY_BYTEC:
+                    # we got a 'busy' response
+                    message_log.busy = True
+                elif version > message_log.version:
+                    # the newest value so far
+                    if response_type == self.VALUE_BYTEC:
+                        # the view is only good until the next read
+                        data = len(message_log.servers) > 1 and \
+                                bytes(data) or data
+                    message_log.version = version
+                    message_log.result = data
+                message_log.responses += 1
+                if message_log.responses < len(message_log.servers):
+                    # wait for the rest of the replicas we asked
+                    pass
+                elif message_log.busy:
+                    # somebody's busy; retry later
+                    message_log.responses = 0
+                    message_log.busy = False
+                    message_log.version = -1
+                    message_log.result = None
+                    self.retry(message_id)
+                else:
+                    # everyone answered; remove from pending
+                    result = message_log.result
+                    if message_type in self.VALUE_REQUESTS:
+                        result = "{} bytes".format(len(result))
+                    result = "{} (version {})".format(result,
+                            message_log.version)
+                    self.finish(message_log)
+                debug_msg = "GET {}: {}".format(key, result)
+                if self.verbose:
+                    self.outfile.write(debug_msg + '\n')
+            # is the response for a PUT?
+            elif message_type in (self.PUT_BYTEC, self.PUTV_BYTEC,
+                    self.MPUT_BYTEC):
+                key = int.from_bytes(message_log.key, byteorder='big')
+                value = message_log.value
+                if message_type == self.MPUT_BYTEC:
+                    entries = self.multi_entries(message_log)
+                    key = ','.join(map(str, sorted(entries)))
+                    value = ','.join(str(entries[key]) for key in
+                            sorted(entries))
+                elif message_type == self.PUTV_BYTEC:
+                    value = "({} bytes)".format(len(value))
+                else:
                     value = int.from_bytes(value, byteorder='big')
 
-                    if response_type == self.ACK_BYTEC:
-                        # can't commit until everyone's said "OK"
-                        message_log['responses'] += 1
-                        if self.verbose:
-                            self.outfile.write("Got ACK #" +
-                                    str(message_log['responses']) + "\n")
-                        if message_log['responses'] >= self.num_servers:
-                            for target_server in self.connected:
-                                if self.verbose:
-                                    self.outfile.write("target is " +
-                                            repr(target_server) + "\n")
-                                self.commit(target_server, message_id)
-                            del self.pending[message_id]
-                        result = "OK"
-                    elif response_type == self.CANCEL_BYTEC:
-                        # need to use a different message_id
-                        message_log['responses'] = 0
-                        if self.verbose:
-                            self.outfile.write("got cancel\n")
-                            self.outfile.write("message ID is:" + str(
-                                message_id) + "\n")
-                        new_id = self.next_message_id
-
-                        # incr msg ID counter by an appropriate amount
-                        self.next_message_id += self.num_nodes
-                        self.next_message_id %= self.max_counter
-
-                        self.pending[new_id] = self.pending[message_id]
-                        # make sure args indicates updated message ID
-                        message_id, req_type, k, v = \
-                                self.pending[new_id]['args']
-                        self.pending[new_id]['args'] = (new_id, req_type,
-                                k, v)
-
-                        # send everyone else an abort
-                        for target_server in self.connected:
-                            if not target_server == conn:
-                                self.abort(target_server, message_id)
-
-                        if self.verbose:
-                            self.outfile.write("deleting pending\n")
-                            self.outfile.flush()
-                        del self.pending[message_id]
-                        if self.verbose:
-                            self.outfile.write("pending deleted\n")
-                            self.outfile.flush()
-
-                        # retry with new msg ID
-                        message_id = new_id
-                        if self.verbose:
-                            self.outfile.write("retrying with ID " + str(
-                                message_id) + "\n")
-
-                        self.retry(message_id)
-
-                        result = "Denied"
-                    else:
-                        result = "Got bad response message"
-                    debug_msg = "PUT {} {}: {}".format(key, value, result)
+                if response_type == self.ACK_BYTEC:
+                    # can't commit until everyone's said "OK"
+                    message_log.responses += 1
                     if self.verbose:
-                        self.outfile.write(debug_msg + '\n')
-            self.pending_lock.release()
+                        self.outfile.write("Got ACK #" +
+                                str(message_log.responses) + "\n")
+                    if message_log.responses >= \
+                            len(message_log.servers):
+                        # the primary has already committed it
+                        commit_to = not self.primary and \
+                                message_log.servers or ()
+                        for target_server in commit_to:
+                            if self.verbose:
+                                self.outfile.write("target is " +
+                                        repr(target_server) + "\n")
+                            self.commit(target_server, message_id)
+                        if message_type == self.MPUT_BYTEC:
+                            for multi_key in self.multi_entries(message_log):
+                                self.done_writing(multi_key.to_bytes(
+                                        self.key_bytes, byteorder='big'))
+                        else:
+                            self.done_writing(message_log.key)
+                        self.finish(message_log)
+                    result = "OK"
+                elif response_type == self.CANCEL_BYTEC:
+                    # need to use a different message_id
+                    if self.verbose:
+                        self.outfile.write("got cancel\n")
+                        self.outfile.write("message ID is:" + str(
+                            message_id) + "\n")
+                    new_id = self.pending.new_id()
+
+                    # move the request over to its new message ID
+                    new_log = self.pending.add(new_id, message_type,
+                            message_log.key, message_log.value,
+                            message_log.servers)
+                    new_log.retries = message_log.retries
+                    new_log.multiplier = message_log.multiplier
+                    new_log.sent = message_log.sent
+                    # still the same transaction, as old as it was
+                    new_log.stamp = message_log.stamp
+                    # nothing's been sent with the new ID until it's
+                    # retried
+                    new_log.owed = dict.fromkeys(message_log.servers, 0)
+                    self.num_aborts += 1
+
+                    # send every other replica an abort
+                    for target_server in message_log.servers:
+                        if not target_server == conn:
+                            self.abort(target_server, message_id)
+
+                    if self.verbose:
+                        self.outfile.write("deleting pending\n")
+                        self.outfile.flush()
+                    self.clear(message_log)
+                    if self.verbose:
+                        self.outfile.write("pending deleted\n")
+                        self.outfile.flush()
+
+                    # retry with new msg ID
+                    message_id = new_id
+                    if self.verbose:
+                        self.outfile.write("retrying with ID " + str(
+                            message_id) + "\n")
+
+                    self.retry(message_id)
 
-            return responses_read
+                    result = "Denied"
+                else:
+                    result = "Got bad response message"
+                debug_msg = "PUT {} {}: {}".format(key, value, result)
+                if self.verbose:
+                    self.outfile.write(debug_msg + '\n')
 
     def show_pending(self, show_ascii=True, show_hex=False,
             show_retries=True, min_pending=None, show_num_pending=False,
@@ -355,22 +666,20 @@ class Client(Process):
             print(num_pending, "messages pending")
 
         if show_retries:
-            values = self.pending.values()
             max_retries = 0
-            for value in values:
-                if value['retries'] > max_retries:
-                    max_retries = value['retries']
+            for message_obj in self.pending:
+                if message_obj.retries > max_retries:
+                    max_retries = message_obj.retries
             print(max_retries, "retries for at least 1 message")
 
         if show_ascii or show_hex:
             if min_pending != None and num_pending >= min_pending:
-                for message_obj in self.pending.values():
-                    args = message_obj["args"]
+                for message_obj in self.pending:
+                    args = message_obj.args
                     if show_ascii:
-                        message = args[0].to_bytes(2, 'big'), *args[1:]
-                        key = int.from_bytes(message[2], 'big')
-                        if len(message) > 3:
-                            value = int.from_bytes(message[3], 'big')
+                        key = int.from_bytes(message_obj.key, 'big')
+                        if message_obj.request_type == self.PUT_BYTEC:
+                            value = int.from_bytes(message_obj.value, 'big')
                             debug_msg = "PUT {} {}".format(key, value)
                         else:
                             debug_msg = "GET {}".format(key)
@@ -382,24 +691,10 @@ class Client(Process):
         if acquire_lock:
             self.pending_lock.release()
 
-    def receive_response(self, conn):
-        """Reads and returns five bytes at a time"""
-        # block if necessary
-        self.sock_lock.acquire()
-        message = conn.recv(5)
-        self.sock_lock.release()
-        if not message:
-            return None, None, None
-        if self.verbose:
-            self.show_hex(message, prefix="Received: ", use_outfile=True)
-        message_id = int.from_bytes(message[:2], byteorder='big')
-        response_type = message[2:3]
-        data = message[3:5]
-        return message_id, response_type, data
-
     def request(self, conn, message_id, request_type,
-            key=PAD_BYTEC*2, value=PAD_BYTEC*2):
-        """Sends a bytecode request using the given connection
+            key=None, value=PAD_BYTEC*2, stamp=None):
+        """Buffers a bytecode request for the given connection; it is sent
+        by the next flush
         
         Parameters
         ----------
@@ -408,87 +703,416 @@ class Client(Process):
             request_type    bytes   whether to PUT/GET/END
             key             bytes   key to GET/PUT (leave blank for END)
             value           bytes   value to PUT (PUT only)
+            stamp           bytes   the PUT's transaction stamp, if it has
+                                    one (see protocol.STAMP)
         """
-        # convert ints to ushort bytes
-        message_id = message_id.to_bytes(2, byteorder='big')
-        # send concatenated bytes
+        if key is None:
+            key = self.PAD_BYTEC * self.key_bytes
+        # convert ints to bytes
+        message_id = message_id.to_bytes(self.id_bytes, byteorder='big')
+        framed = stamp is not None or request_type in self.VALUE_REQUESTS
+        if stamp is not None:
+            # the stamp goes in front of the value
+            message = self.value_frame(message_id, request_type, key,
+                    stamp + value)
+        elif framed:
+            # length-prefixed value, in a frame of its own
+            if request_type in (self.GETV_BYTEC, self.GETV_RYW_BYTEC):
+                value = b''
+            message = self.value_frame(message_id, request_type, key, value)
+        else:
+            message = message_id + request_type + key + value
+        self.buffer(conn, request_type not in self.NO_RESPONSE, framed,
+                message)
+
+    def send_command(self, conn, message_id, command):
+        """Buffers a request that's packed already but for its message ID:
+        a command of a Workload or Trace, whose keys are as wide as ours"""
+        self.buffer(conn, True, False, message_id.to_bytes(self.id_bytes,
+                byteorder='big'), command)
+
+    def buffer(self, conn, answered, framed, *parts):
+        """Adds the parts of a request to the end of a connection's outbox,
+        and flushes the connection once it's holding flush_size bytes;
+        framed tells whether the request is a frame of its own, and
+        answered whether the server will respond
+
+        Requests are sent in the order they're buffered, so an abort or
+        commit never reaches a server ahead of the PUT it's for. With
+        framing, plain requests go in a batch frame that stays open until
+        a framed request or a flush closes it."""
         self.sock_lock.acquire()
         if self.verbose:
-            self.show_hex(message_id + request_type + key + value,
-                    prefix="Sending: ", use_outfile=True)
+            self.show_hex(b''.join(parts), prefix="Buffering: ",
+                    use_outfile=True)
             self.outfile.flush()
-        conn.sendall(message_id + request_type + key + value)
+        if answered:
+            self.outstanding[conn] += 1
+        outbox = self.outbox[conn]
+        if not outbox:
+            self.outbox_since[conn] = monotonic()
+        if framed:
+            self.close_batch(conn)
+        elif self.framing and self.batch_start[conn] is None:
+            # room for the header, packed once the frame is closed
+            self.batch_start[conn] = len(outbox)
+            outbox += bytes(FRAME_HEADER.size)
+        for part in parts:
+            outbox += part
+        full = len(outbox) >= self.flush_size
+        self.sock_lock.release()
+        if full:
+            self.flush(conn)
+
+    def close_batch(self, conn):
+        """Packs the header of the batch frame open in a connection's
+        outbox, if there is one; the caller holds sock_lock"""
+        start = self.batch_start[conn]
+        if start is None:
+            return
+        outbox = self.outbox[conn]
+        FRAME_HEADER.pack_into(outbox, start, BATCH_FRAME,
+                len(outbox) - start - FRAME_HEADER.size)
+        self.batch_start[conn] = None
+
+    @staticmethod
+    def value_frame(message_id, request_type, key, value):
+        """Returns a request with a length-prefixed value, in a VALUE_FRAME
+        of its own; message_id and key are bytes"""
+        return FRAME_HEADER.pack(VALUE_FRAME, len(message_id) + 1 +
+                len(key) + 4 + len(value)) + message_id + request_type + \
+                key + len(value).to_bytes(4, byteorder='big') + value
+
+    def flush(self, conn=None, force=True):
+        """Sends everything buffered for a server in a single write
+
+        Parameters
+        ----------
+            conn    socket  connection to flush (default: all of them)
+            force   bool    if False, only flush outboxes whose oldest
+                            request has waited at least flush_latency
+        """
+        targets = conn is None and self.connected or (conn,)
+        self.sock_lock.acquire()
+        now = monotonic()
+        for target in targets:
+            outbox = self.outbox[target]
+            if not outbox:
+                continue
+            if not force and \
+                    now - self.outbox_since[target] < self.flush_latency:
+                continue
+            self.close_batch(target)
+            if self.verbose:
+                self.show_hex(bytes(outbox), prefix="Sending: ",
+                        use_outfile=True)
+            sendmsg_all(target, [outbox])
+            del outbox[:]
         self.sock_lock.release()
 
+    def send_retries(self):
+        """Resends every message whose retry is due, with one write per
+        server for all of them"""
+        message_ids = self.retry_timers.expire()
+        if not message_ids:
+            return
+        self.pending_lock.acquire()
+        for message_id in message_ids:
+            message_obj = self.pending.get(message_id)
+            # answered or reissued since the retry was scheduled
+            if message_obj is None:
+                continue
+            for target_server in message_obj.servers:
+                self.resend(target_server, message_obj)
+        self.pending_lock.release()
+        self.flush()
+
+    def resend(self, conn, message_obj):
+        """Sends an in-flight request to one of its servers again"""
+        message_id, request_type, key, value = message_obj.args
+        if request_type in self.MULTI_REQUESTS:
+            # only the keys this server holds
+            value = value[conn]
+        message_obj.owed[conn] += 1
+        self.request(conn, message_id, request_type, key, value,
+                message_obj.stamp)
+
     def abort(self, conn, message_id):
-        """Tells the server to abort a PUT"""
+        """Tells the server to abort a PUT; with batch_decisions, the
+        abort waits for send_decisions()"""
         req_type = self.CANCEL_BYTEC
-        message_obj = self.pending[message_id]
-        key, value = message_obj['args'][2:]
+        message_obj = self.pending.get(message_id)
+        key, value = message_obj.key, message_obj.value
+        if message_obj.request_type == self.MPUT_BYTEC:
+            # the same entries the server prepared
+            req_type = self.MABORT_BYTEC
+            value = value[conn]
+        elif message_obj.request_type == self.PUTV_BYTEC:
+            # the server already has the value
+            value = self.PAD_BYTEC * 2
+        if self.batch_decisions and req_type == self.CANCEL_BYTEC:
+            self.aborts[conn].append(message_id.to_bytes(self.id_bytes,
+                    byteorder='big') + key + value)
+            return
         self.request(conn, message_id, req_type, key, value)
 
     def commit(self, conn, message_id):
-        """Tells the server to commit a PUT"""
+        """Tells the server to commit a PUT; with batch_decisions, the
+        commit waits for send_decisions()"""
         req_type = self.ACK_BYTEC
-        message_obj = self.pending[message_id]
-        key, value = message_obj['args'][2:]
+        message_obj = self.pending.get(message_id)
+        key, value = message_obj.key, message_obj.value
+        if message_obj.request_type == self.MPUT_BYTEC:
+            # the same entries the server prepared
+            req_type = self.MCOMMIT_BYTEC
+            value = value[conn]
+        elif message_obj.request_type == self.PUTV_BYTEC:
+            # the server already has the value
+            value = self.PAD_BYTEC * 2
+        if self.batch_decisions and req_type == self.ACK_BYTEC:
+            self.commits[conn].append(message_id.to_bytes(self.id_bytes,
+                    byteorder='big') + key + value)
+            return
         self.request(conn, message_id, req_type, key, value)
 
-    def get(self, conn, message_id, key):
-        """Sends a GET request
+    def send_decisions(self):
+        """Buffers one COMMIT_MANY and one ABORT_MANY for each server,
+        holding every commit and abort decided since the last call; like
+        any other request, they're sent after whatever is buffered for the
+        server already, which may hold the PUTs they decide"""
+        key = self.PAD_BYTEC * self.key_bytes
+        message_id = bytes(self.id_bytes)
+        for decisions, req_type in ((self.commits, self.COMMIT_MANY_BYTEC),
+                (self.aborts, self.ABORT_MANY_BYTEC)):
+            for conn, entries in decisions.items():
+                if not entries:
+                    continue
+                message = self.value_frame(message_id, req_type, key,
+                        b''.join(entries))
+                entries.clear()
+                self.buffer(conn, False, True, message)
+
+    def get(self, servers, message_id, key, consistency=None, command=None):
+        """Sends a GET request to as many of the key's replicas as the read
+        consistency calls for
 
         Parameters
         ----------
-            conn        socket  connection for sending
+            servers     list    connections to the key's replicas
             message_id  int     message chain ID
             key         int     key to GET
+            consistency str     one of READ_CONSISTENCY (default: the
+                                read_consistency config option)
+            command     bytes   the GET packed already, if it is (see
+                                send_command); sent as it is unless it
+                                needs another request type
         """
-        req_type = self.GET_BYTEC
-
-        key = key.to_bytes(2, byteorder='big')
-        self.request(conn, message_id, req_type, key)
+        key = key.to_bytes(self.key_bytes, byteorder='big')
+        if self.primary and self.read_your_writes and key in self.writing:
+            # the primary applies our PUTs in the order we sent them, so
+            # it's the one replica sure to have them
+            servers = servers[:1]
+        else:
+            servers = self.read_replicas(servers,
+                    consistency or self.read_consistency)
+        # only wait out a pending PUT if it might be ours
+        if self.read_your_writes and key in self.writing and \
+                not self.primary:
+            req_type = self.value_bytes and self.GETV_RYW_BYTEC or \
+                    self.GET_RYW_BYTEC
+        else:
+            req_type = self.value_bytes and self.GETV_BYTEC or \
+                    self.GET_BYTEC
+        if command is not None and req_type == self.GET_BYTEC:
+            for conn in servers:
+                self.send_command(conn, message_id, command)
+        else:
+            for conn in servers:
+                self.request(conn, message_id, req_type, key)
 
         self.pending_lock.acquire()
-        self.pending[message_id] = {
-                'args': (message_id, req_type, key),
-                'retries': 0,
-                'multiplier': None,
-                'responses': 0
-        } 
+        self.pending.add(message_id, req_type, key, self.PAD_BYTEC * 2,
+                servers)
         self.pending_lock.release()
 
-    def put(self, conn, message_id, key, value):
-        """Sends a PUT request
+    def read_replicas(self, servers, consistency):
+        """Returns the replicas a read with the given consistency is sent
+        to: the ones with the fewest unanswered requests, preferring our own
+        node's server when there's a tie"""
+        if consistency == 'all':
+            return servers
+        elif consistency == 'quorum':
+            count = len(servers) // 2 + 1
+        elif consistency == 'one':
+            count = 1
+        else:
+            raise ValueError("unknown read consistency: {}".format(
+                    consistency))
+        if count >= len(servers):
+            return servers
+        outstanding = self.outstanding
+        local = self.connected[self.node_n]
+        return sorted(servers, key=lambda conn:
+                (outstanding[conn], conn is not local))[:count]
+
+    def put(self, servers, message_id, key, value, command=None):
+        """Sends a PUT request to each of the key's replicas, or with primary
+        replication, to its primary alone
 
         Parameters
         ----------
-            conn        socket  connection for sending
+            servers     list    connections to the key's replicas
             message_id  int     message chain ID
             key         int     key to PUT
-            value       int     value to PUT
+            value       int     value to PUT; with value_bytes set, it's
+                                repeated to make a value that long
+            command     bytes   the PUT packed already, if it is (see
+                                send_command); sent as it is unless it
+                                needs another request type or a stamp
         """
         req_type = self.PUT_BYTEC
-        key = key.to_bytes(2, byteorder='big')
+        key = key.to_bytes(self.key_bytes, byteorder='big')
         value = value.to_bytes(2, byteorder='big')
-        self.request(conn, message_id, req_type, key, value)
+        if self.value_bytes:
+            req_type = self.PUTV_BYTEC
+            value = (value * (self.value_bytes // 2 + 1))[:self.value_bytes]
+        if self.primary:
+            # it passes the PUT on to the others
+            servers = servers[:1]
+        stamp = None
+        if self.stamped and req_type == self.PUT_BYTEC:
+            # a new transaction starts now
+            stamp = STAMP.pack(int(time() * 1e6) & 0xFFFFFFFF, self.node_n)
+        if command is not None and req_type == self.PUT_BYTEC and \
+                stamp is None:
+            for conn in servers:
+                self.send_command(conn, message_id, command)
+        else:
+            for conn in servers:
+                self.request(conn, message_id, req_type, key, value, stamp)
         
         self.pending_lock.acquire()
-        self.pending[message_id] = {
-                'args': (message_id, req_type, key, value),
-                'retries': 0,
-                'multiplier': None,
-                'responses': 0
-        } 
+        self.pending.add(message_id, req_type, key, value,
+                servers).stamp = stamp
+        self.writing[key] = self.writing.get(key, 0) + 1
+        self.pending_lock.release()
+
+    def mget(self, message_id, keys, consistency=None):
+        """Sends one MGET to each server holding some of the keys, for as
+        many replicas of each key as the read consistency calls for
+
+        Parameters
+        ----------
+            message_id  int     message chain ID
+            keys        list    keys to GET
+            consistency str     one of READ_CONSISTENCY (default: the
+                                read_consistency config option)
+        """
+        consistency = consistency or self.read_consistency
+        connected = self.connected
+        entries = dict()
+        for key in sorted(set(keys)):
+            servers = [connected[index] for index in
+                    self.placement.replicas(key)]
+            for conn in self.read_replicas(servers, consistency):
+                entries.setdefault(conn, []).append(
+                        self.wire.entry.pack(key, 0))
+        self.send_multi(message_id, self.MGET_BYTEC, entries)
+        # newest (value, version) of each key so far
+        self.pending.get(message_id).result = dict()
+
+    def mput(self, message_id, values):
+        """Sends one MPUT to each server holding some of the keys; they're
+        committed or aborted together
+
+        Parameters
+        ----------
+            message_id  int     message chain ID
+            values      dict    value to PUT for each key
+        """
+        connected = self.connected
+        entries = dict()
+        for key in sorted(values):
+            for index in self.placement.replicas(key):
+                entries.setdefault(connected[index], []).append(
+                        self.wire.entry.pack(key, values[key]))
+            key = key.to_bytes(self.key_bytes, byteorder='big')
+            self.writing[key] = self.writing.get(key, 0) + 1
+        self.send_multi(message_id, self.MPUT_BYTEC, entries)
+
+    def send_multi(self, message_id, request_type, entries):
+        """Sends a multi-key request, given the entries for each server,
+        and records it as pending"""
+        entries = dict((conn, b''.join(conn_entries))
+                for conn, conn_entries in entries.items())
+        key = self.PAD_BYTEC * self.key_bytes
+        for conn, conn_entries in entries.items():
+            self.request(conn, message_id, request_type, key, conn_entries)
+        self.pending_lock.acquire()
+        self.pending.add(message_id, request_type, key, entries,
+                list(entries))
         self.pending_lock.release()
 
+    def multi_entries(self, message_obj):
+        """Returns the value of each key of a multi-key request"""
+        return dict(entry for conn_entries in message_obj.value.values()
+                for entry in self.wire.entry.iter_unpack(conn_entries))
+
+    def finish(self, message_obj):
+        """Records how long a request took, then forgets it; the caller
+        holds pending_lock"""
+        self.latencies[self.LATENCY_KINDS[message_obj.request_type]].append(
+                monotonic() - message_obj.sent)
+        self.clear(message_obj)
+
+    def clear(self, message_obj):
+        """Forgets a request; the caller holds pending_lock
+
+        Servers don't answer every request they're sent, e.g. a PUT that
+        was waiting for its key when it was aborted, so whatever is still
+        unanswered stops counting towards each server's outstanding
+        requests once we stop waiting for it."""
+        outstanding = self.outstanding
+        for conn, owed in message_obj.owed.items():
+            outstanding[conn] -= owed
+        self.pending.remove(message_obj)
+
+    def write_stats(self, run_time):
+        """Writes our run time, retry and abort counts and every request's
+        latency (in microseconds) to <hostname>_client.json, next to our
+        output file"""
+        stats = {
+            'node': self.hostname,
+            'commands': len(self.workload),
+            'run_time': run_time,
+            'retries': self.num_retries,
+            'aborts': self.num_aborts,
+            'late': self.num_late,
+            'latency': dict((kind, [round(latency * 1e6) for latency in
+                    latencies]) for kind, latencies in self.latencies.items())
+        }
+        filename = os.path.join(os.getenv("OUTPUT_DIR"),
+                self.hostname + "_client.json")
+        # whoever is waiting for the file never sees half of it
+        with open(filename + '.tmp', 'w') as fh:
+            json.dump(stats, fh)
+        os.replace(filename + '.tmp', filename)
+
+    def done_writing(self, key):
+        """Notes that one of our PUTs of key has been committed; the caller
+        holds pending_lock"""
+        count = self.writing.pop(key) - 1
+        if count:
+            self.writing[key] = count
+
     def retry(self, message_id):
         """Waits an exponentially-increasing amount of time, then
         re-attempts a message. The exact rate of exponential increase is
         random."""
-        message_obj = self.pending[message_id]
+        message_obj = self.pending.get(message_id)
         # how many times have we tried already?
-        num_retries = message_obj['retries']
-        multiplier = message_obj['multiplier']
+        num_retries = message_obj.retries
+        multiplier = message_obj.multiplier
 
         # reset if we already tried 10 times
         if num_retries >= 3:
@@ -498,18 +1122,16 @@ class Client(Process):
         # assign a random rate of exponential increase
         if num_retries == 0:
             multiplier = random() * 2
-            message_obj['multiplier'] = multiplier
+            message_obj.multiplier = multiplier
 
-        message_obj['retries'] += 1
+        message_obj.retries += 1
+        self.num_retries += 1
         if self.verbose:
-            self.outfile.write(str(message_obj['retries']) + " retries ")
+            self.outfile.write(str(message_obj.retries) + " retries ")
             self.outfile.write("for " + str(message_id) + "\n")
         # how long should we wait?
         interval = exp(-5 + num_retries * multiplier)
-        for target_server in self.connected:
-            args = (target_server,) + message_obj["args"]
-            timer = Timer(interval, self.request, args=args)
-            timer.start()
+        self.retry_timers.schedule(interval, message_id)
 
     def show_hex(self, data, prefix='', suffix='', use_outfile=False):
         """For debugging socket messages"""
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# Usage: ./cluster_stats.py [-i seconds] [-c count] [--json] [host ...]
+# Asks every node in config/ips (or just the given hosts) for a STATS
+# snapshot every interval seconds, and prints each node's request rate,
+# pending PUTs, keys, worker queue depths and stage latencies over the last
+# interval, then the same for the whole cluster. Nodes take these
+# connections on stats_port, apart from their clients'.
+#
+# Latencies are only recorded by servers with `stats True`; the rest
+# report their uptime, request count and queue depths alone, and
+# server_mode asyncio nodes have no queues to report.
+
+import json
+import socket
+from argparse import ArgumentParser
+from sys import exit, stderr
+from time import sleep
+from protocol import WireFormat, FrameReader, frame
+from stats import COUNTERS, REQUESTS, PENDING, KEYS, STAGES, NUM_BUCKETS, \
+        summarize, unpack_snapshot
+
+IP_CONFIG = '../config/ips'
+CONFIG = '../config/config.txt'
+
+STATS_BYTEC = b'\x11'
+VALUE_BYTEC = b'\x07'
+
+class Node:
+    """A connection to one server, for asking it for STATS"""
+    def __init__(self, host, port, wire, framing, timeout):
+        self.host = host
+        self.wire = wire
+        self.framing = framing
+        self.conn = socket.create_connection((host, port), timeout)
+        self.reader = FrameReader()
+        self.message_id = 0
+        # the last snapshot, to take differences from
+        self.last = None
+
+    def poll(self):
+        """Returns a new snapshot"""
+        self.message_id = (self.message_id + 1) % \
+                2 ** (8 * self.wire.id_bytes)
+        request = self.wire.request.pack(self.message_id, STATS_BYTEC, 0, 0)
+        if self.framing:
+            request = frame(request)
+        self.conn.sendall(request)
+        while True:
+            if not self.reader.recv_from(self.conn):
+                raise ConnectionError("{} closed the connection".format(
+                        self.host))
+            for message_id, response_type, value, version in \
+                    self.reader.responses(self.wire, VALUE_BYTEC):
+                if message_id == self.message_id and \
+                        response_type == VALUE_BYTEC:
+                    return unpack_snapshot(bytes(value))
+
+def difference(snapshot, last):
+    """Returns snapshot's counters and histograms less last's, and the
+    seconds between them; gauges are kept as they are"""
+    if last is None:
+        return snapshot['counters'], snapshot['histograms'], \
+                snapshot['uptime']
+    counters = [now - before for now, before in zip(snapshot['counters'],
+            last['counters'])]
+    counters[PENDING] = snapshot['counters'][PENDING]
+    counters[KEYS] = snapshot['counters'][KEYS]
+    histograms = [[now - before for now, before in zip(histogram, previous)]
+            for histogram, previous in zip(snapshot['histograms'],
+            last['histograms'])]
+    return counters, histograms, snapshot['uptime'] - last['uptime']
+
+def report(counters, histograms, seconds, depths, enabled):
+    """Returns one node's (or the cluster's) results as a dict"""
+    result = summarize(counters, histograms)
+    result['enabled'] = enabled
+    result['requests_per_s'] = seconds and counters[REQUESTS] / seconds
+    result['request_queue'] = sum(depth[0] for depth in depths)
+    result['response_queue'] = sum(depth[1] for depth in depths)
+    return result
+
+def show(name, result):
+    """Prints a result as a few lines of text"""
+    counters = result['counters']
+    print("{}: {:.0f} requests/s, {} pending, {} keys, queued {} requests, "
+            "{} responses, {} cancels, {} empties".format(name,
+            result['requests_per_s'], counters['pending'], counters['keys'],
+            result['request_queue'], result['response_queue'],
+            counters['cancels'], counters['empties']))
+    if not result['enabled']:
+        print("  (not recording stats)")
+    for stage, latency in result['stages_us'].items():
+        print("  {:<15} p50 {:>6} p99 {:>6} p99.9 {:>6} max {:>6} "
+                "(n={})".format(stage, latency['p50'], latency['p99'],
+                latency['p99.9'], latency['max'], latency['count']))
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Prints live stats of every node")
+    parser.add_argument('-i', '--interval', type=float, default=1,
+            help="seconds between polls (default 1)")
+    parser.add_argument('-c', '--count', type=int, default=1,
+            help="reports to print; 0 keeps going (default 1)")
+    parser.add_argument('--json', action='store_true',
+            help="print each report as JSON")
+    parser.add_argument('--timeout', type=float, default=5,
+            help="seconds to wait for a node")
+    parser.add_argument('-p', '--port', type=int,
+            help="port the nodes take STATS on (default: config.txt's "
+            "stats_port)")
+    parser.add_argument('hosts', nargs='*',
+            help="nodes to ask (default: every host in config/ips)")
+    args = parser.parse_args()
+
+    with open(CONFIG) as fh:
+        options = dict([line.strip().split() for line in fh])
+    hosts = args.hosts
+    if not hosts:
+        with open(IP_CONFIG) as fh:
+            hosts = [line.strip().split()[0] for line in fh if line.strip()]
+    wire = WireFormat.from_config(options)
+    framing = options['framing'].upper()[0] == 'T'
+    try:
+        port = args.port or int(options['stats_port'])
+        nodes = [Node(host, port, wire, framing, args.timeout)
+                for host in hosts]
+    except OSError as e:
+        print("can't connect: {}".format(e), file=stderr)
+        exit(1)
+    for node in nodes:
+        node.last = node.poll()
+
+    reports = 0
+    while not args.count or reports < args.count:
+        sleep(args.interval)
+        results = dict()
+        total_counters = [0] * len(COUNTERS)
+        total_histograms = [[0] * NUM_BUCKETS for stage in STAGES]
+        total_depths = []
+        seconds = 0
+        enabled = True
+        for node in nodes:
+            snapshot = node.poll()
+            counters, histograms, elapsed = difference(snapshot, node.last)
+            node.last = snapshot
+            results[node.host] = report(counters, histograms, elapsed,
+                    snapshot['depths'], snapshot['enabled'])
+            total_counters = [total + count for total, count in
+                    zip(total_counters, counters)]
+            total_histograms = [[total + count for total, count in
+                    zip(totals, histogram)] for totals, histogram in
+                    zip(total_histograms, histograms)]
+            total_depths.extend(snapshot['depths'])
+            # the nodes are polled one after another; close enough
+            seconds = max(seconds, elapsed)
+            enabled = enabled and snapshot['enabled']
+        results['cluster'] = report(total_counters, total_histograms,
+                seconds, total_depths, enabled)
+        reports += 1
+        if args.json:
+            print(json.dumps(results), flush=True)
+            continue
+        for name, result in results.items():
+            show(name, result)
+        print(flush=True)
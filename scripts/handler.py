@@ -0,0 +1,345 @@
+from collections import deque
+from time import monotonic
+
+# a table slot holds a key's value in its low 32 bits, and the number of
+# times the key has been committed (its version) in the high 32 bits; one
+# word, so no reader ever sees a value with another commit's version
+VERSION_SHIFT = 32
+VALUE_MASK = (1 << VERSION_SHIFT) - 1
+
+def pack_version(version, value):
+    """Returns the table word for a value and its version"""
+    return (version & VALUE_MASK) << VERSION_SHIFT | value & VALUE_MASK
+
+# a transaction stamp is its start time << 16 | its node index (see
+# protocol.STAMP); start times wrap at 2 ** 32
+NODE_BITS = 16
+NODE_MASK = (1 << NODE_BITS) - 1
+TIME_MASK = (1 << 32) - 1
+
+def older(stamp, other):
+    """Returns whether the transaction with one stamp started before the
+    one with the other; start times are compared modulo 2 ** 32, so they
+    may wrap as long as no transaction lives for half of that, and equal
+    ones are ordered by node index"""
+    elapsed = ((other >> NODE_BITS) - (stamp >> NODE_BITS)) & TIME_MASK
+    if not elapsed:
+        return stamp & NODE_MASK < other & NODE_MASK
+    return elapsed < 1 << 31
+
+class Waiter:
+    """A PUT waiting for another PUT of its key to commit or abort"""
+    __slots__ = ('message_id', 'key', 'stamp', 'reply_to', 'deadline',
+            'waiting')
+
+    def __init__(self, message_id, key, stamp, reply_to, deadline):
+        self.message_id = message_id
+        self.key = key
+        # its transaction's stamp, which orders it against other PUTs
+        self.stamp = stamp
+        # whatever the caller needs to route the late answer
+        self.reply_to = reply_to
+        self.deadline = deadline
+        # cleared once it's been granted or refused
+        self.waiting = True
+
+class PendingSet(dict):
+    """Private pending indicators for sparse keys; reads like the pending
+    bytearray, but clearing a key removes it"""
+    def __missing__(self, key):
+        return 0
+
+    def __setitem__(self, key, value):
+        if value:
+            dict.__setitem__(self, key, value)
+        else:
+            self.pop(key, None)
+
+class RequestHandler:
+    """Applies GET/PUT/GETV/PUTV/ACK/CANCEL requests to a shared memory
+    table.
+
+    GETs are answered with the last committed value and its version, even
+    while a PUT of the key is pending; only the read-your-writes GETs
+    (GET_RYW/GETV_RYW) are told to come back later, for clients that
+    need to see a PUT of their own that may not have been committed yet.
+
+    Holds no connection state, so the same handler logic can be driven by
+    a Worker process reading from a queue or by an event loop reading
+    straight from a socket.
+
+    With max_wait set, a PUT of a pending key isn't refused straight away:
+    if its transaction is older (has an earlier stamp, which its retries
+    keep) than the PUT holding the key, it waits up to max_wait seconds
+    for the key, and younger ones are refused (wait-die). Waits therefore
+    always point from older to younger transactions, so replicas can't
+    deadlock on each other, and the youngest waiter is granted the key
+    first, so that every PUT still waiting is older than the new holder.
+    PUTVs and MPUT keys never wait. Answers to PUTs that waited are
+    collected in `woken` as (message_id, reply_to, response).
+
+    With primary replication, a key's primary commits PUTs as soon as it
+    gets them (WRITE), and its other replicas apply the table words the
+    primary pushes to them (REPLICATE)."""
+    # request types
+    GET_BYTEC    = b'\x00'
+    PUT_BYTEC    = b'\x01'
+    END_BYTEC    = b'\x02'
+    GETV_BYTEC   = b'\x03'
+    PUTV_BYTEC   = b'\x04'
+    GET_RYW_BYTEC  = b'\x05'
+    GETV_RYW_BYTEC = b'\x08'
+    # one key of an MPUT; prepared like a PUT, but never waits, so that
+    # a worker answers an MPUT's keys in the order it got them
+    MPUT_BYTEC     = b'\x0a'
+    # a write pushed by the key's primary; its value is the table word
+    REPLICATE_BYTEC = b'\x0d'
+    # a PUT received by the key's primary, which orders the key's writes
+    # itself, so it's committed at once instead of prepared
+    WRITE_BYTEC    = b'\x0e'
+
+    # response types
+    EMPTY_BYTEC  = b'\x00'
+    ACK_BYTEC    = b'\x06'
+    VALUE_BYTEC  = b'\x07'
+    CANCEL_BYTEC = b'\x18'
+
+    def __init__(self, table, pending, pending_lock=None, blobs=None,
+            slab=None, retire=None, wal=None, max_wait=0):
+        # type: multiprocessing.sharedctypes.Array or ShmHashTable
+        self.table = table
+        # keeps track of which keys are pending 2-phase-commit
+        self.pending = pending
+        # guards the check-and-set on pending; None if pending is private
+        self.pending_lock = pending_lock
+        # ShmHashTable mapping keys to slab references of their
+        # variable-length values, and the SlabAllocator holding them
+        self.blobs = blobs
+        self.slab = slab
+        # called instead of slab.free for replaced values, which may still
+        # be on their way to a client; None frees them at once
+        self.retire = retire or (slab is not None and slab.free)
+        # slab references of PUTV values waiting for their commit
+        self.staged = dict()
+        # WriteAheadLog that commits are recorded in; None if the table
+        # isn't durable
+        self.wal = wal
+        # how long a PUT may wait for a pending key; 0 refuses it at once
+        self.max_wait = max_wait
+        # (message ID, reply_to, stamp) of the PUT holding each pending
+        # key, so that only its own abort releases the key, and the
+        # Waiters for it, oldest (earliest stamp) first
+        self.holders = dict()
+        self.waiters = dict()
+        # every Waiter, in the order their deadlines run out
+        self.deadlines = deque()
+        # answers to PUTs that waited, for the caller to send
+        self.woken = []
+        # how many keys are pending, and how many have ever been
+        # written; counted as they change, for STATS. The caller sets
+        # num_keys first if the table already holds keys.
+        self.num_pending = 0
+        self.num_keys = 0
+
+    def handle(self, request_type, key, value, message_id=0, reply_to=None):
+        """Applies a single parsed request to the table
+
+        Returns a (response_type, value, version) tuple, or None if the
+        request does not expect a response or is waiting for its key"""
+        if request_type == self.GET_BYTEC:
+            # the last committed value, pending PUT or not
+            word = self.table[key]
+            return self.ACK_BYTEC, word & VALUE_MASK, word >> VERSION_SHIFT
+        elif request_type == self.PUT_BYTEC:
+            # with max_wait, the value is the PUT's stamp << 16 | value;
+            # only the commit's value is written. Stamp 0 is an unstamped
+            # PUT, which never waits
+            stamp = None
+            if self.max_wait:
+                stamp = value >> NODE_BITS or None
+            return self.prepare(key, message_id, reply_to, stamp)
+        elif request_type == self.MPUT_BYTEC:
+            return self.prepare(key, message_id, reply_to)
+        elif request_type == self.WRITE_BYTEC:
+            word = self.table[key]
+            if not word:
+                self.num_keys += 1
+            version = (word >> VERSION_SHIFT) + 1
+            word = pack_version(version, value)
+            self.table[key] = word
+            if self.wal is not None:
+                self.wal.log_put(key, word)
+            # the caller pushes the new value and version to the replicas
+            return self.ACK_BYTEC, value, version
+        elif request_type == self.REPLICATE_BYTEC:
+            # keep whichever word is newer, so applying one twice is
+            # harmless
+            word = self.table[key]
+            if value >> VERSION_SHIFT > word >> VERSION_SHIFT:
+                if not word:
+                    self.num_keys += 1
+                self.table[key] = value
+                if self.wal is not None:
+                    self.wal.log_put(key, value)
+            return self.ACK_BYTEC, 0, 0
+        elif request_type == self.GETV_BYTEC:
+            # respond with the value's slab reference; 0 means no value.
+            # A pending PUTV's value is staged elsewhere until it commits.
+            version = self.table[key] >> VERSION_SHIFT
+            if self.blobs is None:
+                return self.VALUE_BYTEC, 0, version
+            return self.VALUE_BYTEC, self.blobs[key], version
+        elif request_type in (self.GET_RYW_BYTEC, self.GETV_RYW_BYTEC):
+            # is there a PUT pending for this key?
+            if self.pending[key]:
+                # let client know the location is locked
+                return self.EMPTY_BYTEC, 0, 0
+            if request_type == self.GET_RYW_BYTEC:
+                return self.handle(self.GET_BYTEC, key, value)
+            return self.handle(self.GETV_BYTEC, key, value)
+        elif request_type == self.PUTV_BYTEC:
+            # value is the slab reference the value was stored at, or 0 if
+            # there was no room for it
+            if not value:
+                return self.CANCEL_BYTEC, 0, 0
+            response = self.prepare(key, message_id, reply_to)
+            if response[0] == self.ACK_BYTEC:
+                self.staged[key] = value
+            else:
+                self.slab.free(value)
+            return response
+        # need commit message before we can PUT value
+        elif request_type == self.ACK_BYTEC:
+            word = self.table[key]
+            if not word:
+                self.num_keys += 1
+            version = (word >> VERSION_SHIFT) + 1
+            if key in self.staged:
+                # swap in the new value, then free the old one
+                old_ref = self.blobs[key]
+                ref = self.staged.pop(key)
+                self.blobs[key] = ref
+                if old_ref:
+                    self.retire(old_ref)
+                # the table only keeps the key's version
+                word = pack_version(version, word)
+                if self.wal is not None:
+                    self.wal.log_value(key, self.slab.view(ref))
+            else:
+                word = pack_version(version, value)
+            self.table[key] = word
+            if self.wal is not None:
+                self.wal.log_put(key, word)
+            self.release(key)
+        elif request_type == self.CANCEL_BYTEC:
+            holder = self.holders.get(key)
+            if holder is None or holder[0] != message_id or \
+                    holder[1] != reply_to:
+                # an abort of a PUT that's still waiting, or that we
+                # refused (clients abort on every replica); the key isn't
+                # its to release
+                self.forget(key, message_id, reply_to)
+                return None
+            if key in self.staged:
+                self.slab.free(self.staged.pop(key))
+            self.release(key)
+        elif request_type == self.END_BYTEC:
+            print("Workers aren't supposed to receive ENDs")
+        else:
+            print("Got bad request")
+        return None
+
+    def prepare(self, key, message_id=0, reply_to=None, stamp=None):
+        """Marks key as pending, unless a PUT is already pending for it;
+        then, the PUT either waits for the key (if it has a stamp and its
+        transaction is older than the holder's) or is refused"""
+        # is there already a pending PUT?
+        lock = self.pending_lock
+        if lock is not None:
+            lock.acquire()
+        if self.pending[key]:
+            if lock is not None:
+                lock.release()
+            holder = self.holders.get(key)
+            if stamp is not None and holder is not None and \
+                    holder[2] is not None and older(stamp, holder[2]):
+                self.wait(Waiter(message_id, key, stamp, reply_to,
+                        monotonic() + self.max_wait))
+                return None
+            return self.CANCEL_BYTEC, 0, 0
+        # mark it as pending
+        self.pending[key] = 1
+        if lock is not None:
+            lock.release()
+        self.num_pending += 1
+        self.holders[key] = message_id, reply_to, stamp
+        return self.ACK_BYTEC, 0, 0
+
+    def wait(self, waiter):
+        """Queues a PUT for its key, keeping the oldest first"""
+        waiters = self.waiters.setdefault(waiter.key, [])
+        index = len(waiters)
+        while index and older(waiter.stamp, waiters[index - 1].stamp):
+            index -= 1
+        waiters.insert(index, waiter)
+        self.deadlines.append(waiter)
+
+    def release(self, key):
+        """Clears key's pending mark, and hands the key to the youngest PUT
+        waiting for it"""
+        if self.pending[key]:
+            self.num_pending -= 1
+        self.pending[key] = 0
+        self.holders.pop(key, None)
+        waiters = self.waiters.get(key)
+        if not waiters:
+            return
+        waiter = waiters.pop()
+        if not waiters:
+            del self.waiters[key]
+        waiter.waiting = False
+        self.pending[key] = 1
+        self.num_pending += 1
+        self.holders[key] = waiter.message_id, waiter.reply_to, waiter.stamp
+        self.woken.append((waiter.message_id, waiter.reply_to,
+                (self.ACK_BYTEC, 0, 0)))
+
+    def forget(self, key, message_id, reply_to):
+        """Drops the PUT waiting for key with this message ID, if any"""
+        for waiter in self.waiters.get(key, ()):
+            if waiter.message_id == message_id and \
+                    waiter.reply_to == reply_to:
+                break
+        else:
+            return
+        waiter.waiting = False
+        self.waiters[key].remove(waiter)
+        if not self.waiters[key]:
+            del self.waiters[key]
+
+    def wait_timeout(self):
+        """Returns how long until the next wait runs out, or None if
+        nothing's waiting"""
+        deadlines = self.deadlines
+        while deadlines and not deadlines[0].waiting:
+            deadlines.popleft()
+        if not deadlines:
+            return None
+        return max(0, deadlines[0].deadline - monotonic())
+
+    def expire(self):
+        """Refuses every PUT that has waited max_wait seconds"""
+        deadlines = self.deadlines
+        now = monotonic()
+        while deadlines and (not deadlines[0].waiting or
+                deadlines[0].deadline <= now):
+            waiter = deadlines.popleft()
+            if not waiter.waiting:
+                continue
+            waiter.waiting = False
+            waiters = self.waiters[waiter.key]
+            waiters.remove(waiter)
+            if not waiters:
+                del self.waiters[waiter.key]
+            self.woken.append((waiter.message_id, waiter.reply_to,
+                    (self.CANCEL_BYTEC, 0, 0)))
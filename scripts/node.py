@@ -5,6 +5,7 @@ from multiprocessing import Pool
 # custom
 from client import Client
 from server import Server
+from async_server import AsyncServer
 
 # static config options
 IP_CONFIG = '../config/ips'
@@ -40,7 +41,12 @@ SERVER_BACKLOG_SIZE = int(options['backlog'])
 print("Starting server")
 # connect by hostname, not IP
 CLIENTS = list(zip(*host_list))[0]
-server = Server(CLIENTS, SERVER_HOST, options)
+# 'select' uses Worker processes; 'asyncio' uses one event loop per process
+# (server_threads of them), which share only the shared-memory table
+if options['server_mode'] == 'asyncio':
+    server = AsyncServer(CLIENTS, SERVER_HOST, options)
+else:
+    server = Server(CLIENTS, SERVER_HOST, options)
 server.start()
 print("Server thread started")
 
@@ -0,0 +1,106 @@
+"""Fixed-size table of a client's in-flight requests
+
+Records are preallocated __slots__ objects, one per slot, and a message ID
+picks its slot directly, so recording, finding and clearing a request
+allocate nothing. The table also hands out the message IDs, skipping any
+whose slot is still taken by a request that's been retrying for a while,
+so two in-flight requests never share a slot."""
+from time import monotonic
+
+class PendingRequest:
+    """One in-flight request, and what we know about its responses"""
+    __slots__ = ('message_id', 'request_type', 'key', 'value', 'servers',
+            'retries', 'multiplier', 'responses', 'busy', 'version',
+            'result', 'sent', 'stamp', 'owed', 'in_use')
+
+    def __init__(self):
+        self.in_use = False
+
+    @property
+    def args(self):
+        """The request's (message_id, request_type, key, value)"""
+        return self.message_id, self.request_type, self.key, self.value
+
+class PendingTable:
+    """Maps message IDs to PendingRequests
+
+    Our message IDs are first_id, first_id + step, first_id + 2 * step, ...
+    (each node gets its own IDs this way), so the slot of an ID is
+    (message_id // step) % capacity."""
+    def __init__(self, capacity, first_id=0, step=1, max_id=2 ** 16):
+        # a power of two, so the slot can be masked out
+        capacity = 1 << max(0, (capacity - 1).bit_length())
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.records = [PendingRequest() for i in range(capacity)]
+        self.first_id = first_id
+        self.step = step
+        # IDs wrap before they outgrow the wire format
+        self.max_seq = (max_id - first_id - 1) // step + 1
+        self.next_seq = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, message_id):
+        return self.get(message_id) is not None
+
+    def __iter__(self):
+        """Yields every in-flight request"""
+        for record in self.records:
+            if record.in_use:
+                yield record
+
+    def new_id(self):
+        """Returns the next message ID whose slot is free"""
+        if self.size >= self.capacity:
+            raise OverflowError("more requests in flight than the table holds")
+        records = self.records
+        mask = self.mask
+        while True:
+            seq = self.next_seq
+            self.next_seq = (seq + 1) % self.max_seq
+            if not records[seq & mask].in_use:
+                return self.first_id + seq * self.step
+
+    def add(self, message_id, request_type, key, value, servers):
+        """Records a request sent with an ID from new_id()"""
+        record = self.records[(message_id // self.step) & self.mask]
+        record.message_id = message_id
+        record.request_type = request_type
+        record.key = key
+        record.value = value
+        record.servers = servers
+        record.retries = 0
+        record.multiplier = None
+        record.responses = 0
+        # for reads: whether a replica said a PUT was pending, and the
+        # newest version (and its value) any replica answered with
+        record.busy = False
+        record.version = -1
+        record.result = None
+        # when it was first sent, for its latency
+        record.sent = monotonic()
+        # a PUT's transaction stamp (protocol.STAMP) with max_wait set,
+        # which its retries keep
+        record.stamp = None
+        # how many of the times it was sent to each server are still
+        # unanswered
+        record.owed = dict.fromkeys(servers, 1)
+        record.in_use = True
+        self.size += 1
+        return record
+
+    def get(self, message_id):
+        """Returns the in-flight request with this ID, or None"""
+        record = self.records[(message_id // self.step) & self.mask]
+        if record.in_use and record.message_id == message_id:
+            return record
+        return None
+
+    def remove(self, record):
+        record.in_use = False
+        # don't keep the connections or the value alive
+        record.servers = record.value = record.result = record.owed = None
+        self.size -= 1
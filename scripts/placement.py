@@ -0,0 +1,32 @@
+from functools import lru_cache
+
+MASK_64 = 2 ** 64 - 1
+
+def mix64(x):
+    """splitmix64 finalizer; a cheap, well-distributed 64-bit hash that
+    (unlike hash()) gives the same answer in every process"""
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9 & MASK_64
+    x = (x ^ (x >> 27)) * 0x94d049bb133111eb & MASK_64
+    return x ^ (x >> 31)
+
+class Placement:
+    """Decides which servers store a key, using rendezvous (highest random
+    weight) hashing: every server gets a pseudo-random weight for the key,
+    and the replication_factor heaviest servers hold it. Adding a server
+    only moves the keys that the new server wins."""
+    def __init__(self, num_servers, replication_factor):
+        self.num_servers = num_servers
+        # can't keep more copies than there are servers
+        self.replication_factor = min(replication_factor, num_servers)
+        # per-server salts, so servers don't all weigh a key the same way
+        self.salts = [mix64(server + 1) for server in range(num_servers)]
+        self.replicas = lru_cache(maxsize=2 ** 16)(self.replicas)
+
+    def replicas(self, key):
+        """Returns the indices of the servers responsible for key, most
+        preferred first"""
+        weights = [(mix64(key ^ salt), server)
+                for server, salt in enumerate(self.salts)]
+        weights.sort(reverse=True)
+        return tuple(server for weight, server in
+                weights[:self.replication_factor])
@@ -0,0 +1,302 @@
+"""Wire formats shared by the client and the servers
+
+A request is a 7-byte record: message ID, request type, key and value.
+A response is a 9-byte record: message ID, response type, value and the
+value's version (how many times its key has been committed).
+With key_bytes set to 8, keys are 64-bit and requests are 13 bytes, and
+id_bytes widens message IDs the same way (to 4 or 8 bytes), for clients
+with enough requests in flight that 16-bit IDs would wrap too soon.
+
+In framed mode (config option `framing`), requests travel inside frames:
+a 5-byte header holding the frame kind and payload length, followed by
+the payload. A BATCH_FRAME payload is any number of request records.
+
+Variable-length values (GETV/PUTV) only travel in framed mode, inside a
+VALUE_FRAME: each request is a message ID, request type, key and 4-byte
+value length, followed by the value itself. A GETV is answered with a
+VALUE response: a message ID, response type, version and value length,
+followed by the value.
+
+Multi-key requests (MGET, MPUT and the MCOMMIT/MABORT that end an MPUT)
+travel in VALUE_FRAMEs too, laid out like a PUTV whose value is a list
+of (key, value) entries in ascending key order. An MGET is answered with
+a VALUE response holding a (value, version) entry for each key, in the
+same order, and an MPUT with a single ACK or CANCEL for all of its keys.
+
+With primary replication, servers talk to each other too: a key's
+primary pushes every write it commits to the key's other replicas as a
+REPLICATE request in a VALUE_FRAME, whose value is the key's 8-byte
+table word (version and value), and each replica answers with an ACK.
+
+With max_wait set, PUTs travel in VALUE_FRAMEs too, with their
+transaction's STAMP in front of their value, so that servers can tell
+which of two conflicting PUTs is older. A PUT sent in a BATCH_FRAME
+anyway has no stamp, and never waits. However their requests are framed,
+a client sends them to each server in the order it made them: a server
+takes the abort of a PUT it hasn't seen yet as a no-op, and the PUT
+would then hold its key for good.
+
+COMMIT_MANY and ABORT_MANY carry the decisions for many 2PC PUTs at
+once, in a VALUE_FRAME laid out like a PUTV whose value is a list of
+(message ID, key, value) entries, one for each PUT; they get no
+response, just like the commits and aborts they stand for."""
+import os
+import struct
+
+# message_id, request_type, key, value
+REQUEST = struct.Struct('>HcHH')
+# message_id, response_type, value, version
+RESPONSE = struct.Struct('>HcHI')
+
+# message_id, response_type, version, value_length; followed by the value
+VALUE_RESPONSE = struct.Struct('>HcII')
+
+# message_id, request_type, key, value, conn_fileno; a request on its way
+# from the dispatcher to the Worker that owns its key. The value is wide
+# enough to carry a slab reference for PUTV.
+ROUTED = struct.Struct('>HcHQH')
+
+# message_id, response_type, value, version, conn_fileno; a response on its
+# way from a Worker back to the dispatcher. The value is wide enough to
+# carry the slab reference of a GETV's value.
+ROUTED_RESPONSE = struct.Struct('>HcQIH')
+
+# value, version; one key's answer to an MGET
+MULTI_RESULT = struct.Struct('>HI')
+
+# version << 32 | value; the value of a REPLICATE request
+TABLE_WORD = struct.Struct('>Q')
+
+# start time (microseconds, wrapping at 2 ** 32) and node index of the
+# transaction a PUT belongs to, which every retry of the PUT keeps. With
+# max_wait set, a PUT travels in a VALUE_FRAME whose value is its stamp
+# followed by its 2-byte value, which servers read as one '>Q'
+# (stamp << 16 | value).
+STAMP = struct.Struct('>IH')
+
+# integer formats for each supported field width
+WIDTHS = {2: 'H', 4: 'I', 8: 'Q'}
+
+class WireFormat:
+    """Record layouts for one protocol configuration"""
+    def __init__(self, key_bytes=2, id_bytes=2):
+        key = WIDTHS[key_bytes]
+        message_id = WIDTHS[id_bytes]
+        self.key_bytes = key_bytes
+        self.id_bytes = id_bytes
+        self.request = struct.Struct('>{}c{}H'.format(message_id, key))
+        # request_type, key, value; a request but for its message ID, as
+        # workloads and traces hold them
+        self.command = struct.Struct('>c{}H'.format(key))
+        self.response = struct.Struct('>{}cHI'.format(message_id))
+        self.value_request = struct.Struct('>{}c{}I'.format(message_id, key))
+        self.value_response = struct.Struct('>{}cII'.format(message_id))
+        self.routed = struct.Struct('>{}c{}QH'.format(message_id, key))
+        self.routed_response = struct.Struct('>{}cQIH'.format(message_id))
+        # key, value; one key of a multi-key request
+        self.entry = struct.Struct('>{}H'.format(key))
+        # message_id, key, value; one PUT of a COMMIT_MANY/ABORT_MANY
+        self.decision = struct.Struct('>{}{}H'.format(message_id, key))
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(int(config['key_bytes']), int(config['id_bytes']))
+
+    def value_requests(self, payload):
+        """Yields (message_id, request_type, key, value) for every request
+        in a VALUE_FRAME payload; each value is a view into the payload"""
+        header = self.value_request
+        offset = 0
+        while offset < len(payload):
+            message_id, request_type, key, length = header.unpack_from(
+                    payload, offset)
+            offset += header.size
+            value = payload[offset:offset + length]
+            offset += length
+            yield message_id, request_type, key, value
+
+# frame_kind, payload_length
+FRAME_HEADER = struct.Struct('>BI')
+
+# frame kinds
+BATCH_FRAME = 0
+VALUE_FRAME = 1
+
+def frame(payload, kind=BATCH_FRAME):
+    """Returns payload prefixed with a frame header"""
+    return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+# the most buffers one sendmsg() call takes
+IOV_MAX = os.sysconf('SC_IOV_MAX')
+
+def sendmsg_all(conn, buffers):
+    """Like sendall(), but gathers several buffers into each sendmsg() call
+    instead of joining them first"""
+    buffers = [memoryview(buffer).cast('B') for buffer in buffers]
+    while buffers:
+        sendmsg_some(conn, buffers)
+
+def sendmsg_some(conn, buffers):
+    """Writes buffers (memoryviews) with gathering sendmsg() calls until
+    they're all sent or a non-blocking conn is full; whatever is left stays
+    in buffers"""
+    while buffers:
+        try:
+            sent = conn.sendmsg(buffers[:IOV_MAX])
+        except BlockingIOError:
+            return
+        # drop whatever was fully sent, and trim what was partly sent
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers.pop(0))
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+class FrameReader:
+    """Receive buffer for one connection
+
+    Bytes are received straight into a preallocated bytearray, and complete
+    records or frames are handed out as memoryviews into it, so partial
+    frames wait in place for the rest of their bytes. Views are only valid
+    until the next call to recv_from."""
+    def __init__(self, size=65536):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # unread bytes are self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = 0
+
+    def get_buffer(self, min_size=1):
+        """Returns a writable view of the free space after the unread bytes,
+        making room first if necessary"""
+        if self.start == self.end:
+            # everything has been read; start over at the front
+            self.start = self.end = 0
+        unread = self.end - self.start
+        if len(self.buffer) - self.end < min_size:
+            if unread + min_size > len(self.buffer):
+                # a frame bigger than the buffer; grow to fit it
+                size = len(self.buffer)
+                while unread + min_size > size:
+                    size *= 2
+                buffer = bytearray(size)
+                buffer[:unread] = self.view[self.start:self.end]
+                self.buffer = buffer
+                self.view = memoryview(buffer)
+            else:
+                # move the partial frame to the front of the buffer
+                self.view[:unread] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = unread
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        """Marks nbytes written into get_buffer() as unread"""
+        self.end += nbytes
+
+    def recv_from(self, conn):
+        """Reads as much as conn has, up to the free space in the buffer
+
+        Returns the number of bytes read; 0 means the peer closed"""
+        nbytes = conn.recv_into(self.get_buffer())
+        self.end += nbytes
+        return nbytes
+
+    def records(self, record_size=REQUEST.size):
+        """Returns a view of every complete unframed record"""
+        end = self.end - (self.end - self.start) % record_size
+        records = self.view[self.start:end]
+        self.start = end
+        return records
+
+    def responses(self, wire, value_type):
+        """Yields (message_id, response_type, value, version) for every
+        complete response; the value of a value_type response is a view of
+        it"""
+        response = wire.response
+        value_response = wire.value_response
+        # the response type follows the message ID
+        type_offset = wire.id_bytes
+        value_type = value_type[0]
+        buffer = self.buffer
+        while self.end - self.start >= response.size:
+            if buffer[self.start + type_offset] != value_type:
+                message = response.unpack_from(buffer, self.start)
+                self.start += response.size
+                yield message
+                continue
+            if self.end - self.start < value_response.size:
+                break
+            message_id, response_type, version, length = \
+                    value_response.unpack_from(buffer, self.start)
+            value_start = self.start + value_response.size
+            if self.end - value_start < length:
+                # make sure the whole value fits next time
+                self.get_buffer(value_response.size + length)
+                break
+            self.start = value_start + length
+            yield (message_id, response_type,
+                    self.view[value_start:self.start], version)
+
+    def frames(self):
+        """Yields (frame_kind, payload) for every complete frame"""
+        header_size = FRAME_HEADER.size
+        while self.end - self.start >= header_size:
+            kind, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            payload_start = self.start + header_size
+            if self.end - payload_start < length:
+                break
+            self.start = payload_start + length
+            yield kind, self.view[payload_start:self.start]
+
+class OutputBuffer:
+    """Send buffer for one non-blocking connection, owned by the one
+    process that writes to it
+
+    Small records are packed into a bytearray, and larger buffers (e.g.
+    views of stored values) are queued as they are, so that flush() can
+    write everything with a single gathering sendmsg. Whatever the
+    connection has no room for stays buffered until it's writable again."""
+    def __init__(self, conn):
+        self.conn = conn
+        # buffers to write, in order; the last one is always a bytearray
+        # that small records are appended to
+        self.buffers = [bytearray()]
+        self.nbytes = 0
+        # when the oldest unwritten byte was buffered
+        self.since = 0
+        # whether the last flush() left bytes the connection had no room
+        # for; flush again once select() says it's writable
+        self.blocked = False
+
+    def __len__(self):
+        return self.nbytes
+
+    def append(self, data, now=0):
+        """Copies data into the buffer"""
+        if not self.nbytes:
+            self.since = now
+        self.buffers[-1] += data
+        self.nbytes += len(data)
+
+    def append_view(self, view, now=0):
+        """Queues a buffer without copying it; it must stay unchanged until
+        the next flush()"""
+        if not self.nbytes:
+            self.since = now
+        self.buffers.append(view)
+        self.buffers.append(bytearray())
+        self.nbytes += len(view)
+
+    def flush(self):
+        """Writes as much of the buffer as the connection has room for"""
+        if not self.nbytes:
+            return
+        buffers = [memoryview(buffer).cast('B') for buffer in self.buffers]
+        sendmsg_some(self.conn, buffers)
+        self.blocked = bool(buffers)
+        # copy what's left, since queued views may change once we return
+        left = bytearray().join(buffers)
+        for view in buffers:
+            view.release()
+        self.buffers = [left]
+        self.nbytes = len(left)
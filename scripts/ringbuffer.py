@@ -0,0 +1,168 @@
+"""Single-producer/single-consumer ring buffers in shared memory
+
+Records are copied into fixed-size slots of a multiprocessing.shared_memory
+segment; nothing is pickled. The producer publishes a whole batch by moving
+the tail once, and only rings the consumer's doorbell (an eventfd, or a
+pipe where eventfd is missing) when the consumer said it was going to
+sleep, so a busy consumer costs the producer no system calls at all.
+
+The head and tail are plain 64-bit integers in the segment, which relies
+on aligned 8-byte stores being atomic and on stores not being reordered
+with other stores (true on x86). A wakeup can still be lost when the
+producer publishes just as the consumer goes to sleep, so consumers never
+sleep for longer than max_sleep seconds."""
+import os
+import struct
+from select import select
+from time import sleep
+from multiprocessing import shared_memory
+
+# head and tail live on separate cache lines
+HEAD_OFFSET = 0
+TAIL_OFFSET = 64
+WAITING_OFFSET = 128
+HEADER_SIZE = 192
+INDEX = struct.Struct('=Q')
+
+class Doorbell:
+    """Wakes a sleeping process; many rings in a row cost one wakeup"""
+    def __init__(self):
+        if hasattr(os, 'eventfd'):
+            self.read_fd = self.write_fd = os.eventfd(0, os.EFD_NONBLOCK)
+        else:
+            self.read_fd, self.write_fd = os.pipe()
+            os.set_blocking(self.read_fd, False)
+
+    def fileno(self):
+        """Lets a Doorbell be passed to select()"""
+        return self.read_fd
+
+    def ring(self):
+        try:
+            os.write(self.write_fd, b'\x01\x00\x00\x00\x00\x00\x00\x00')
+        except BlockingIOError:
+            # the other end already has plenty of unread rings
+            pass
+
+    def clear(self):
+        try:
+            os.read(self.read_fd, 4096)
+        except BlockingIOError:
+            pass
+
+class RingBuffer:
+    """Fixed-slot SPSC ring; create it before forking, then use put() from
+    exactly one process and get()/consume() from exactly one other"""
+    def __init__(self, slot_size, num_slots, max_sleep=0.01):
+        self.slot_size = slot_size
+        self.num_slots = num_slots
+        self.size = slot_size * num_slots
+        self.max_sleep = max_sleep
+        self.shm = shared_memory.SharedMemory(create=True,
+                size=HEADER_SIZE + self.size)
+        self.buf = self.shm.buf
+        self.slots = self.buf[HEADER_SIZE:]
+        INDEX.pack_into(self.buf, HEAD_OFFSET, 0)
+        INDEX.pack_into(self.buf, TAIL_OFFSET, 0)
+        INDEX.pack_into(self.buf, WAITING_OFFSET, 0)
+        self.doorbell = Doorbell()
+
+    def fileno(self):
+        """Lets a consumer select() on the ring along with sockets"""
+        return self.doorbell.fileno()
+
+    def close(self):
+        """Unmaps the segment from this process; views returned by get()
+        must be released first"""
+        if self.slots is not None:
+            self.slots.release()
+            self.buf = self.slots = None
+            self.shm.close()
+
+    __del__ = close
+
+    def unlink(self):
+        """Removes the segment's name; processes that already have it
+        mapped keep using it, and nothing is left behind when they die"""
+        self.shm.unlink()
+
+    def put(self, records, wait=None):
+        """Copies a bytes-like object holding whole records into the ring,
+        waiting for the consumer if the ring is full
+
+        wait, if given, is called instead of yielding the CPU while the
+        ring is full"""
+        buf = self.buf
+        size = self.size
+        records = memoryview(records).cast('B')
+        tail = INDEX.unpack_from(buf, TAIL_OFFSET)[0]
+        while len(records):
+            head = INDEX.unpack_from(buf, HEAD_OFFSET)[0]
+            free = size - (tail - head)
+            if not free:
+                # make sure the consumer is awake, then let it run
+                self.doorbell.ring()
+                if wait is None:
+                    sleep(0)
+                else:
+                    wait()
+                continue
+            # copy as much as fits before the end of the ring
+            start = tail % size
+            nbytes = min(free, size - start, len(records))
+            self.slots[start:start + nbytes] = records[:nbytes]
+            records = records[nbytes:]
+            tail += nbytes
+            # publish the whole copy at once
+            INDEX.pack_into(buf, TAIL_OFFSET, tail)
+        if INDEX.unpack_from(buf, WAITING_OFFSET)[0]:
+            self.doorbell.ring()
+
+    def get(self, block=True):
+        """Returns a view of the unread records up to the end of the ring;
+        call consume() once they have been handled. Returns an empty view
+        only if block is False and the ring is empty."""
+        buf = self.buf
+        head = INDEX.unpack_from(buf, HEAD_OFFSET)[0]
+        tail = INDEX.unpack_from(buf, TAIL_OFFSET)[0]
+        while tail == head and block:
+            self.sleep()
+            tail = INDEX.unpack_from(buf, TAIL_OFFSET)[0]
+        start = head % self.size
+        return self.slots[start:start + min(tail - head, self.size - start)]
+
+    def consume(self, nbytes):
+        """Frees nbytes worth of records returned by get()"""
+        head = INDEX.unpack_from(self.buf, HEAD_OFFSET)[0]
+        INDEX.pack_into(self.buf, HEAD_OFFSET, head + nbytes)
+
+    def empty(self):
+        return INDEX.unpack_from(self.buf, HEAD_OFFSET)[0] == \
+                INDEX.unpack_from(self.buf, TAIL_OFFSET)[0]
+
+    def __len__(self):
+        """Returns how many bytes have been put but not consumed yet"""
+        return INDEX.unpack_from(self.buf, TAIL_OFFSET)[0] - \
+                INDEX.unpack_from(self.buf, HEAD_OFFSET)[0]
+
+    def set_waiting(self, waiting):
+        """Tells the producer whether the consumer wants its doorbell
+        rung; consumers that select() on several rings use this directly,
+        and call clear() on the rings that select() found ready"""
+        INDEX.pack_into(self.buf, WAITING_OFFSET, waiting)
+
+    def clear(self):
+        """Resets the doorbell after it woke the consumer"""
+        self.doorbell.clear()
+
+    def sleep(self, timeout=None):
+        """Blocks until the producer rings or max_sleep (or timeout, if
+        it's shorter) passes"""
+        if timeout is None or timeout > self.max_sleep:
+            timeout = self.max_sleep
+        self.set_waiting(1)
+        # the producer may have published before it saw the flag
+        if self.empty() and \
+                select((self.doorbell,), (), (), timeout)[0]:
+            self.doorbell.clear()
+        self.set_waiting(0)
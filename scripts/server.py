@@ -1,121 +1,339 @@
 import os
+import json
+import fcntl
+import signal
 import socket
+import termios
 from select import select
-from sys import stdout
-from multiprocessing import Array, Lock, Process, Pipe, Queue, RawArray
-from hash_single_thread import Table
-from ctypes import c_int
+from sys import byteorder, exit, stdout
+from time import monotonic, sleep
+from collections import deque
+from multiprocessing import Lock, Process, RawArray
+from handler import PendingSet, RequestHandler
+from placement import Placement
+from protocol import VALUE_FRAME, MULTI_RESULT, TABLE_WORD, WireFormat, \
+        FrameReader, OutputBuffer, frame
+from shm_table import ShmHashTable
+from slab import SlabAllocator
+from table_file import TableFile
+from ringbuffer import RingBuffer
+from stats import Stats, pack_snapshot
+from wal import WriteAheadLog, PUT_RECORD, PUTV_RECORD, VALUE, \
+        read_records, write_snapshot
+from ctypes import c_ulonglong
 
 class Worker(Process):
     # request types
     GET_BYTEC    = b'\x00'
     PUT_BYTEC    = b'\x01'
     END_BYTEC    = b'\x02'
+    GETV_BYTEC   = b'\x03'
+    PUTV_BYTEC   = b'\x04'
+    GET_RYW_BYTEC  = b'\x05'
+    GETV_RYW_BYTEC = b'\x08'
     
     # response types
     EMPTY_BYTEC  = b'\x00'
     ACK_BYTEC    = b'\x06'
+    VALUE_BYTEC  = b'\x07'
     CANCEL_BYTEC = b'\x18'
 
-    """Uses blocking FIFO queues to read and write to a shared memory
-    table"""
-    def __init__(self, worker_id, pipe_conn, sock, conns, table,
-            request_queue, sock_locks, pending, outfile=None,
-            verbose=False):
+    """Reads requests for the keys it owns from a pipe or ring buffer,
+    applies them to a shared memory table, and hands the responses back to
+    the dispatcher, which owns the client connections"""
+    def __init__(self, worker_id, requests, responses, table, wire=None,
+            blobs=None, slab=None, acked=None, pending=None, num_workers=1,
+            data_prefix=None, wal_interval=0.005, snapshot_bytes=2 ** 24,
+            max_wait=0, outfile=None, verbose=False, stats=None,
+            handled=None):
         # our assigned worker number
         self.worker_id = worker_id
-        # same as above, but as a bytes object
-        self.WORKER_ID_BYTEC = worker_id.to_bytes(2, byteorder='big')
-        # server's socket, shared with us from main thread
-        self.socket = sock
-        # map a connection's file number to its connection object
-        self.connections = dict()
-        for conn in conns:
-            self.connections[conn.fileno()] = conn
-        # for receiving commit/abort messages
-        self.pipe = pipe_conn
-        # type: multiprocessing.sharedctypes.Array
+        # we own the keys where key % num_workers == worker_id
+        self.num_workers = num_workers
+        # for receiving batches of requests for the keys we own; either
+        # the read end of a pipe or a RingBuffer
+        self.requests = requests
+        # carries our responses back to the dispatcher; either the write
+        # end of a pipe or a RingBuffer
+        self.responses = responses
+        # layout of the requests we receive
+        self.wire = wire or WireFormat()
+        # type: multiprocessing.sharedctypes.Array, or the ShmHashTable
+        # partition holding our keys
         self.table = table
-        self.table_size = len(table)
-        # type: multiprocessing.Queue
-        self.request_queue = request_queue
-        # ensures two processes don't try to write to the same socket
-        self.num_clients = len(sock_locks)
-        self.sock_locks = sock_locks
-        # keeps track of which messages are pending 2-phase-commit
-        self.pending = pending
+        # keeps track of which keys are pending 2-phase-commit; only we
+        # see requests for our keys, so it needs no lock, even if it's
+        # the table file's array that the other workers also use
+        if pending is not None:
+            self.pending = pending
+        elif isinstance(table, ShmHashTable):
+            self.pending = PendingSet()
+        else:
+            self.pending = bytearray(len(table))
+        # variable-length values: a ShmHashTable of slab references and
+        # the SlabAllocator they point into; None if they're disabled
+        self.slab = slab
+        # the dispatcher sends values straight from the slab, so a
+        # replaced value is only freed once the dispatcher has handled
+        # every response we sent before it was replaced. acked[worker_id]
+        # counts the bytes of our responses it has handled.
+        self.acked = acked
+        self.bytes_sent = 0
+        # (bytes_sent when replaced, slab reference) of replaced values
+        self.retired = deque()
+        # applies requests to the table; PUTs of pending keys may wait up
+        # to max_wait seconds for them
+        self.handler = RequestHandler(table, self.pending, blobs=blobs,
+                slab=slab, retire=self.retire, max_wait=max_wait)
+        self.blobs = blobs
+        # our write-ahead log and snapshot are data_prefix + '.wal' and
+        # '.snap'; None keeps the table in memory only. The log is group
+        # committed every wal_interval seconds, and replaced by a snapshot
+        # once it's snapshot_bytes long.
+        self.data_prefix = data_prefix
+        self.wal_interval = wal_interval
+        self.snapshot_bytes = snapshot_bytes
+        self.wal = None
 
         # logging info
         self.outfile = outfile
         self.verbose = verbose
+        # the dispatcher's Stats, which we record ours in, or None
+        self.stats = stats
+        self.slot = worker_id + 1
+        # handled[worker_id] counts the requests we've applied, whether or
+        # not stats are recorded
+        self.handled = handled
 
         # pass options to multiprocessing.Process
         super(Worker, self).__init__(group=None, target=None, name=None)
 
     def run(self):
+        handler = self.handler
+        handle = handler.handle
+        requests = self.requests
+        use_ring = isinstance(requests, RingBuffer)
+        routed = self.wire.routed
+        routed_response = self.wire.routed_response
+        self.replies = replies = []
+        # a pipe is a stream, so partial records wait here for the rest
+        reader = FrameReader()
+        if self.data_prefix is not None:
+            # requests for our keys wait in the pipe or ring meanwhile
+            self.recover()
+            self.wal = WriteAheadLog(self.data_prefix + '.wal',
+                    self.wal_interval)
+            self.handler.wal = self.wal
+        wal = self.wal
+        stats = self.stats
+        slot = self.slot
+        handled = self.handled
+        worker_id = self.worker_id
+        if stats is not None:
+            # keys recovered, or already in the table file
+            handler.num_keys = self.count_keys()
         while True:
-            # get the next request as a byte-string, blocking if necessary
-            req_bytes, conn_fileno = self.request_queue.get()
-            # get connection object from file number
-            conn = self.connections[conn_fileno]
-            # parse the bytes
-            message_id = req_bytes[:2] # we don't need to convert to int
-            request_type = req_bytes[2:3]
-            key = int.from_bytes(req_bytes[3:5], byteorder='big')
-            if request_type == self.GET_BYTEC:
-                # is there a PUT pending for this key?
-                if self.pending[key % self.table_size]:
-                    # let client know the location is locked
-                    self.respond(conn, message_id, self.EMPTY_BYTEC,
-                            self.EMPTY_BYTEC * 2)
-                else:
-                    # get the value and respond with it
-                    value = self.table[key].to_bytes(2, byteorder='big')
-                    self.respond(conn, message_id, self.ACK_BYTEC, value)
-            elif request_type == self.PUT_BYTEC:
-                # is there already a pending PUT?
-                lock = self.pending.get_lock()
-                lock.acquire()
-                if self.pending[key]:
-                    lock.release()
-                    self.respond(conn, message_id, self.CANCEL_BYTEC,
-                            self.EMPTY_BYTEC * 2)
-                    value = int.from_bytes(req_bytes[5:7],
-                            byteorder='big')
-                else:
-                    # mark it as pending
-                    self.pending[key] = 1
-                    lock.release()
-                    value = int.from_bytes(req_bytes[5:7],
-                            byteorder='big')
-                    self.respond(conn, message_id, self.ACK_BYTEC,
-                            self.EMPTY_BYTEC * 2)
-            # need commit message before we can PUT value
-            elif request_type == self.ACK_BYTEC:
-                value = int.from_bytes(req_bytes[5:7], byteorder='big')
-                self.table[key] = value
-                self.pending[key] = 0
-            elif request_type == self.CANCEL_BYTEC:
-                self.pending[key] = 0
-                value = int.from_bytes(req_bytes[5:7], byteorder='big')
-            elif request_type == self.END_BYTEC:
-                print("Workers aren't supposed to receive ENDs")
+            timeout = self.next_timeout()
+            if timeout is not None and not self.wait_requests(timeout):
+                # nothing came in before the group commit or a wait was
+                # due
+                self.expire_waiters()
+                if wal is not None:
+                    self.checkpoint()
+                continue
+            # get the next batch of requests, blocking if necessary
+            if use_ring:
+                batch = requests.get()
+            else:
+                nbytes = os.readv(requests, [reader.get_buffer()])
+                if not nbytes:
+                    # the dispatcher is gone
+                    break
+                reader.buffer_updated(nbytes)
+                batch = reader.records(routed.size)
+            if stats is not None:
+                stats.batch_read(slot)
+            for message_id, request_type, key, value, conn_fileno in \
+                    routed.iter_unpack(batch):
+                # apply the request; ACK/CANCEL (commit/abort) get no
+                # response, and PUTs waiting for their key get one later
+                response = handle(request_type, key, value, message_id,
+                        conn_fileno)
+                if response is not None:
+                    replies.append(routed_response.pack(message_id,
+                            *response, conn_fileno))
+                if handler.woken:
+                    # a commit or abort handed its key to a waiting PUT
+                    self.add_woken()
+            if use_ring:
+                requests.consume(len(batch))
+            if handled is not None:
+                handled[worker_id] += len(batch) // routed.size
+            if stats is not None:
+                stats.batch_handled(slot, len(batch) // routed.size,
+                        handler.num_pending, handler.num_keys)
+            if handler.deadlines:
+                self.expire_waiters()
             else:
-                print("Got bad request")
-
-    def respond(self, conn, message_id, response_type, value):
-        """Obtains a socket's write lock, then writes to the socket,
-        blocking if necessary"""
-        # figure out which client to send to
-        client_id = int.from_bytes(message_id, byteorder='big') % self.num_clients
-        # block until we get the write lock lock = self.sock_locks[client_id]
-        lock = self.sock_locks[client_id]
-        lock.acquire()
-        conn.sendall(message_id + response_type + value)
-        lock.release()
+                self.send_replies()
+            if self.retired:
+                self.free_retired()
+            if wal is not None:
+                self.checkpoint()
+
+    def send_replies(self):
+        """Hands every buffered response to the dispatcher at once"""
+        replies = self.replies
+        if not replies:
+            return
+        message = b''.join(replies)
         if self.verbose:
-            self.show_hex(message_id + response_type + value,
-            prefix="Sending: ", use_outfile=True)
+            self.show_hex(message, prefix="Responding: ", use_outfile=True)
+        stats = self.stats
+        if stats is not None:
+            # the response type byte of every record; before the dispatcher
+            # can see them
+            stats.replies_sent(self.slot, message[self.wire.id_bytes::
+                    self.wire.routed_response.size])
+        if isinstance(self.responses, RingBuffer):
+            self.responses.put(message)
+        else:
+            self.write_all(message)
+        self.bytes_sent += len(message)
+        replies.clear()
+
+    def add_woken(self):
+        """Buffers the responses to PUTs that are done waiting"""
+        routed_response = self.wire.routed_response
+        for message_id, conn_fileno, response in self.handler.woken:
+            self.replies.append(routed_response.pack(message_id, *response,
+                    conn_fileno))
+        self.handler.woken.clear()
+
+    def expire_waiters(self):
+        """Refuses PUTs that have waited too long, and sends every buffered
+        response"""
+        self.handler.expire()
+        if self.handler.woken:
+            self.add_woken()
+        self.send_replies()
+
+    def next_timeout(self):
+        """Returns how long we may wait for requests before the group
+        commit or a PUT's wait is due, or None to wait indefinitely"""
+        timeout = self.handler.wait_timeout()
+        wal = self.wal
+        if wal is not None and wal.dirty():
+            wal_timeout = wal.timeout()
+            if timeout is None or wal_timeout < timeout:
+                timeout = wal_timeout
+        return timeout
+
+    def wait_requests(self, timeout):
+        """Waits up to timeout seconds for requests; returns whether any
+        came in"""
+        if isinstance(self.requests, RingBuffer):
+            if self.requests.empty():
+                self.requests.sleep(timeout)
+            return not self.requests.empty()
+        return bool(select((self.requests,), (), (), timeout)[0])
+
+    def recover(self):
+        """Loads our snapshot, then replays our write-ahead log"""
+        records, length = read_records(self.data_prefix + '.snap')
+        for record in records:
+            self.apply(*record)
+        num_records = len(records)
+        wal_path = self.data_prefix + '.wal'
+        records, length = read_records(wal_path)
+        for record in records:
+            self.apply(*record)
+        if os.path.exists(wal_path) and os.path.getsize(wal_path) > length:
+            # cut off a record torn by a crash, so new ones follow the
+            # last good one
+            os.truncate(wal_path, length)
+        num_records += len(records)
+        if num_records:
+            self.outfile.write("Worker {} recovered {} records{}".format(
+                    self.worker_id, num_records, os.linesep))
+            self.outfile.flush()
+
+    def apply(self, kind, key, payload):
+        """Applies one snapshot or log record to the table"""
+        if kind == PUT_RECORD:
+            self.table[key] = VALUE.unpack(payload)[0]
+            return
+        ref = 0
+        if self.slab is not None:
+            # the record replaces the old value, so its slot can be reused
+            old_ref = self.blobs[key]
+            if old_ref:
+                self.blobs[key] = 0
+                self.slab.free(old_ref)
+            ref = self.slab.store(payload)
+        if not ref:
+            # carrying on would serve the key as if it had no value
+            message = "Worker {} can't recover the {}-byte value of key " \
+                    "{}; slab_bytes is too small for it".format(
+                    self.worker_id, len(payload), key)
+            self.outfile.write(message + os.linesep)
+            self.outfile.flush()
+            raise ValueError(message)
+        self.blobs[key] = ref
+
+    def checkpoint(self):
+        """Group commits the log if it's due, and replaces it with a
+        snapshot once it has grown too long"""
+        wal = self.wal
+        wal.sync()
+        if wal.size >= self.snapshot_bytes:
+            wal.sync(force=True)
+            write_snapshot(self.data_prefix + '.snap',
+                    self.snapshot_records())
+            wal.truncate()
+
+    def snapshot_records(self):
+        """Yields a record for every key we own"""
+        table = self.table
+        if isinstance(table, ShmHashTable):
+            items = table.items()
+        else:
+            items = ((key, table[key]) for key in
+                    range(self.worker_id, len(table), self.num_workers))
+        for key, value in items:
+            if value:
+                yield PUT_RECORD, key, VALUE.pack(value)
+        if self.blobs is not None:
+            for key, ref in self.blobs.items():
+                yield PUTV_RECORD, key, self.slab.view(ref)
+
+    def count_keys(self):
+        """Returns how many of our keys have a value"""
+        table = self.table
+        if isinstance(table, ShmHashTable):
+            return len(table)
+        return sum(1 for key in range(self.worker_id, len(table),
+                self.num_workers) if table[key])
+
+    def write_all(self, message):
+        """Writes all of message to our response pipe, blocking if needed"""
+        view = memoryview(message)
+        while len(view):
+            view = view[os.write(self.responses, view):]
+
+    def retire(self, ref):
+        """Frees a replaced value once the dispatcher can't be sending it
+        any more"""
+        # responses in the batch we're building may refer to it too
+        self.retired.append((self.bytes_sent +
+                len(self.replies) * self.wire.routed_response.size, ref))
+
+    def free_retired(self):
+        """Frees every retired value the dispatcher is done with"""
+        acked = self.acked[self.worker_id]
+        retired = self.retired
+        while retired and retired[0][0] <= acked:
+            self.slab.free(retired.popleft()[1])
 
     def show_hex(self, data, prefix='', suffix='', use_outfile=False):
         """For debugging socket messages"""
@@ -127,17 +345,75 @@ class Worker(Process):
         else:
             print(prefix + ' '.join(data) + suffix)
 
+def unread_bytes(fd):
+    """Returns how many bytes are waiting to be read from a pipe; either
+    end of it will do"""
+    return int.from_bytes(fcntl.ioctl(fd, termios.FIONREAD, bytes(4)),
+            byteorder=byteorder)
+
+class MultiRequest:
+    """An MGET or MPUT being answered by the workers that own its keys"""
+    __slots__ = ('request_type', 'keys', 'results', 'order', 'remaining')
+
+    def __init__(self, request_type, keys, num_workers):
+        self.request_type = request_type
+        # in ascending order, which is the order answers are sent in
+        self.keys = keys
+        # (response_type, value, version) for each key
+        self.results = [None] * len(keys)
+        # indices of the keys sent to each worker, in the order it answers
+        self.order = [deque() for worker_id in range(num_workers)]
+        self.remaining = len(keys)
+
 class Server(Process):
     # request types
     GET_BYTEC    = b'\x00'
     PUT_BYTEC    = b'\x01'
     END_BYTEC    = b'\x02'
-    
+    GETV_BYTEC   = b'\x03'
+    PUTV_BYTEC   = b'\x04'
+    GET_RYW_BYTEC  = b'\x05'
+    GETV_RYW_BYTEC = b'\x08'
+    MGET_BYTEC     = b'\x09'
+    MPUT_BYTEC     = b'\x0a'
+    MCOMMIT_BYTEC  = b'\x0b'
+    MABORT_BYTEC   = b'\x0c'
+    REPLICATE_BYTEC = b'\x0d'
+    WRITE_BYTEC    = b'\x0e'
+    COMMIT_MANY_BYTEC = b'\x0f'
+    ABORT_MANY_BYTEC  = b'\x10'
+    # answered by the dispatcher with a snapshot of our stats (see
+    # stats.pack_snapshot); sent by cluster_stats.py, to stats_port
+    STATS_BYTEC    = b'\x11'
+
     # response types
     EMPTY_BYTEC  = b'\x00'
     ACK_BYTEC    = b'\x06'
+    VALUE_BYTEC  = b'\x07'
     CANCEL_BYTEC = b'\x18'
 
+    # multi-key requests, and the request each of their keys becomes on
+    # its way to the worker that owns it
+    MULTI_REQUESTS = {
+        MGET_BYTEC: GET_BYTEC,
+        MPUT_BYTEC: MPUT_BYTEC,
+        MCOMMIT_BYTEC: ACK_BYTEC,
+        MABORT_BYTEC: CANCEL_BYTEC
+    }
+
+    # batched commits and aborts, and the request each of their PUTs
+    # becomes on its way to the worker that owns its key
+    DECISIONS = {
+        COMMIT_MANY_BYTEC: ACK_BYTEC,
+        ABORT_MANY_BYTEC: CANCEL_BYTEC
+    }
+
+    # requests answered with a VALUE response
+    GETV_REQUESTS = (
+        GETV_BYTEC,
+        GETV_RYW_BYTEC
+    )
+
     # 2-phase-commit response types
     TWO_PC_BYTEC = (
         ACK_BYTEC,
@@ -149,14 +425,21 @@ class Server(Process):
         GET_BYTEC,
         PUT_BYTEC
     )
-    def __init__(self, clients, server_host, config):
-        # setup connection info
-        self.hostname = socket.gethostname()
+    def __init__(self, clients, server_host, config, hostname=None):
+        # setup connection info; hostname is our name in clients, which
+        # is this host's name unless we're one of several nodes on it
+        self.hostname = hostname or socket.gethostname()
         self.clients = clients
         self.num_clients = len(clients)
         self.server_settings = (server_host, int(config['port']))
+        # where cluster_stats.py asks for STATS
+        self.stats_port = int(config['stats_port'])
         self.backlog_size = int(config['backlog'])
         self.max_retries = int(config['max_retries'])
+        # whether clients wrap requests in length-prefixed frames
+        self.framing = config['framing'].upper()[0] == 'T'
+        # record layouts, e.g. how wide keys are
+        self.wire = WireFormat.from_config(config)
 
         # setup logging info
         self.verbose = config['verbose'].upper()[0] == 'T'
@@ -165,17 +448,88 @@ class Server(Process):
                 self.hostname + "_server.out")
         self.outfile = open(outfilename, 'w')
 
+        # setup worker synchronization; each worker owns the keys where
+        # key % num_workers == worker_id, and tracks their pending PUTs
+        self.num_workers = int(config['server_threads'])
+
         # setup table
         num_keys = int(config['table_size'])
-        # syncrhonized by means of an indicator array
-        self.table = RawArray(c_int, num_keys)
-
-        # setup worker synchronization
-        self.num_workers = int(config['server_threads'])
-        self.request_queue = Queue() # multi-producer/multi-consumer queues
-        self.sock_locks = [Lock() for i in range(self.num_clients)]
-        # a dumb globally-locked array keeps track of pending PUTs
-        self.pending = Array(c_int, num_keys)
+        # 'array' indexes a fixed array by key; 'hash' stores sparse keys
+        self.table_backend = config['table_backend']
+        if self.table_backend == 'hash':
+            # one growable partition per worker; only its owner writes it
+            self.table = [ShmHashTable(num_keys // self.num_workers + 1)
+                    for worker_id in range(self.num_workers)]
+        else:
+            # syncrhonized by means of an indicator array
+            self.table = RawArray(c_ulonglong, num_keys)
+        # the array table and pending indicators can live in a mapped file
+        # instead, which a restarted server serves from right away
+        self.table_file = self.pending = None
+        if config['table_file'] != 'none':
+            if self.table_backend != 'array':
+                raise ValueError("table_file requires table_backend array")
+            self.table_file = TableFile(config['table_file'], num_keys)
+            self.table = self.table_file.table
+            self.pending = self.table_file.pending
+        # 'pipe' sends requests to workers and responses back through
+        # pipes; 'ring' uses shared memory RingBuffers both ways. Either
+        # way, only the dispatcher writes to the client connections.
+        self.transport = config['transport']
+        self.ring_slots = int(config['ring_slots'])
+        # responses for a client are written once this many bytes are
+        # buffered, or once the oldest has waited this many seconds; 0
+        # writes whatever a pass over the connections and workers produced
+        self.flush_size = int(config['response_flush_size'])
+        self.flush_latency = float(config['response_flush_latency'])
+        # variable-length values live in per-worker slabs, with slab_bytes
+        # of slots per size class; 0 disables GETV/PUTV
+        slab_bytes = int(config['slab_bytes'])
+        self.slabs = self.blobs = None
+        if slab_bytes:
+            # the dispatcher allocates, and the owning worker frees
+            self.slabs = [SlabAllocator(slab_bytes, Lock())
+                    for worker_id in range(self.num_workers)]
+            self.blobs = [ShmHashTable()
+                    for worker_id in range(self.num_workers)]
+        # bytes of each worker's responses the dispatcher has handled
+        self.acked = RawArray(c_ulonglong, self.num_workers)
+        # requests each worker has applied, for STATS answers; so cheap
+        # to count that it's done whether or not stats are recorded
+        self.handled = RawArray(c_ulonglong, self.num_workers)
+        # where workers keep their write-ahead logs and snapshots; 'none'
+        # keeps the table in memory only
+        self.wal_dir = config['wal_dir']
+        self.wal_interval = float(config['wal_interval'])
+        self.snapshot_bytes = int(config['snapshot_bytes'])
+        # how long a PUT of a pending key waits for it before it's
+        # refused; 0 refuses it straight away
+        self.max_wait = float(config['max_wait'])
+        # '2pc' has clients prepare and commit each PUT on every replica of
+        # its key; 'primary' has them send it to the key's primary alone,
+        # which commits it, pushes it to the other replicas and answers
+        # once they all have it
+        self.replication = config['replication']
+        if self.replication not in ('2pc', 'primary'):
+            raise ValueError("unknown replication: {}".format(
+                    self.replication))
+        if self.replication == 'primary' and not self.framing:
+            raise ValueError("replication primary requires framing")
+        # PUTs carry their transaction's stamp in a VALUE_FRAME
+        if self.max_wait and not self.framing:
+            raise ValueError("max_wait requires framing")
+        # the same placement the clients use; we're server node_n
+        self.node_n = clients.index(self.hostname)
+        self.placement = Placement(self.num_clients,
+                int(config['replication_factor']))
+        # per-stage latency histograms and counters of the dispatcher and
+        # each worker, written to <hostname>_stats.json once every client
+        # is done; None doesn't time anything
+        self.stats = None
+        if config['stats'].upper()[0] == 'T':
+            self.stats = Stats(self.num_workers + 1)
+        # the Worker processes, once they're started
+        self.workers = []
 
         # setup multiprocessing info
         super(Server, self).__init__(
@@ -184,9 +538,17 @@ class Server(Process):
 
     def run(self):
         """Setup socket and start listening for connections"""
+        # for the uptime in STATS answers
+        self.start_time = monotonic()
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.bind(self.server_settings)
         s.listen(self.backlog_size)
+        # STATS requests come in on a port of their own, so that they
+        # can't be mistaken for one of our clients' connections
+        stats_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        stats_socket.bind((self.server_settings[0], self.stats_port))
+        stats_socket.listen(self.backlog_size)
+        self.stats_socket = stats_socket
         # make a socket for each client
         socket_list = []
         self.socket = s
@@ -194,14 +556,36 @@ class Server(Process):
                 "Listening for connections on port ({}){}".format(
                 self.server_settings[1], os.linesep))
         self.outfile.flush()
-        self.get_quorum()
+        if self.table_file is None:
+            self.get_quorum()
+            return
+        self.outfile.write("Mapped table file {} ({}){}".format(
+                self.table_file.path, self.table_file.status, os.linesep))
+        self.outfile.flush()
+        # stop_all.sh sends SIGTERM; unwind so the file is closed cleanly
+        signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+        try:
+            self.get_quorum()
+        finally:
+            # the table has to stop changing before it's checksummed
+            for worker in self.workers:
+                worker.terminate()
+                worker.join()
+            self.table_file.close()
 
     def get_quorum(self):
         """Waits for all nodes to connect"""
         s = self.socket
         connected = []
         clients = self.clients
-        while len(connected) != len(clients):
+        num_connections = len(clients)
+        # our links to the other servers, by node index
+        self.peers = dict()
+        if self.replication == 'primary':
+            self.connect_peers()
+            # every other server links to us as well
+            num_connections += len(clients) - 1
+        while len(connected) != num_connections:
             # block until someone is ready
             conn, addr = s.accept()
             connected.append(conn)
@@ -217,51 +601,548 @@ class Server(Process):
         self.outfile.write("Reading messages" + os.linesep)
         self.outfile.flush()
         # start 8 worker threads
-        pipes = []
-        for worker_id in range(self.num_workers):
-            parent_conn, child_conn = Pipe()
-            pipes.append(parent_conn)
-            Worker(worker_id, child_conn, s, connected, self.table,
-                    self.request_queue, self.sock_locks, self.pending,
-                    self.outfile, self.verbose).start()
+        num_workers = self.num_workers
+        use_ring = self.transport == 'ring'
+        routed = self.wire.routed
+        routed_response = self.wire.routed_response
+        # each worker's request and response channels: RingBuffers, or the
+        # dispatcher's ends of a pair of pipes
+        self.request_channels = []
+        self.response_channels = []
+        for worker_id in range(num_workers):
+            if use_ring:
+                requests = RingBuffer(routed.size, self.ring_slots)
+                responses = RingBuffer(routed_response.size,
+                        self.ring_slots)
+                worker_requests, worker_responses = requests, responses
+            else:
+                worker_requests, requests = os.pipe()
+                responses, worker_responses = os.pipe()
+                # we never wait on a worker; requests it isn't ready for
+                # yet are kept in self.unsent
+                os.set_blocking(requests, False)
+            self.request_channels.append(requests)
+            self.response_channels.append(responses)
+            if self.table_backend == 'hash':
+                table = self.table[worker_id]
+            else:
+                table = self.table
+            blobs = slab = None
+            if self.slabs is not None:
+                blobs = self.blobs[worker_id]
+                slab = self.slabs[worker_id]
+            data_prefix = None
+            if self.wal_dir != 'none':
+                # a worker only finds its log again if it owns the same
+                # keys it did before the restart
+                os.makedirs(self.wal_dir, exist_ok=True)
+                data_prefix = os.path.join(self.wal_dir,
+                        "{}_worker{}of{}".format(self.hostname, worker_id,
+                        num_workers))
+            worker = Worker(worker_id, worker_requests, worker_responses,
+                    table, self.wire, blobs, slab, self.acked, self.pending,
+                    num_workers, data_prefix, self.wal_interval,
+                    self.snapshot_bytes, self.max_wait, self.outfile,
+                    self.verbose, self.stats, self.handled)
+            worker.start()
+            self.workers.append(worker)
+            if use_ring:
+                # every process that needs the rings has them mapped now
+                requests.unlink()
+                responses.unlink()
+            else:
+                os.close(worker_requests)
+                os.close(worker_responses)
+        if self.slabs is not None:
+            for slab in self.slabs:
+                slab.unlink()
+        # requests waiting for room in each worker's pipe
+        self.unsent = [bytearray() for worker_id in range(num_workers)]
+        # partial responses from each worker's pipe
+        self.response_readers = [FrameReader()
+                for worker_id in range(num_workers)]
+        # we're the only process that writes to the clients; responses
+        # wait in a buffer per connection until it's time to flush it. A
+        # client that isn't reading mustn't block us, so whatever its
+        # connection has no room for stays in its buffer
+        self.outputs = dict()
+        for conn in connected + list(self.peers.values()):
+            conn.setblocking(False)
+            self.outputs[conn.fileno()] = OutputBuffer(conn)
+        # while a worker's request ring is full, keep draining responses
+        # so that the worker can't block on a full response ring
+        wait_for_room = lambda: self.collect_responses(
+                self.response_channels)
+        self.wait_for_room = wait_for_room
+        # requests read in this pass, grouped by the worker that owns them
+        self.batches = batches = [[] for worker_id in range(num_workers)]
+        # MGETs and MPUTs still waiting for some of their keys' answers,
+        # by (conn_fileno, message_id)
+        self.multi = dict()
+        # keys of the PUTs we're the primary for that a worker is
+        # committing, by (conn_fileno, message_id)
+        self.writes = dict()
+        # [conn_fileno, message_id, version, replicas left] of every
+        # committed PUT whose replicas haven't all acknowledged it, by the
+        # message ID of its REPLICATEs
+        self.replicating = dict()
+        self.replicate_id = 0
         # keep track of the number of successful PUT operations
         num_puts = 0
         num_done = 0
         done = False
+        # partial requests stay in their connection's buffer between reads
+        readers = dict()
+        for conn in connected + list(self.peers.values()):
+            readers[conn.fileno()] = FrameReader()
+        peers = set(self.peers.values())
+        # connections to stats_port, to ask for STATS
+        observers = set()
+        stats_socket = self.stats_socket
+        readable = connected + self.response_channels + list(peers) + \
+                [stats_socket]
+        stats = self.stats
         while not done:
+            timeout = None
+            if use_ring:
+                # ask the workers to wake us if they have responses, but
+                # don't sleep through responses they've already written
+                for ring in self.response_channels:
+                    ring.set_waiting(1)
+                timeout = min(ring.max_sleep
+                        for ring in self.response_channels)
+                if not all(ring.empty() for ring in self.response_channels):
+                    timeout = 0
+                wlist = []
+            else:
+                # pipes that have room again for requests we kept back
+                wlist = [self.request_channels[worker_id]
+                        for worker_id in range(num_workers)
+                        if self.unsent[worker_id]]
+            # connections that had no room for everything we flushed
+            wlist.extend(output.conn for output in self.outputs.values()
+                    if output.blocked)
+            # don't sleep past the time buffered responses are due
+            flush_timeout = self.flush_timeout()
+            if flush_timeout is not None and \
+                    (timeout is None or flush_timeout < timeout):
+                timeout = flush_timeout
             # block until we get at least one message
-            ready_list = select(connected, wlist, xlist)[0]
+            ready_list, writable = select(readable, wlist, xlist,
+                    timeout)[:2]
+            if stats is not None:
+                started = monotonic()
+            if use_ring:
+                for ring in self.response_channels:
+                    ring.set_waiting(0)
+            for fd in writable:
+                if isinstance(fd, socket.socket):
+                    self.flush_output(self.outputs[fd.fileno()])
+                else:
+                    self.write_requests(self.request_channels.index(fd))
+            ready_responses = []
             for conn in ready_list:
-                # read the message
-                message = conn.recv(511) # multiple of 7 near 512
-                if not message:
+                if conn is stats_socket:
+                    conn, addr = stats_socket.accept()
+                    conn.setblocking(False)
+                    observers.add(conn)
+                    readable.append(conn)
+                    readers[conn.fileno()] = FrameReader()
+                    self.outputs[conn.fileno()] = OutputBuffer(conn)
+                    continue
+                if not isinstance(conn, socket.socket):
+                    if use_ring:
+                        # drained by collect_responses below
+                        conn.clear()
+                    else:
+                        ready_responses.append(conn)
+                    continue
+                # read as much as the connection has
+                conn_fileno = conn.fileno()
+                reader = readers[conn_fileno]
+                if not reader.recv_from(conn):
+                    if conn in observers:
+                        # done asking; nothing can still be owed to it,
+                        # since STATS is answered straight away
+                        observers.remove(conn)
+                        readable.remove(conn)
+                        del readers[conn_fileno]
+                        del self.outputs[conn_fileno]
+                        conn.close()
+                        continue
                     # we really shouldn't ever get here, but just in case
                     break
-                # pass the message to a worker
-                for line in self.split_multiline(message):
+                if conn in peers:
+                    # replicas acknowledging our REPLICATEs
+                    self.replicated(reader)
+                    continue
+                # route each request to the worker that owns its key
+                for request in self.read_requests(reader):
+                    # is this is a commit/abort message?
+                    request_type = request[1]
+                    if request_type == self.PUTV_BYTEC:
+                        # copy the value into the slab of the worker that
+                        # owns the key, and pass along its reference
+                        worker_id = request[2] % num_workers
+                        request = request[:3] + (self.store_value(
+                                worker_id, request[3]),)
+                    elif request_type in self.GETV_REQUESTS:
+                        request = request[:3] + (0,)
+                    elif request_type == self.PUT_BYTEC and \
+                            self.replication == 'primary':
+                        # we're the key's primary; commit it at once
+                        request = (request[0], self.WRITE_BYTEC) + \
+                                request[2:]
+                        self.writes[conn_fileno, request[0]] = request[2]
+                    elif request_type == self.PUT_BYTEC and self.max_wait \
+                            and not isinstance(request[3], int):
+                        # stamp << 16 | value, for the worker to order
+                        # the PUT by if it has to wait; a PUT sent
+                        # unstamped, in a batch frame, keeps its bare
+                        # value, which reads as stamp 0
+                        request = request[:3] + \
+                                (int.from_bytes(request[3], 'big'),)
+                    elif request_type == self.REPLICATE_BYTEC:
+                        # the table word the primary committed
+                        request = request[:3] + \
+                                TABLE_WORD.unpack(request[3])
+                    elif request_type in self.MULTI_REQUESTS:
+                        # one request per key, to the workers that own them
+                        self.route_multi(*request[:2], request[3],
+                                conn_fileno)
+                        continue
+                    elif request_type in self.DECISIONS:
+                        self.route_decisions(request_type, request[3],
+                                conn_fileno)
+                        continue
+                    elif request_type == self.STATS_BYTEC:
+                        self.answer_stats(request[0], conn_fileno)
+                        continue
                     if self.verbose:
-                        self.show_hex(line, prefix="Received: ",
-                                use_outfile=True)
+                        self.show_hex(routed.pack(*request, conn_fileno),
+                                prefix="Received: ", use_outfile=True)
                         self.outfile.flush()
-                    # is this is a commit/abort message?
-                    request_type = line[2:3]
                     if request_type != self.END_BYTEC:
-                        self.request_queue.put((line, conn.fileno()))
+                        batches[request[2] % num_workers].append(
+                                routed.pack(*request, conn_fileno))
                     else:
                         # it's an end; record it
                         num_done += 1
                         message = "Received END #{}\n".format(num_done)
                         self.outfile.write(message)
                         self.outfile.flush()
+                        if stats is not None and \
+                                num_done == self.num_clients:
+                            self.write_stats()
+            self.send_batches()
+            if stats is not None:
+                read = monotonic()
+            if use_ring:
+                self.collect_responses(self.response_channels)
+            else:
+                self.collect_responses(ready_responses)
+            # keys of refused MPUTs to release
+            self.send_batches()
+            if stats is not None:
+                collected = monotonic()
+            self.flush_outputs()
+            if stats is not None:
+                stats.pass_done(started, read, collected)
+
+    def send_batches(self):
+        """Hands each worker the requests batched for it, with one pipe or
+        ring write per worker"""
+        use_ring = self.transport == 'ring'
+        for worker_id, batch in enumerate(self.batches):
+            if batch:
+                # waiting for room may batch more requests
+                message = b''.join(batch)
+                batch.clear()
+                if self.stats is not None:
+                    # before the worker can see them
+                    self.stats.requests_sent(worker_id + 1)
+                if use_ring:
+                    self.request_channels[worker_id].put(message,
+                            self.wait_for_room)
+                else:
+                    self.unsent[worker_id] += message
+                    self.write_requests(worker_id)
+
+    def route_multi(self, message_id, request_type, entries, conn_fileno):
+        """Batches one request for each key of a multi-key request
+
+        Every worker gets its keys in ascending order, so two multi-key
+        requests never take the same keys' pending marks in different
+        orders."""
+        num_workers = self.num_workers
+        routed = self.wire.routed
+        key_type = self.MULTI_REQUESTS[request_type]
+        entries = sorted(self.wire.entry.iter_unpack(entries))
+        multi = None
+        if request_type in (self.MGET_BYTEC, self.MPUT_BYTEC):
+            multi = MultiRequest(request_type, [key for key, value in
+                    entries], num_workers)
+            if not entries:
+                self.finish_multi(message_id, conn_fileno, multi)
+                return
+            self.multi[conn_fileno, message_id] = multi
+        for index, (key, value) in enumerate(entries):
+            worker_id = key % num_workers
+            self.batches[worker_id].append(routed.pack(message_id, key_type,
+                    key, value, conn_fileno))
+            if multi is not None:
+                multi.order[worker_id].append(index)
+
+    def route_decisions(self, request_type, entries, conn_fileno):
+        """Batches a commit or abort for each PUT of a COMMIT_MANY or
+        ABORT_MANY; each worker gets all of its PUTs in one write"""
+        num_workers = self.num_workers
+        routed = self.wire.routed
+        key_type = self.DECISIONS[request_type]
+        batches = self.batches
+        for message_id, key, value in self.wire.decision.iter_unpack(
+                entries):
+            batches[key % num_workers].append(routed.pack(message_id,
+                    key_type, key, value, conn_fileno))
+
+    def gather_multi(self, worker_id, multi, message_id, response_type,
+            value, version, conn_fileno):
+        """Records a worker's answer for one key of a multi-key request,
+        and answers the request once every key has been answered"""
+        multi.results[multi.order[worker_id].popleft()] = (response_type,
+                value, version)
+        multi.remaining -= 1
+        if not multi.remaining:
+            del self.multi[conn_fileno, message_id]
+            self.finish_multi(message_id, conn_fileno, multi)
+
+    def finish_multi(self, message_id, conn_fileno, multi):
+        """Answers a multi-key request whose keys have all been answered"""
+        output = self.outputs[conn_fileno]
+        now = monotonic()
+        if multi.request_type == self.MGET_BYTEC:
+            # every value and version, in ascending key order
+            payload = b''.join([MULTI_RESULT.pack(value, version)
+                    for response_type, value, version in multi.results])
+            output.append(self.wire.value_response.pack(message_id,
+                    self.VALUE_BYTEC, 0, len(payload)), now)
+            output.append(payload, now)
+            return
+        response_type = self.ACK_BYTEC
+        if any(result[0] != self.ACK_BYTEC for result in multi.results):
+            # all or nothing: release the keys we did get, then refuse
+            response_type = self.CANCEL_BYTEC
+            routed = self.wire.routed
+            for key, result in zip(multi.keys, multi.results):
+                if result[0] == self.ACK_BYTEC:
+                    self.batches[key % self.num_workers].append(routed.pack(
+                            message_id, self.CANCEL_BYTEC, key, 0,
+                            conn_fileno))
+        output.append(self.wire.response.pack(message_id, response_type, 0,
+                0), now)
+
+    def connect_peers(self):
+        """Opens a link to every other server, for the REPLICATEs of the
+        keys we're the primary for"""
+        port = self.server_settings[1]
+        for index, host in enumerate(self.clients):
+            if index == self.node_n:
+                continue
+            tries = 0
+            while True:
+                peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                if not peer.connect_ex((host, port)):
+                    break
+                peer.close()
+                tries += 1
+                if tries > self.max_retries:
+                    raise ConnectionError("can't reach server {}".format(
+                            host))
+                # it may not be listening yet
+                sleep(1)
+            self.peers[index] = peer
+            self.outfile.write("Linked to server {}{}".format(host,
+                    os.linesep))
+            self.outfile.flush()
+
+    def replicate(self, key, message_id, value, version, conn_fileno):
+        """Pushes a PUT we committed as the key's primary to its other
+        replicas; it's acknowledged once they've all applied it"""
+        peers = [self.peers[index] for index in self.placement.replicas(key)
+                if index != self.node_n]
+        now = monotonic()
+        if not peers:
+            self.outputs[conn_fileno].append(self.wire.response.pack(
+                    message_id, self.ACK_BYTEC, 0, version), now)
+            return
+        # our own message IDs on the links to the other servers
+        replicate_id = self.replicate_id
+        self.replicate_id = (replicate_id + 1) % 2 ** (8 * self.wire.id_bytes)
+        self.replicating[replicate_id] = [conn_fileno, message_id, version,
+                len(peers)]
+        word = TABLE_WORD.pack(value | version << 32)
+        request = frame(self.wire.value_request.pack(replicate_id,
+                self.REPLICATE_BYTEC, key, len(word)) + word, VALUE_FRAME)
+        for peer in peers:
+            # pipelined: sent with the next flush, without waiting for
+            # earlier REPLICATEs to be acknowledged
+            self.outputs[peer.fileno()].append(request, now)
+
+    def replicated(self, reader):
+        """Acknowledges every PUT whose replicas have all acknowledged
+        its REPLICATE"""
+        response = self.wire.response
+        now = monotonic()
+        for replicate_id, response_type, value, version in \
+                reader.responses(self.wire, self.VALUE_BYTEC):
+            waiting = self.replicating[replicate_id]
+            waiting[3] -= 1
+            if waiting[3]:
+                continue
+            del self.replicating[replicate_id]
+            conn_fileno, message_id, version = waiting[:3]
+            self.outputs[conn_fileno].append(response.pack(message_id,
+                    self.ACK_BYTEC, 0, version), now)
+
+    def write_requests(self, worker_id):
+        """Writes as many of a worker's unsent requests as its pipe has room
+        for, without blocking"""
+        unsent = self.unsent[worker_id]
+        try:
+            nbytes = os.write(self.request_channels[worker_id], unsent)
+        except BlockingIOError:
+            return
+        del unsent[:nbytes]
+
+    def collect_responses(self, channels):
+        """Moves the responses waiting in the given response channels into
+        the output buffers of the connections they're for"""
+        use_ring = self.transport == 'ring'
+        for channel in channels:
+            worker_id = self.response_channels.index(channel)
+            if self.stats is not None:
+                self.stats.replies_read(worker_id + 1)
+            if use_ring:
+                view = channel.get(block=False)
+                while len(view):
+                    self.buffer_responses(worker_id, view)
+                    channel.consume(len(view))
+                    view = channel.get(block=False)
+            else:
+                reader = self.response_readers[worker_id]
+                nbytes = os.readv(channel, [reader.get_buffer()])
+                reader.buffer_updated(nbytes)
+                self.buffer_responses(worker_id, reader.records(
+                        self.wire.routed_response.size))
+
+    def buffer_responses(self, worker_id, records):
+        """Adds a worker's responses to their connections' output buffers"""
+        response = self.wire.response
+        now = monotonic()
+        multi = self.multi
+        writes = self.writes
+        # output buffers holding views of slab values
+        viewing = set()
+        for message_id, response_type, value, version, conn_fileno in \
+                self.wire.routed_response.iter_unpack(records):
+            if multi and (conn_fileno, message_id) in multi:
+                self.gather_multi(worker_id, multi[conn_fileno, message_id],
+                        message_id, response_type, value, version,
+                        conn_fileno)
+                continue
+            if writes and (conn_fileno, message_id) in writes:
+                # committed; answered once the replicas have it too
+                self.replicate(writes.pop((conn_fileno, message_id)),
+                        message_id, value, version, conn_fileno)
+                continue
+            output = self.outputs[conn_fileno]
+            if response_type == self.VALUE_BYTEC:
+                # send the value straight from the slab; the worker won't
+                # free it until we've acked these records
+                value = value and self.slabs[worker_id].view(value) or b''
+                output.append(self.wire.value_response.pack(message_id,
+                        response_type, version, len(value)), now)
+                output.append_view(value, now)
+                viewing.add(output)
+            else:
+                output.append(response.pack(message_id, response_type,
+                        value, version), now)
+                if len(output) >= self.flush_size and not output.blocked:
+                    self.flush_output(output)
+        # the views have to be written, or copied if a connection has no
+        # room for them, before the worker may reuse their slab space
+        for output in viewing:
+            self.flush_output(output)
+        # tell the worker which of its responses we're done with
+        self.acked[worker_id] += len(records)
 
-    @staticmethod
-    def respond(conn, message_id, response_type, data=b''):
-        """Responds with bytecode for yes/no + any additional data
-        that was requested by the client (if any)"""
-        message_id = message_id.to_bytes(2, byteorder='big')
-        if data != b'':
-            data = data.to_bytes(2, byteorder='big')
-        conn.sendall(message_id + response_type + data)
+    def answer_stats(self, message_id, conn_fileno):
+        """Answers a STATS request with a VALUE response holding a snapshot
+        of our stats"""
+        use_ring = self.transport == 'ring'
+        routed = self.wire.routed
+        routed_response = self.wire.routed_response
+        depths = []
+        for worker_id in range(self.num_workers):
+            requests = self.request_channels[worker_id]
+            responses = self.response_channels[worker_id]
+            if use_ring:
+                depths.append((len(requests) // routed.size,
+                        len(responses) // routed_response.size))
+                continue
+            reader = self.response_readers[worker_id]
+            depths.append(((unread_bytes(requests) +
+                    len(self.unsent[worker_id])) // routed.size,
+                    (unread_bytes(responses) + reader.end - reader.start) //
+                    routed_response.size))
+        payload = pack_snapshot(monotonic() - self.start_time, depths,
+                sum(self.handled), self.stats)
+        now = monotonic()
+        output = self.outputs[conn_fileno]
+        output.append(self.wire.value_response.pack(message_id,
+                self.VALUE_BYTEC, 0, len(payload)), now)
+        output.append(payload, now)
+
+    def write_stats(self):
+        """Writes every stage's latency percentiles and the counters to
+        <hostname>_stats.json, next to our output file"""
+        filename = os.path.join(os.getenv("OUTPUT_DIR"),
+                self.hostname + "_stats.json")
+        with open(filename + '.tmp', 'w') as fh:
+            json.dump(self.stats.summary(), fh)
+        os.replace(filename + '.tmp', filename)
+
+    def flush_timeout(self):
+        """Returns how long until the oldest buffered response is due to be
+        written, or None if nothing is buffered"""
+        since = [output.since for output in self.outputs.values() if
+                len(output) and not output.blocked]
+        if not since:
+            return None
+        return max(0, min(since) + self.flush_latency - monotonic())
+
+    def flush_outputs(self):
+        """Writes every output buffer whose oldest response is due, except
+        those waiting for their connection to be writable"""
+        now = monotonic()
+        for output in self.outputs.values():
+            if len(output) and not output.blocked and \
+                    now - output.since >= self.flush_latency:
+                self.flush_output(output)
+
+    def flush_output(self, output):
+        if self.verbose:
+            for buffer in output.buffers:
+                self.show_hex(bytes(buffer), prefix="Sending: ",
+                        use_outfile=True)
+        output.flush()
+
+    def store_value(self, worker_id, value):
+        """Copies a PUTV value into a worker's slab; returns its slab
+        reference, or 0 if it can't be stored"""
+        if self.slabs is None:
+            return 0
+        return self.slabs[worker_id].store(value)
 
     def show_hex(self, data, prefix='', suffix='', use_outfile=False):
         """For debugging socket messages"""
@@ -272,22 +1153,16 @@ class Server(Process):
         else:
             print(prefix + ' '.join(data) + suffix)
 
-    @staticmethod
-    def split_multiline(data):
-        """Returns the next parsed line of multiline input"""
-        assert not len(data) % 7, "Got bad message length"
-        while len(data):
-            yield data[:7]
-            data = data[7:]
-
-    @staticmethod
-    def parse_multiline(data):
-        """Returns the next parsed line of multiline input"""
-        assert not len(data) % 7, "Got bad message length"
-        while len(data):
-            message_id   = int.from_bytes(data[:2], byteorder='big')
-            request_type = data[2:3]
-            key          = int.from_bytes(data[3:5], byteorder='big')
-            value        = int.from_bytes(data[5:7], byteorder='big')
-            yield message_id, request_type, key, value
-            data = data[7:]
+    def read_requests(self, reader):
+        """Yields each complete (message_id, request_type, key, value)
+        request in a connection's buffer; the values of GETV/PUTV requests
+        are views into the buffer"""
+        request = self.wire.request
+        if self.framing:
+            for frame_kind, payload in reader.frames():
+                if frame_kind == VALUE_FRAME:
+                    yield from self.wire.value_requests(payload)
+                else:
+                    yield from request.iter_unpack(payload)
+        else:
+            yield from request.iter_unpack(reader.records(request.size))
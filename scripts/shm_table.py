@@ -0,0 +1,383 @@
+"""Open-addressing hash table in shared memory
+
+Keys and values are unsigned 64-bit integers. Slots are found by linear
+probing from a splitmix64 hash of the key, and deleted slots become
+tombstones so that probe chains stay intact.
+
+When live entries plus tombstones pass max_load, a new segment is
+allocated (twice the size, unless most of the load is tombstones) and the
+old entries move over a few slots at a time on every write, so no single
+request pays for the whole rehash. Lookups check the new segment first and
+fall back to the old one until the move is done.
+
+The current and old segment names live in a small control segment, so any
+process can attach to the table by name and follows resizes made by other
+processes. Writers must be serialized: either only one process writes
+(each Worker owns a partition), or every process passes the same lock.
+
+Readers don't take the lock. Every write makes the sequence number at the
+front of the control segment odd while it's changing the table, and even
+again once it's done (a seqlock), so a reader that saw the number change
+under it (a torn control block, or a key caught between the old and new
+segments) reads again. A segment can also be unlinked between a reader
+reading its name and attaching to it; that reader starts over too."""
+import struct
+from multiprocessing import shared_memory
+from placement import mix64
+
+# slot states
+EMPTY = 0
+FULL = 1
+TOMBSTONE = 2
+
+# sequence number, then generation, capacity, size, tombstones,
+# old_capacity, migrate_pos, current segment name, old segment name
+SEQUENCE = struct.Struct('=Q')
+CONTROL = struct.Struct('=6Q32s32s')
+CONTROL_OFFSET = SEQUENCE.size
+GENERATION = struct.Struct('=Q')
+
+# slots moved from the old segment on every write during a resize
+MIGRATE_BATCH = 16
+
+class Segment:
+    """One array of slots: a state byte, a key and a value for each"""
+    def __init__(self, capacity, name=None):
+        self.capacity = capacity
+        self.mask = capacity - 1
+        # keys and values first, so they stay 8-byte aligned
+        size = capacity * 17
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.shm.buf[:size] = bytes(size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        buf = self.shm.buf
+        self.keys = buf[:capacity * 8].cast('Q')
+        self.values = buf[capacity * 8:capacity * 16].cast('Q')
+        self.states = buf[capacity * 16:size]
+        self.nbytes = size
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def find(self, key):
+        """Returns the slot holding key, or -1"""
+        keys = self.keys
+        states = self.states
+        mask = self.mask
+        slot = mix64(key) & mask
+        while True:
+            state = states[slot]
+            if state == EMPTY:
+                return -1
+            if state == FULL and keys[slot] == key:
+                return slot
+            slot = (slot + 1) & mask
+
+    def insert(self, key, value):
+        """Stores a key known not to be in the segment; returns whether a
+        tombstone was reused"""
+        states = self.states
+        mask = self.mask
+        slot = mix64(key) & mask
+        while states[slot] == FULL:
+            slot = (slot + 1) & mask
+        reused = states[slot] == TOMBSTONE
+        self.keys[slot] = key
+        self.values[slot] = value
+        states[slot] = FULL
+        return reused
+
+    def close(self):
+        if not hasattr(self, 'states'):
+            # the segment couldn't be attached
+            return
+        # views first, or the mapping can't be closed
+        self.keys.release()
+        self.values.release()
+        self.states.release()
+        self.shm.close()
+
+    __del__ = close
+
+class ShmHashTable:
+    """Maps 64-bit keys to 64-bit values; a missing key reads as 0, just
+    like an untouched slot of the RawArray table"""
+    def __init__(self, capacity=1024, max_load=0.7, lock=None, name=None):
+        self.max_load = max_load
+        # serializes writers that share the table; None if there's only one
+        self.lock = lock
+        if name is None:
+            self.control = shared_memory.SharedMemory(create=True,
+                    size=SEQUENCE.size + CONTROL.size)
+            # power of two, so the hash can be masked instead of divided
+            capacity = 1 << max(3, (capacity - 1).bit_length())
+            self.current = Segment(capacity)
+            self.old = None
+            self.generation = 0
+            SEQUENCE.pack_into(self.control.buf, 0, 0)
+            self.write_control(0, capacity, 0, 0, 0, 0)
+        else:
+            self.control = shared_memory.SharedMemory(name=name)
+            self.generation = -1
+            self.current = self.old = None
+            self.refresh()
+
+    @property
+    def name(self):
+        """Other processes attach with ShmHashTable(name=table.name)"""
+        return self.control.name
+
+    def read_control(self):
+        return CONTROL.unpack_from(self.control.buf, CONTROL_OFFSET)
+
+    def write_control(self, generation, capacity, size, tombstones,
+            old_capacity, migrate_pos):
+        old_name = self.old is not None and self.old.name or ''
+        CONTROL.pack_into(self.control.buf, CONTROL_OFFSET, generation,
+                capacity, size, tombstones, old_capacity, migrate_pos,
+                self.current.name.encode(), old_name.encode())
+
+    def read_sequence(self):
+        """Returns the sequence number once no write is in progress"""
+        buf = self.control.buf
+        sequence = SEQUENCE.unpack_from(buf, 0)[0]
+        while sequence & 1:
+            sequence = SEQUENCE.unpack_from(buf, 0)[0]
+        return sequence
+
+    def changed(self, sequence):
+        """Returns whether anything was written since read_sequence()
+        returned sequence"""
+        return SEQUENCE.unpack_from(self.control.buf, 0)[0] != sequence
+
+    def begin_write(self):
+        """Tells readers a write is in progress; the caller holds the
+        lock, if any"""
+        sequence = SEQUENCE.unpack_from(self.control.buf, 0)[0] + 1
+        SEQUENCE.pack_into(self.control.buf, 0, sequence)
+
+    def end_write(self):
+        sequence = SEQUENCE.unpack_from(self.control.buf, 0)[0] + 1
+        SEQUENCE.pack_into(self.control.buf, 0, sequence)
+
+    def refresh(self):
+        """Re-attaches if another process resized the table"""
+        while True:
+            sequence = self.read_sequence()
+            if GENERATION.unpack_from(self.control.buf, CONTROL_OFFSET)[0] \
+                    == self.generation:
+                return
+            control = self.read_control()
+            if self.changed(sequence):
+                # torn; read it again
+                continue
+            if self.attach(control):
+                return
+
+    def attach(self, control):
+        """Maps the segments named in control; returns False if one of
+        them was unlinked before we got to it"""
+        current_name = control[6].rstrip(b'\x00').decode()
+        old_name = control[7].rstrip(b'\x00').decode()
+        segments = dict()
+        for segment in (self.current, self.old):
+            if segment is not None:
+                segments[segment.name] = segment
+        attached = []
+        try:
+            current = segments.pop(current_name, None)
+            if current is None:
+                current = Segment(control[1], current_name)
+                attached.append(current)
+            old = None
+            if old_name:
+                old = segments.pop(old_name, None)
+                if old is None:
+                    old = Segment(control[4], old_name)
+                    attached.append(old)
+        except FileNotFoundError:
+            # a resize finished meanwhile; the control block has moved on
+            for segment in attached:
+                segment.close()
+            return False
+        self.current = current
+        self.old = old
+        for segment in segments.values():
+            # dropped by whoever finished the resize
+            segment.close()
+        self.generation = control[0]
+        return True
+
+    def unlink(self):
+        """Removes the table's segments once no process needs them"""
+        for segment in (self.current, self.old):
+            if segment is not None:
+                segment.shm.unlink()
+        self.control.unlink()
+
+    def __len__(self):
+        return self.read_control()[2]
+
+    def __contains__(self, key):
+        while True:
+            sequence = self.read_sequence()
+            found = self.lookup(key)[0] is not None
+            if not self.changed(sequence):
+                return found
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        if self.lock is not None:
+            with self.lock:
+                self.put(key, value)
+        else:
+            self.put(key, value)
+
+    def __delitem__(self, key):
+        if self.lock is not None:
+            with self.lock:
+                self.delete(key)
+        else:
+            self.delete(key)
+
+    def lookup(self, key):
+        """Returns (segment, slot) for key, or (None, -1); only reliable
+        for writers, or between read_sequence() and changed()"""
+        self.refresh()
+        for segment in (self.current, self.old):
+            if segment is not None:
+                slot = segment.find(key)
+                if slot >= 0:
+                    return segment, slot
+        return None, -1
+
+    def get(self, key, default=0):
+        while True:
+            sequence = self.read_sequence()
+            segment, slot = self.lookup(key)
+            value = default
+            if segment is not None:
+                value = segment.values[slot]
+            if not self.changed(sequence):
+                return value
+
+    def items(self):
+        """Yields every (key, value); the table mustn't change meanwhile"""
+        self.refresh()
+        # moved entries leave tombstones, so no key shows up twice
+        for segment in (self.current, self.old):
+            if segment is not None:
+                for slot in range(segment.capacity):
+                    if segment.states[slot] == FULL:
+                        yield segment.keys[slot], segment.values[slot]
+
+    def put(self, key, value):
+        """Inserts or updates key; the caller holds the lock, if any"""
+        self.refresh()
+        self.begin_write()
+        (generation, capacity, size, tombstones, old_capacity,
+                migrate_pos) = self.read_control()[:6]
+        if self.old is not None:
+            migrate_pos, tombstones = self.migrate(migrate_pos, tombstones)
+        current = self.current
+        slot = current.find(key)
+        if slot >= 0:
+            current.values[slot] = value
+        else:
+            old_slot = -1
+            if self.old is not None:
+                old_slot = self.old.find(key)
+            if old_slot >= 0:
+                # not moved yet; move it now
+                self.old.states[old_slot] = TOMBSTONE
+                size -= 1
+            if current.insert(key, value):
+                tombstones -= 1
+            size += 1
+        if self.old is not None and migrate_pos >= old_capacity:
+            # everything has moved; drop the old segment
+            self.old.shm.unlink()
+            self.old.close()
+            self.old = None
+            old_capacity = migrate_pos = 0
+            generation += 1
+        elif self.old is None and \
+                size + tombstones > self.max_load * capacity:
+            generation, capacity, tombstones, old_capacity, migrate_pos = \
+                    self.start_resize(generation, capacity, size)
+        self.generation = generation
+        self.write_control(generation, capacity, size, tombstones,
+                old_capacity, migrate_pos)
+        self.end_write()
+
+    def delete(self, key):
+        """Removes key if present; the caller holds the lock, if any"""
+        segment, slot = self.lookup(key)
+        if segment is None:
+            return
+        self.begin_write()
+        segment.states[slot] = TOMBSTONE
+        control = list(self.read_control())
+        # live entries
+        control[2] -= 1
+        if segment is self.current:
+            control[3] += 1
+        self.write_control(*control[:6])
+        self.end_write()
+
+    def start_resize(self, generation, capacity, size):
+        """Allocates the segment that the current one will move into"""
+        new_capacity = capacity
+        # grow only if live entries, not tombstones, fill the table
+        if size > self.max_load * capacity / 2:
+            new_capacity = capacity * 2
+        self.old = self.current
+        self.current = Segment(new_capacity)
+        return generation + 1, new_capacity, 0, capacity, 0
+
+    def migrate(self, migrate_pos, tombstones):
+        """Moves the next MIGRATE_BATCH slots of the old segment"""
+        old = self.old
+        current = self.current
+        end = min(migrate_pos + MIGRATE_BATCH, old.capacity)
+        for slot in range(migrate_pos, end):
+            if old.states[slot] == FULL:
+                if current.insert(old.keys[slot], old.values[slot]):
+                    tombstones -= 1
+                # leave a tombstone so later probes in old still work
+                old.states[slot] = TOMBSTONE
+        return end, tombstones
+
+    def footprint(self):
+        """Returns the number of bytes of shared memory the table maps"""
+        nbytes = SEQUENCE.size + CONTROL.size + self.current.nbytes
+        if self.old is not None:
+            nbytes += self.old.nbytes
+        return nbytes
+
+    def stats(self):
+        """Returns occupancy figures for the table"""
+        self.refresh()
+        control = self.read_control()
+        return {
+            'capacity': control[1],
+            'size': control[2],
+            'tombstones': control[3],
+            'resizing': control[4] > 0,
+            'load': (control[2] + control[3]) / control[1],
+            'bytes': self.footprint()
+        }
+
+class ShmIndicatorTable(ShmHashTable):
+    """ShmHashTable for flags: writing 0 deletes the key, so keys that are
+    no longer flagged don't take up space"""
+    def __setitem__(self, key, value):
+        if value:
+            super(ShmIndicatorTable, self).__setitem__(key, value)
+        else:
+            self.__delitem__(key)
@@ -0,0 +1,145 @@
+"""Size-class slab allocator for variable-length values in shared memory
+
+Each size class is one multiprocessing.shared_memory segment cut into
+equal slots (64 bytes, 128 bytes, ... up to 64 KiB), plus a stack of the
+slot numbers that are free. A value goes in the smallest slot that fits
+it, so allocating or freeing is a stack push or pop, and nothing is ever
+compacted.
+
+Where a value lives is packed into a single 64-bit reference: the size
+class, the slot number and the value's length. That is all a table needs
+to store, and a reference of 0 never points at a value.
+
+Segments must be created before forking. Allocations and frees must be
+serialized: pass a lock if more than one process does either."""
+import struct
+from array import array
+from multiprocessing import shared_memory
+
+# smallest slot; each size class is twice as big as the one before
+MIN_SLOT_BITS = 6
+NUM_CLASSES = 11
+SIZE_CLASSES = tuple(1 << (MIN_SLOT_BITS + i) for i in range(NUM_CLASSES))
+
+# number of free slots, at the start of each segment
+TOP = struct.Struct('=Q')
+
+# reference layout: size class + 1 | slot | length
+CLASS_SHIFT = 56
+SLOT_SHIFT = 24
+SLOT_MASK = (1 << 32) - 1
+LENGTH_MASK = (1 << SLOT_SHIFT) - 1
+
+class SizeClass:
+    """num_slots slots of slot_size bytes, and the stack of free slots"""
+    def __init__(self, slot_size, num_slots):
+        self.slot_size = slot_size
+        self.num_slots = num_slots
+        # keep the slots cache-line aligned
+        stack_size = -(-(TOP.size + num_slots * 4) // 64) * 64
+        self.shm = shared_memory.SharedMemory(create=True,
+                size=stack_size + slot_size * num_slots)
+        self.buf = self.shm.buf
+        self.free_slots = self.buf[TOP.size:TOP.size + num_slots * 4].cast('I')
+        # hand out low slots first
+        self.free_slots[:] = array('I', range(num_slots - 1, -1, -1))
+        TOP.pack_into(self.buf, 0, num_slots)
+        self.slots = self.buf[stack_size:]
+        self.nbytes = self.shm.size
+
+    def available(self):
+        return TOP.unpack_from(self.buf, 0)[0]
+
+    def alloc(self):
+        """Returns a free slot number, or -1 if the class is full"""
+        top = TOP.unpack_from(self.buf, 0)[0]
+        if not top:
+            return -1
+        top -= 1
+        TOP.pack_into(self.buf, 0, top)
+        return self.free_slots[top]
+
+    def free(self, slot):
+        top = TOP.unpack_from(self.buf, 0)[0]
+        self.free_slots[top] = slot
+        TOP.pack_into(self.buf, 0, top + 1)
+
+    def view(self, slot, length):
+        start = slot * self.slot_size
+        return self.slots[start:start + length]
+
+    def close(self):
+        # views first, or the mapping can't be closed
+        if self.buf is not None:
+            self.free_slots.release()
+            self.slots.release()
+            self.buf = None
+            self.shm.close()
+
+    __del__ = close
+
+class SlabAllocator:
+    """Stores values of up to 64 KiB in shared memory, class_bytes bytes of
+    slots per size class"""
+    def __init__(self, class_bytes, lock=None):
+        self.classes = [SizeClass(slot_size, max(1, class_bytes // slot_size))
+                for slot_size in SIZE_CLASSES]
+        # serializes allocations and frees; None if one process does both
+        self.lock = lock
+
+    @staticmethod
+    def size_class(length):
+        """Returns the index of the smallest size class that fits length"""
+        return max(0, (length - 1).bit_length() - MIN_SLOT_BITS)
+
+    def store(self, data):
+        """Copies data into a free slot and returns its reference, or 0 if
+        it's too big or its size class is full"""
+        length = len(data)
+        index = self.size_class(length)
+        if index >= NUM_CLASSES:
+            return 0
+        size_class = self.classes[index]
+        if self.lock is not None:
+            with self.lock:
+                slot = size_class.alloc()
+        else:
+            slot = size_class.alloc()
+        if slot < 0:
+            return 0
+        size_class.view(slot, length)[:] = data
+        return (index + 1) << CLASS_SHIFT | slot << SLOT_SHIFT | length
+
+    def view(self, ref):
+        """Returns a memoryview of the value that ref points at"""
+        size_class = self.classes[(ref >> CLASS_SHIFT) - 1]
+        return size_class.view(ref >> SLOT_SHIFT & SLOT_MASK,
+                ref & LENGTH_MASK)
+
+    @staticmethod
+    def length(ref):
+        return ref & LENGTH_MASK
+
+    def free(self, ref):
+        """Returns ref's slot to its size class"""
+        size_class = self.classes[(ref >> CLASS_SHIFT) - 1]
+        if self.lock is not None:
+            with self.lock:
+                size_class.free(ref >> SLOT_SHIFT & SLOT_MASK)
+        else:
+            size_class.free(ref >> SLOT_SHIFT & SLOT_MASK)
+
+    def unlink(self):
+        """Removes the segments' names; processes that already have them
+        mapped keep using them"""
+        for size_class in self.classes:
+            size_class.shm.unlink()
+
+    def footprint(self):
+        """Returns the number of bytes of shared memory the slabs map"""
+        return sum(size_class.nbytes for size_class in self.classes)
+
+    def stats(self):
+        """Returns (slot_size, slots, free slots) for every size class"""
+        return [(size_class.slot_size, size_class.num_slots,
+                size_class.available()) for size_class in self.classes]
@@ -0,0 +1,302 @@
+"""Per-stage latency histograms and counters in shared memory
+
+A Stats is created by the dispatcher before it forks its workers, and has
+a slot per process: slot 0 is the dispatcher's, and slot worker_id + 1 is
+each worker's. Every histogram and counter has exactly one process that
+writes it, so nothing is locked; a reader may see a snapshot that's a few
+updates behind.
+
+Histograms are log-linear (like HdrHistogram): values below 2 * SUB get a
+bucket each, and every power of two above that is split into SUB
+buckets, so a bucket is never wider than 1 / SUB of the values in it.
+Latencies are recorded in microseconds.
+
+Stages, and who records them:
+    read            dispatcher: reading requests and handing them to the
+                    workers, per pass (its count is the number of passes)
+    request_queue   worker: oldest unread batch's wait in its pipe or ring
+    batch           worker: requests per batch it read (not a latency)
+    handle          worker: applying a batch to the table
+    response_queue  dispatcher, in the worker's slot: oldest unread
+                    responses' wait in the worker's pipe or ring
+    collect         dispatcher: buffering workers' responses, per pass
+    flush           dispatcher: writing buffered responses to clients
+
+The queue stages are timed with a timestamp per channel that the sender
+sets when it's clear and the receiver takes and clears, so they sample
+the oldest unread batch rather than timing every one."""
+import struct
+from ctypes import c_ulonglong, c_double
+from multiprocessing import RawArray
+from time import monotonic
+
+# every power of two is split into SUB buckets
+SUB_BITS = 4
+SUB = 1 << SUB_BITS
+
+STAGES = (
+    'read',
+    'request_queue',
+    'batch',
+    'handle',
+    'response_queue',
+    'collect',
+    'flush'
+)
+READ, REQUEST_QUEUE, BATCH, HANDLE, RESPONSE_QUEUE, COLLECT, FLUSH = \
+        range(len(STAGES))
+
+COUNTERS = (
+    'requests', # requests a worker handled
+    'empties',  # EMPTY responses a worker sent
+    'cancels',  # CANCEL responses
+    # gauges, as of a worker's last batch
+    'pending',  # keys with a PUT pending 2-phase-commit
+    'keys'      # keys that have a value
+)
+REQUESTS, EMPTIES, CANCELS, PENDING, KEYS = range(len(COUNTERS))
+
+# the counter of each response type that's counted
+RESPONSE_COUNTERS = {
+    b'\x00': EMPTIES,
+    b'\x18': CANCELS
+}
+
+# the timestamps of each slot's channels
+REQUESTS_SENT = 0
+REPLIES_SENT = 1
+
+# latency percentiles in summaries
+PERCENTILES = (
+    ('p50', 0.5),
+    ('p99', 0.99),
+    ('p99.9', 0.999)
+)
+
+# a STATS answer: SNAPSHOT_HEADER (format version, whether the server
+# records stats, seconds it's been up, number of workers, counters and
+# histogram entries), then each worker's request and response queue
+# depths in records, every counter, and a HISTOGRAM_ENTRY for each nonzero
+# bucket of every stage
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('>BBdHBH')
+QUEUE_DEPTHS = struct.Struct('>II')
+COUNTER = struct.Struct('>Q')
+# stage, bucket, count
+HISTOGRAM_ENTRY = struct.Struct('>BHQ')
+
+def bucket(value):
+    """Returns the histogram bucket of a non-negative integer"""
+    if value < 2 * SUB:
+        return value
+    shift = value.bit_length() - SUB_BITS - 1
+    return min(NUM_BUCKETS - 1, (shift << SUB_BITS) + (value >> shift))
+
+def bucket_floor(index):
+    """Returns the smallest value in a histogram bucket"""
+    if index < 2 * SUB:
+        return index
+    shift = (index >> SUB_BITS) - 1
+    return (index - (shift << SUB_BITS)) << shift
+
+# microseconds up to 2 ** 32 (over an hour) fit; larger values go in the
+# last bucket
+NUM_BUCKETS = (32 - SUB_BITS + 1) * SUB
+SLOT_SIZE = len(COUNTERS) + len(STAGES) * NUM_BUCKETS
+
+def percentile(histogram, fraction):
+    """Returns the bucket floor below which fraction of a histogram's
+    values fall"""
+    target = fraction * sum(histogram)
+    seen = 0
+    for index, count in enumerate(histogram):
+        seen += count
+        if count and seen >= target:
+            return bucket_floor(index)
+    return 0
+
+def summarize(counters, histograms):
+    """Returns counters and histograms (lists by COUNTERS and STAGES, e.g.
+    from Stats.totals) as a dict of counts and percentiles"""
+    stages = dict()
+    for name, histogram in zip(STAGES, histograms):
+        count = sum(histogram)
+        if not count:
+            continue
+        stages[name] = dict((label, percentile(histogram, fraction))
+                for label, fraction in PERCENTILES)
+        stages[name]['max'] = bucket_floor(max(index for index, count in
+                enumerate(histogram) if count))
+        stages[name]['count'] = count
+    return {
+        'counters': dict(zip(COUNTERS, counters)),
+        'stages_us': stages
+    }
+
+class Stats:
+    """Counters and a histogram per stage for each of num_slots
+    processes"""
+    def __init__(self, num_slots):
+        self.num_slots = num_slots
+        self.array = RawArray(c_ulonglong, num_slots * SLOT_SIZE)
+        # updated through a memoryview, which is quicker than the ctypes
+        # array
+        self.values = memoryview(self.array).cast('B').cast('Q')
+        # when the oldest unread batch was sent on each slot's request
+        # and response channels; 0 while there's none
+        self.stamps = RawArray(c_double, 2 * num_slots)
+        self.stamp_values = memoryview(self.stamps).cast('B').cast('d')
+        # when the batch each worker is handling was read; private to the
+        # process that owns the slot
+        self.started = [0] * num_slots
+
+    def count(self, slot, counter, amount=1):
+        self.values[slot * SLOT_SIZE + counter] += amount
+
+    def record(self, slot, stage, value):
+        """Adds value to a stage's histogram"""
+        # bucket(value), inlined
+        if value >= 2 * SUB:
+            shift = value.bit_length() - SUB_BITS - 1
+            value = min(NUM_BUCKETS - 1, (shift << SUB_BITS) +
+                    (value >> shift))
+        self.values[slot * SLOT_SIZE + len(COUNTERS) +
+                stage * NUM_BUCKETS + value] += 1
+
+    # the hooks below are called once per batch or dispatcher pass; each
+    # does everything that needs doing then in one call
+
+    def batch_read(self, slot):
+        """A worker read a batch of requests; times its wait in the
+        request channel, and starts timing its handling"""
+        now = monotonic()
+        self.started[slot] = now
+        index = 2 * slot + REQUESTS_SENT
+        sent = self.stamp_values[index]
+        if sent:
+            self.stamp_values[index] = 0
+            self.record(slot, REQUEST_QUEUE, int((now - sent) * 1e6))
+
+    def batch_handled(self, slot, num_requests, num_pending, num_keys):
+        """A worker applied the num_requests requests of a batch, which
+        left it with num_pending pending keys and num_keys keys"""
+        self.record(slot, HANDLE,
+                int((monotonic() - self.started[slot]) * 1e6))
+        self.record(slot, BATCH, num_requests)
+        values = self.values
+        base = slot * SLOT_SIZE
+        values[base + REQUESTS] += num_requests
+        values[base + PENDING] = num_pending
+        values[base + KEYS] = num_keys
+
+    def replies_sent(self, slot, types):
+        """A worker is about to hand the dispatcher responses; types holds
+        each one's response type byte"""
+        for response_type, counter in RESPONSE_COUNTERS.items():
+            amount = types.count(response_type)
+            if amount:
+                self.values[slot * SLOT_SIZE + counter] += amount
+        self.stamp(slot, REPLIES_SENT)
+
+    def requests_sent(self, slot):
+        """The dispatcher handed a worker a batch"""
+        self.stamp(slot, REQUESTS_SENT)
+
+    def replies_read(self, slot):
+        """The dispatcher is reading a worker's responses; times their wait
+        in the response channel"""
+        index = 2 * slot + REPLIES_SENT
+        sent = self.stamp_values[index]
+        if sent:
+            self.stamp_values[index] = 0
+            self.record(slot, RESPONSE_QUEUE,
+                    int((monotonic() - sent) * 1e6))
+
+    def pass_done(self, started, read, collected):
+        """The dispatcher finished a pass over its connections and workers,
+        which it started, was done reading requests, and was done
+        collecting responses at the given monotonic() times"""
+        self.record(0, READ, int((read - started) * 1e6))
+        self.record(0, COLLECT, int((collected - read) * 1e6))
+        self.record(0, FLUSH, int((monotonic() - collected) * 1e6))
+
+    def stamp(self, slot, channel):
+        """Notes that a batch was sent on a channel, unless an older one is
+        still unread"""
+        index = 2 * slot + channel
+        if not self.stamp_values[index]:
+            self.stamp_values[index] = monotonic()
+
+    def slot(self, slot):
+        """Returns a copy of a slot's counters and histograms"""
+        values = self.values[slot * SLOT_SIZE:
+                (slot + 1) * SLOT_SIZE].tolist()
+        histograms = values[len(COUNTERS):]
+        return values[:len(COUNTERS)], [histograms[stage * NUM_BUCKETS:
+                (stage + 1) * NUM_BUCKETS] for stage in range(len(STAGES))]
+
+    def totals(self):
+        """Returns the counters and histograms of every slot added up"""
+        values = self.values.tolist()
+        totals = [sum(values[index::SLOT_SIZE]) for index in
+                range(SLOT_SIZE)]
+        histograms = totals[len(COUNTERS):]
+        return totals[:len(COUNTERS)], [histograms[stage * NUM_BUCKETS:
+                (stage + 1) * NUM_BUCKETS] for stage in range(len(STAGES))]
+
+    def summary(self):
+        """Returns every slot's stats added up, as counts and percentiles,
+        and each worker's request count"""
+        summary = summarize(*self.totals())
+        summary['worker_requests'] = [self.slot(slot)[0][REQUESTS]
+                for slot in range(1, self.num_slots)]
+        return summary
+
+def pack_snapshot(uptime, depths, num_requests, stats=None):
+    """Returns a STATS answer; depths holds (request queue, response
+    queue) depths for each worker, num_requests is how many requests the
+    workers have handled, and stats is the server's Stats, or None if it
+    doesn't record any"""
+    entries = []
+    if stats is not None:
+        counters, histograms = stats.totals()
+        for stage, histogram in enumerate(histograms):
+            entries.extend(HISTOGRAM_ENTRY.pack(stage, index, count)
+                    for index, count in enumerate(histogram) if count)
+    else:
+        counters = [0] * len(COUNTERS)
+    # counted even without stats
+    counters[REQUESTS] = num_requests
+    return b''.join([SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION,
+            stats is not None, uptime, len(depths), len(counters),
+            len(entries))] + [QUEUE_DEPTHS.pack(*depth) for depth in depths] +
+            [COUNTER.pack(counter) for counter in counters] + entries)
+
+def unpack_snapshot(payload):
+    """Returns a STATS answer as a dict: enabled, uptime, depths (a
+    (request, response) pair per worker), counters (by COUNTERS) and
+    histograms (a list of NUM_BUCKETS counts per stage)"""
+    version, enabled, uptime, num_workers, num_counters, num_entries = \
+            SNAPSHOT_HEADER.unpack_from(payload, 0)
+    if version != SNAPSHOT_VERSION:
+        raise ValueError("unknown STATS format {}".format(version))
+    offset = SNAPSHOT_HEADER.size
+    depths = [QUEUE_DEPTHS.unpack_from(payload,
+            offset + worker_id * QUEUE_DEPTHS.size)
+            for worker_id in range(num_workers)]
+    offset += num_workers * QUEUE_DEPTHS.size
+    counters = [COUNTER.unpack_from(payload, offset + index * COUNTER.size)[0]
+            for index in range(num_counters)]
+    offset += num_counters * COUNTER.size
+    histograms = [[0] * NUM_BUCKETS for stage in STAGES]
+    for entry in range(num_entries):
+        stage, index, count = HISTOGRAM_ENTRY.unpack_from(payload,
+                offset + entry * HISTOGRAM_ENTRY.size)
+        histograms[stage][index] = count
+    return {
+        'enabled': bool(enabled),
+        'uptime': uptime,
+        'depths': depths,
+        'counters': counters,
+        'histograms': histograms
+    }
@@ -0,0 +1,89 @@
+"""The array table and pending array in a memory-mapped file
+
+The file is a header page followed by the table (one c_ulonglong per
+key, holding its value and version) and the pending array (a c_int per
+key). Workers forked after the file is mapped share it through the page
+cache, just like a RawArray, and a restarted server maps the same file
+and serves the values it holds without loading anything.
+
+The header records the format version, the table size, a CRC32 of the
+table and whether the server shut down cleanly. The flag is cleared as
+soon as the file is mapped and only set again, with a fresh checksum, by
+close(); a file that wasn't closed (the server crashed or was killed) or
+whose table doesn't match its checksum can't be trusted, and its table
+is zeroed. Pending PUTs never survive a restart, so the pending array
+always starts out zeroed."""
+import os
+import mmap
+import struct
+from ctypes import c_int, c_ulonglong, sizeof
+from zlib import crc32
+
+MAGIC = b'DHTT'
+VERSION = 2
+# magic, version, table size, table checksum, clean-shutdown flag
+HEADER = struct.Struct('>4sIQIB')
+# the arrays start on a page of their own
+HEADER_SIZE = mmap.PAGESIZE
+
+class TableFile:
+    """Maps path, creating or resizing it if necessary; table is a
+    c_ulonglong array of num_keys, and pending a c_int array of num_keys"""
+    def __init__(self, path, num_keys):
+        self.path = path
+        self.num_keys = num_keys
+        array_bytes = num_keys * sizeof(c_ulonglong)
+        pending_bytes = num_keys * sizeof(c_int)
+        size = HEADER_SIZE + array_bytes + pending_bytes
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # why the old table couldn't be kept, or 'clean' if it was
+            self.status = self.check(fd, num_keys, array_bytes)
+            if self.status != 'clean' and os.fstat(fd).st_size:
+                # start over from zeros
+                os.ftruncate(fd, 0)
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            # the mapping keeps the file open
+            os.close(fd)
+        self.table = (c_ulonglong * num_keys).from_buffer(self.map,
+                HEADER_SIZE)
+        self.pending = (c_int * num_keys).from_buffer(self.map,
+                HEADER_SIZE + array_bytes)
+        self.map[HEADER_SIZE + array_bytes:] = bytes(pending_bytes)
+        self.write_header(0, False)
+
+    @staticmethod
+    def check(fd, num_keys, array_bytes):
+        """Returns 'clean' if the file's table can be used as it is, or
+        why it can't"""
+        header = os.pread(fd, HEADER.size, 0)
+        if not header:
+            return 'new'
+        if len(header) < HEADER.size:
+            return 'truncated'
+        magic, version, size, checksum, clean = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            return 'unknown format'
+        if size != num_keys:
+            return 'table size changed from {}'.format(size)
+        if not clean:
+            return 'unclean shutdown'
+        table = os.pread(fd, array_bytes, HEADER_SIZE)
+        if len(table) < array_bytes or crc32(table) != checksum:
+            return 'checksum mismatch'
+        return 'clean'
+
+    def write_header(self, checksum, clean):
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.num_keys,
+                checksum, clean)
+        self.map.flush(0, HEADER_SIZE)
+
+    def close(self):
+        """Marks the file clean; nothing may write the table afterwards"""
+        array_bytes = self.num_keys * sizeof(c_ulonglong)
+        # the table has to be on disk before the header vouches for it
+        self.map.flush()
+        checksum = crc32(self.map[HEADER_SIZE:HEADER_SIZE + array_bytes])
+        self.write_header(checksum, True)
@@ -0,0 +1,73 @@
+"""Hashed timing wheel for scheduling many short timers from one thread
+
+Time is cut into ticks, and a timer goes in the slot for the tick it's
+due in (modulo the number of slots), so scheduling a timer is an append,
+and expiring timers only looks at the slots for the ticks that have
+passed. Timers further out than one turn of the wheel share a slot with
+nearer ones and are left there until their own tick comes around.
+
+Timers never fire early, and fire at most one tick late once expire() is
+called."""
+from time import monotonic
+
+class TimerWheel:
+    def __init__(self, tick=0.001, num_slots=512):
+        # seconds per slot
+        self.tick = tick
+        self.num_slots = num_slots
+        # (due_tick, item) for every timer, in the slot of its due tick
+        self.slots = [[] for i in range(num_slots)]
+        # ticks up to this one have expired
+        self.current_tick = int(monotonic() / tick)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def schedule(self, delay, item):
+        """Arranges for expire() to return item delay seconds from now"""
+        due_tick = int((monotonic() + delay) / self.tick) + 1
+        due_tick = max(due_tick, self.current_tick + 1)
+        self.slots[due_tick % self.num_slots].append((due_tick, item))
+        self.size += 1
+
+    def expire(self):
+        """Returns the items of every timer that is due, oldest first"""
+        now_tick = int(monotonic() / self.tick)
+        expired = []
+        if now_tick <= self.current_tick or not self.size:
+            self.current_tick = max(self.current_tick, now_tick)
+            return expired
+        slots = self.slots
+        num_slots = self.num_slots
+        # one turn of the wheel visits every slot
+        first_tick = max(self.current_tick + 1, now_tick - num_slots + 1)
+        for tick in range(first_tick, now_tick + 1):
+            slot = slots[tick % num_slots]
+            if not slot:
+                continue
+            waiting = []
+            for timer in slot:
+                if timer[0] <= now_tick:
+                    expired.append(timer[1])
+                else:
+                    waiting.append(timer)
+            slots[tick % num_slots] = waiting
+        self.current_tick = now_tick
+        self.size -= len(expired)
+        return expired
+
+    def timeout(self):
+        """Returns how many seconds until the next timer is due (0 if one
+        already is), or None if there are no timers"""
+        if not self.size:
+            return None
+        slots = self.slots
+        num_slots = self.num_slots
+        current_tick = self.current_tick
+        for tick in range(current_tick + 1, current_tick + num_slots + 1):
+            for timer in slots[tick % num_slots]:
+                if timer[0] <= tick:
+                    return max(0, tick * self.tick - monotonic())
+        # everything is more than a turn away; check back after a turn
+        return num_slots * self.tick
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# Usage: ./traces.py compile text_trace binary_trace [key_bytes]
+#        ./traces.py show binary_trace
+# Compiles a text trace (e.g. transactions/node_0) into the binary format
+# the client replays with the `trace` config option, or prints a binary
+# trace back as text
+"""Binary traces of client commands
+
+A text trace has a command per line: 'GET key [consistency]' or 'PUT
+key value', optionally preceded by when it was sent, in seconds since
+the trace started (e.g. '0.0125 PUT 5 17'). A GET's consistency is one of
+'one', 'quorum' or 'all', and the client's read_consistency without one.
+Blank lines and lines starting with '#' are skipped.
+
+The compiled trace is a header (magic, format version, key width and
+number of records) followed by a record per command: its offset in
+microseconds, then the command as a request record, exactly as it goes
+on the wire except for the message ID, which is left 0 for the client to
+fill in; a GET's value is its consistency, as in a Workload. A trace
+without offsets replays at the fastest rate either way.
+
+Traces are read through mmap, so replaying one doesn't load it first."""
+import os
+import mmap
+import struct
+from sys import argv, exit
+from protocol import WireFormat
+from workload import CONSISTENCIES, GET, PUT
+
+MAGIC = b'DHTR'
+VERSION = 1
+# magic, version, key_bytes, number of records
+HEADER = struct.Struct('>4sBBI')
+
+# the request types a trace holds, and the workload operations they are
+REQUEST_TYPES = {
+    'GET': b'\x00',
+    'PUT': b'\x01'
+}
+OPS = {
+    b'\x00': GET,
+    b'\x01': PUT
+}
+
+def record_format(key_bytes):
+    """Returns the struct of a record: an offset in microseconds, then a
+    request record"""
+    request = WireFormat(key_bytes).request
+    return struct.Struct('>I' + request.format.lstrip('>'))
+
+def parse_command(fields, key_bytes=2):
+    """Returns the (offset, request_type, key, value) of a text trace line
+    split into fields; raises ValueError if it isn't a valid command"""
+    offset = 0
+    if fields[0] not in REQUEST_TYPES:
+        offset = round(float(fields.pop(0)) * 1e6)
+        if not 0 <= offset < 2 ** 32:
+            raise ValueError("offset out of range")
+    if not fields or fields[0] not in REQUEST_TYPES:
+        raise ValueError("not a GET or PUT")
+    if fields[0] == 'PUT' and len(fields) != 3:
+        raise ValueError("expected 'PUT key value'")
+    if fields[0] == 'GET' and len(fields) not in (2, 3):
+        raise ValueError("expected 'GET key [consistency]'")
+    key = int(fields[1])
+    if not 0 <= key < 2 ** (8 * key_bytes):
+        raise ValueError("key out of range")
+    value = 0
+    if fields[0] == 'PUT':
+        value = int(fields[2])
+        if not 0 <= value < 2 ** 16:
+            raise ValueError("value out of range")
+    elif len(fields) == 3:
+        if fields[2] not in CONSISTENCIES[1:]:
+            raise ValueError("unknown consistency")
+        value = CONSISTENCIES.index(fields[2])
+    return offset, REQUEST_TYPES[fields[0]], key, value
+
+def compile_trace(lines, key_bytes=2):
+    """Returns the binary trace of an iterable of text trace lines; raises
+    ValueError, naming the line, if one isn't a valid command"""
+    record = record_format(key_bytes)
+    records = []
+    for line_n, line in enumerate(lines, 1):
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        try:
+            offset, request_type, key, value = parse_command(fields,
+                    key_bytes)
+        except ValueError as error:
+            raise ValueError("line {}: {}: {!r}".format(line_n, error,
+                    line.rstrip('\n'))) from None
+        records.append(record.pack(offset, 0, request_type, key, value))
+    return HEADER.pack(MAGIC, VERSION, key_bytes, len(records)) + \
+            b''.join(records)
+
+class Trace:
+    """A compiled trace, mapped from path"""
+    def __init__(self, path):
+        with open(path, 'rb') as fh:
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.key_bytes, self.num_records = \
+                HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} isn't a version {} trace".format(path,
+                    VERSION))
+        self.record = record_format(self.key_bytes)
+        size = HEADER.size + self.num_records * self.record.size
+        if len(self.map) < size:
+            raise ValueError("{} is truncated".format(path))
+        self.records = memoryview(self.map)[HEADER.size:size]
+        # where the command (the request but for its message ID) starts
+        # in a record
+        self.command_start = self.record.size - \
+                WireFormat(self.key_bytes).command.size
+
+    def __len__(self):
+        return self.num_records
+
+    def __iter__(self):
+        """Yields (op, key, value, command) for every command, like a
+        Workload; command is a view of the mapped file"""
+        records = self.records
+        size = self.record.size
+        start = self.command_start
+        end = size
+        for offset, message_id, request_type, key, value in \
+                self.record.iter_unpack(records):
+            yield OPS[request_type], key, value, records[start:end]
+            start += size
+            end += size
+
+    def offset(self, index):
+        """Returns when command index was sent, in seconds since the
+        trace started"""
+        return self.record.unpack_from(self.records,
+                index * self.record.size)[0] / 1e6
+
+    def describe(self, index):
+        """Returns command index as text, e.g. 'PUT 5 17'"""
+        offset, message_id, request_type, key, value = \
+                self.record.unpack_from(self.records,
+                index * self.record.size)
+        if OPS[request_type] == PUT:
+            return "PUT {} {}".format(key, value)
+        if value:
+            return "GET {} {}".format(key, CONSISTENCIES[value])
+        return "GET {}".format(key)
+
+    def close(self):
+        self.records.release()
+        self.map.close()
+
+if __name__ == '__main__':
+    if len(argv) >= 4 and argv[1] == 'compile':
+        key_bytes = len(argv) > 4 and int(argv[4]) or 2
+        with open(argv[2]) as infile:
+            try:
+                data = compile_trace(infile, key_bytes)
+            except ValueError as error:
+                print("{}: {}".format(argv[2], error))
+                exit(1)
+        with open(argv[3] + '.tmp', 'wb') as outfile:
+            outfile.write(data)
+        os.replace(argv[3] + '.tmp', argv[3])
+        print("{} commands, {} bytes".format(
+                (len(data) - HEADER.size) // record_format(key_bytes).size,
+                len(data)))
+    elif len(argv) == 3 and argv[1] == 'show':
+        trace = Trace(argv[2])
+        for index in range(len(trace)):
+            print("{:.6f} {}".format(trace.offset(index),
+                    trace.describe(index)))
+        trace.close()
+    else:
+        print("Usage: {0} compile text_trace binary_trace [key_bytes]\n"
+                "       {0} show binary_trace".format(argv[0]))
+        exit(1)
@@ -0,0 +1,128 @@
+"""Write-ahead log and snapshots of a Worker's committed values
+
+Every committed PUT is appended to the log as a record: a CRC32 of the
+rest of the record, the record kind, the key, the payload length and
+the payload (the 8-byte value of a PUT, or the bytes of a PUTV). Records
+are buffered and written with one write and one fsync per group commit,
+at most every `interval` seconds, instead of one fsync per PUT. Commits
+made since the last group commit can be lost in a crash.
+
+Once the log grows past a limit, the Worker writes a snapshot of all of
+its keys in the same record format (to a temporary file that is renamed
+into place) and truncates the log. Recovery loads the snapshot and
+replays the log on top of it, so it reads the snapshot plus at most one
+log's worth of history. A torn record at the end of the log (from a
+crash mid-write) fails its CRC; replay stops there, and the log is cut
+back to the last good record."""
+import os
+import struct
+from time import monotonic
+from zlib import crc32
+
+# crc32, kind, key, payload_length
+RECORD = struct.Struct('>IBQI')
+# the part of the header the CRC covers
+KIND_KEY_LENGTH = struct.Struct('>BQI')
+VALUE = struct.Struct('>Q')
+
+# record kinds
+PUT_RECORD = 0
+PUTV_RECORD = 1
+
+def encode(kind, key, payload):
+    """Returns one record"""
+    body = KIND_KEY_LENGTH.pack(kind, key, len(payload)) + payload
+    return struct.pack('>I', crc32(body)) + body
+
+def read_records(path):
+    """Returns (records, length): (kind, key, payload) for every intact
+    record in a file, and the length of the intact part"""
+    try:
+        with open(path, 'rb') as fh:
+            data = fh.read()
+    except FileNotFoundError:
+        return [], 0
+    view = memoryview(data)
+    records = []
+    offset = 0
+    while len(data) - offset >= RECORD.size:
+        checksum, kind, key, length = RECORD.unpack_from(data, offset)
+        end = offset + RECORD.size + length
+        if end > len(data) or crc32(view[offset + 4:end]) != checksum:
+            # torn write at the end of the log
+            break
+        records.append((kind, key, view[offset + RECORD.size:end]))
+        offset = end
+    return records, offset
+
+def write_snapshot(path, records):
+    """Atomically replaces the snapshot at path with the given records"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fh:
+        for kind, key, payload in records:
+            fh.write(encode(kind, key, payload))
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_path, path)
+    # make the rename itself durable
+    dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+class WriteAheadLog:
+    """Append-only log of committed PUTs with group commit"""
+    def __init__(self, path, interval=0.005):
+        self.path = path
+        # seconds a committed PUT may wait for its fsync
+        self.interval = interval
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                0o644)
+        # bytes on disk
+        self.size = os.fstat(self.fd).st_size
+        # records waiting for the next group commit, and when the oldest
+        # of them was committed
+        self.buffer = bytearray()
+        self.since = 0
+
+    def log_put(self, key, value):
+        self.append(encode(PUT_RECORD, key, VALUE.pack(value)))
+
+    def log_value(self, key, data):
+        self.append(encode(PUTV_RECORD, key, data))
+
+    def append(self, record):
+        if not self.buffer:
+            self.since = monotonic()
+        self.buffer += record
+
+    def dirty(self):
+        """Returns whether there are records waiting for a group commit"""
+        return bool(self.buffer)
+
+    def timeout(self):
+        """Returns how long until the waiting records are due"""
+        return max(0, self.since + self.interval - monotonic())
+
+    def sync(self, force=False):
+        """Writes and fsyncs the waiting records if they are due"""
+        if not self.buffer or (not force and self.timeout() > 0):
+            return
+        view = memoryview(self.buffer)
+        while len(view):
+            view = view[os.write(self.fd, view):]
+        view.release()
+        os.fsync(self.fd)
+        self.size += len(self.buffer)
+        self.buffer.clear()
+
+    def truncate(self, size=0):
+        """Drops everything in the log past size bytes"""
+        os.ftruncate(self.fd, size)
+        os.fsync(self.fd)
+        self.size = size
+
+    def close(self):
+        self.sync(force=True)
+        os.close(self.fd)
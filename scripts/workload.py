@@ -0,0 +1,210 @@
+"""Pre-generated command streams for the test client
+
+All of a client's commands are generated before its timer starts, into
+packed arrays: an operation per command, and the keys and values it
+uses (multi_keys of each for MGETs and MPUTs, one otherwise). Single-key
+GETs and PUTs are also packed as requests, ready to send but for their
+message IDs. The client's loop only reads integers back out of the
+arrays and sends the packed requests as they are, so neither building
+nor parsing commands is part of what gets measured.
+
+A GET's value is its read consistency, as an index into CONSISTENCIES;
+0 leaves it to the client's read_consistency option.
+
+Keys follow one of DISTRIBUTIONS:
+    uniform  every key is equally likely
+    zipf     key of popularity rank r is picked with probability
+             proportional to 1 / r ** zipf_s; ranks are shuffled over the
+             key space, so the popular keys aren't all small numbers
+    hotspot  hot_access_frac of the picks go to hot_key_frac of the keys
+
+A read-modify-write (rmw_frac of the commands) is a GET followed by a PUT
+of the same key. The client doesn't wait for the GET before sending the
+PUT, so this reproduces the access pattern, not the data dependency.
+
+Streams with the same seed are the same, so runs can be repeated
+exactly."""
+from array import array
+from itertools import accumulate
+from random import Random
+from protocol import WireFormat
+
+# operations
+GET = 0
+PUT = 1
+MGET = 2
+MPUT = 3
+
+OP_NAMES = ('GET', 'PUT', 'MGET', 'MPUT')
+
+# read consistencies a GET can ask for; None is the client's default
+CONSISTENCIES = (None, 'one', 'quorum', 'all')
+
+DISTRIBUTIONS = (
+    'uniform',
+    'zipf',
+    'hotspot'
+)
+
+class Workload:
+    """num_commands commands on keys 0 to num_keys - 1
+
+    ops holds an operation per command, and keys and values the keys and
+    values of every command in order; values of GETs are their read
+    consistency (0 for the default), and those of MGETs are 0. Without
+    multi_keys, commands holds every command as a request with
+    key_bytes-wide keys, but for its message ID."""
+    def __init__(self, num_commands, num_keys, get_frac=0.8, max_value=1000,
+            distribution='uniform', zipf_s=0.99, hot_key_frac=0.01,
+            hot_access_frac=0.9, rmw_frac=0, multi_keys=0, seed=None,
+            key_bytes=2):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError("unknown key distribution: {}".format(
+                    distribution))
+        self.num_commands = num_commands
+        self.num_keys = num_keys
+        self.multi_keys = multi_keys
+        self.key_bytes = key_bytes
+        self.command = WireFormat(key_bytes).command
+        self.random = Random(seed)
+        self.distribution = distribution
+        self.zipf_s = zipf_s
+        self.hot_key_frac = hot_key_frac
+        self.hot_access_frac = hot_access_frac
+        # every key, most popular first, and the cumulative zipf weights
+        # of the ranks; made the first time they're needed
+        self.ranking = None
+        self.zipf_weights = None
+        self.ops = array('B')
+        self.keys = array('Q')
+        self.values = array('H')
+        # where each MGET's or MPUT's keys start in keys and values
+        self.starts = array('L')
+        self.commands = bytearray()
+        if multi_keys:
+            self.generate_multi(get_frac, max_value)
+        else:
+            self.generate(get_frac, max_value, rmw_frac)
+            # an operation is its request type
+            self.commands = bytearray().join(self.command.pack(bytes((op,)),
+                    key, value) for op, key, value in zip(self.ops,
+                    self.keys, self.values))
+
+    def __len__(self):
+        return self.num_commands
+
+    def __iter__(self):
+        """Yields (op, key, value, command) for every command, where
+        command is a view of its packed request; for MGETs and MPUTs, key
+        and value are arrays of multi_keys keys and values, and command is
+        None"""
+        if not self.multi_keys:
+            commands = memoryview(self.commands)
+            size = self.command.size
+            start = 0
+            for op, key, value in zip(self.ops, self.keys, self.values):
+                yield op, key, value, commands[start:start + size]
+                start += size
+            return
+        keys = self.keys
+        values = self.values
+        multi_keys = self.multi_keys
+        for op, start in zip(self.ops, self.starts):
+            end = start + multi_keys
+            yield op, keys[start:end], values[start:end], None
+
+    def generate(self, get_frac, max_value, rmw_frac):
+        """Fills in single-key GETs, PUTs and read-modify-writes"""
+        rand = self.random.random
+        num_commands = self.num_commands
+        keys = self.pick_keys(num_commands)
+        ops = self.ops
+        values = self.values
+        out_keys = self.keys
+        index = 0
+        while len(ops) < num_commands:
+            key = keys[index]
+            index += 1
+            choice = rand()
+            if choice < rmw_frac and len(ops) + 1 < num_commands:
+                ops.extend((GET, PUT))
+                out_keys.extend((key, key))
+                values.extend((0, int(rand() * max_value)))
+            elif choice < rmw_frac + (1 - rmw_frac) * get_frac:
+                ops.append(GET)
+                out_keys.append(key)
+                values.append(0)
+            else:
+                ops.append(PUT)
+                out_keys.append(key)
+                values.append(int(rand() * max_value))
+
+    def generate_multi(self, get_frac, max_value):
+        """Fills in MGETs and MPUTs of multi_keys different keys each"""
+        rand = self.random.random
+        multi_keys = min(self.multi_keys, self.num_keys)
+        self.multi_keys = multi_keys
+        for index in range(self.num_commands):
+            keys = set()
+            while len(keys) < multi_keys:
+                keys.update(self.pick_keys(multi_keys - len(keys)))
+            self.starts.append(len(self.keys))
+            self.keys.extend(sorted(keys))
+            if rand() < get_frac:
+                self.ops.append(MGET)
+                self.values.extend([0] * multi_keys)
+            else:
+                self.ops.append(MPUT)
+                self.values.extend(int(rand() * max_value)
+                        for i in range(multi_keys))
+
+    def pick_keys(self, count):
+        """Returns count keys drawn from the distribution"""
+        rand = self.random.random
+        num_keys = self.num_keys
+        if self.distribution == 'uniform':
+            return [int(rand() * num_keys) for i in range(count)]
+        if self.distribution == 'hotspot':
+            keys = self.ranked_keys()
+            num_hot = min(num_keys, max(1, int(self.hot_key_frac * num_keys)))
+            num_cold = num_keys - num_hot
+            hot_access_frac = self.hot_access_frac
+            picks = []
+            for i in range(count):
+                if rand() < hot_access_frac or not num_cold:
+                    picks.append(keys[int(rand() * num_hot)])
+                else:
+                    picks.append(keys[num_hot + int(rand() * num_cold)])
+            return picks
+        if self.zipf_weights is None:
+            s = self.zipf_s
+            self.zipf_weights = list(accumulate(1 / rank ** s
+                    for rank in range(1, num_keys + 1)))
+        return self.random.choices(self.ranked_keys(),
+                cum_weights=self.zipf_weights, k=count)
+
+    def ranked_keys(self):
+        """Returns every key, most popular first"""
+        if self.ranking is None:
+            self.ranking = list(range(self.num_keys))
+            self.random.shuffle(self.ranking)
+        return self.ranking
+
+    def describe(self, index):
+        """Returns command index as text, e.g. 'PUT 5 17'"""
+        op = self.ops[index]
+        if not self.multi_keys:
+            args = [self.keys[index]]
+            if op == PUT:
+                args.append(self.values[index])
+            elif self.values[index]:
+                args.append(CONSISTENCIES[self.values[index]])
+        else:
+            start = self.starts[index]
+            end = start + self.multi_keys
+            if op == MGET:
+                args = self.keys[start:end]
+            else:
+                args = [arg for pair in zip(self.keys[start:end],
+                        self.values[start:end]) for arg in pair]
+        return ' '.join([OP_NAMES[op]] + list(map(str, args)))